@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+import os
+import sys
+import signal
+import asyncio
+import argparse
+from loguru import logger
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'helpers')))
+from parameters import Becik4UParameters
+from service.job_manager import JobManager
+from service.slice_store import SliceStore
+from service.http_server import JobServer
+
+class APIService:
+    """
+    HTTP job service running ingest and preprocessing jobs in worker process pools.
+    """
+
+    def __init__(self, host: str, port: int, ingest_workers: int, preprocess_workers: int, cpus: int = None,
+                 options: dict = None, volume_cache_bytes: int = 1 << 30, slice_cache_bytes: int = 64 << 20):
+        logger.remove(0)
+        logger.add(sys.stderr, format = "<red>[{level}]</red> <green>{message}</green> ", colorize=True)
+        self.params = Becik4UParameters()
+
+        cpu_budget = cpus or os.cpu_count() or 1
+        self.manager = JobManager({
+            'ingest': (ingest_workers, max(1, cpu_budget // max(ingest_workers, 1))),
+            'preprocess': (preprocess_workers, max(1, cpu_budget // max(preprocess_workers, 1))),
+        }, options)
+        self.slice_store = SliceStore(self.params, volume_cache_bytes, slice_cache_bytes)
+        self.server = JobServer(self.manager, self.slice_store, host, port)
+
+    async def serve(self) -> None:
+        """Serve until SIGINT or SIGTERM, then stop the workers."""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, stop_event.set)
+
+        self.manager.start()
+        await self.server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("### API : shutting down ###")
+            await self.server.stop()
+            await self.manager.stop()
+
+def main():
+    """
+    Main function to parse command-line arguments and run the job service.
+    """
+    parser = argparse.ArgumentParser(description="Becik4U Job API Service")
+    parser.add_argument('--host', default="127.0.0.1", help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--ingest-workers', type=int, default=2, help='Worker processes running DICOM/NIfTI ingest jobs.')
+    parser.add_argument('--preprocess-workers', type=int, default=1, help='Worker processes running preprocessing jobs.')
+    parser.add_argument('--cpus', type=int, default=None, help='CPU budget split between the workers of each pool (default: all CPUs).')
+    parser.add_argument('--refrence-vectors', default=None, help='Reference vectors JSON file (default: refrence_vectors.json in BECIK4U_CORE).')
+    parser.add_argument('--compress-level', type=int, choices=range(0, 10), default=6, help='gzip/zip compression level of the outputs.')
+    parser.add_argument('--preview', nargs='?', choices=("uint8", "uint16"), const="uint8", default=None,
+                        help='Preprocessing jobs also write a quantized preview pyramid and thumbnails (default type: uint8).')
+    parser.add_argument('--telemetry', default=None, help='Append per-step resource usage events of every job to this JSON-lines file.')
+    parser.add_argument('--volume-cache-mb', type=int, default=1024, help='Memory for decoded volumes served as slices, in MB.')
+    parser.add_argument('--slice-cache-mb', type=int, default=64, help='Memory for encoded slices, in MB.')
+    args = parser.parse_args()
+
+    service = APIService(
+        args.host, args.port, args.ingest_workers, args.preprocess_workers, args.cpus,
+        options={'refrence_vectors': args.refrence_vectors, 'compress_level': args.compress_level, 'telemetry': args.telemetry,
+                 'preview_dtype': args.preview},
+        volume_cache_bytes=args.volume_cache_mb << 20,
+        slice_cache_bytes=args.slice_cache_mb << 20
+    )
+    asyncio.run(service.serve())
+
+
+if __name__ == "__main__":
+    main()
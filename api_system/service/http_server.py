@@ -0,0 +1,252 @@
+import re
+import json
+import asyncio
+import urllib.parse
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from .job_manager import JobManager, JobError, FINISHED_STATES
+from .slice_store import SliceStore, VOLUME_SOURCES, AXES
+
+MAX_BODY_BYTES = 1 << 20
+
+# Seconds between keep-alive comments of an idle event stream
+HEARTBEAT_SECONDS = 15
+
+# Threads reading and encoding slices, so decoding a volume does not block the event loop
+READER_THREADS = 4
+
+SCAN_ROUTE = r"^/scans/(?P<scan_id>[A-Za-z0-9][A-Za-z0-9._-]*)/(?P<volume>" + "|".join(VOLUME_SOURCES) + ")"
+
+
+class HTTPError(Exception):
+    """An HTTP error answered with a JSON body."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class JobServer:
+    """
+    Minimal asyncio HTTP/1.1 server exposing the JobManager as a JSON API.
+
+    Routes:
+        GET    /health               Service and pool status.
+        POST   /jobs                 Submit a job ({"operation": ..., "scan_id": ..., ...}).
+        GET    /jobs                 Status of every known job.
+        GET    /jobs/{id}            Status of one job.
+        DELETE /jobs/{id}            Cancel a queued or running job.
+        GET    /jobs/{id}/events     Server-Sent Events: 'status' and 'progress' until the job finishes.
+        GET    /scans/{id}/{volume}                  Shape, dtype and source of a processed volume.
+        GET    /scans/{id}/{volume}/{axis}/{index}   One slice as PNG or '.npy' (?format=, ?min=&max=).
+        GET    /scans/{id}/{volume}/block            A sub-block as '.npy' (?x=start:stop&y=...&z=...).
+
+    Each connection serves one request.
+    """
+
+    ROUTES = (
+        ("GET", re.compile(r"^/health$"), "health"),
+        ("POST", re.compile(r"^/jobs$"), "submit"),
+        ("GET", re.compile(r"^/jobs$"), "list_jobs"),
+        ("GET", re.compile(r"^/jobs/(?P<job_id>[0-9a-f]+)$"), "job_status"),
+        ("DELETE", re.compile(r"^/jobs/(?P<job_id>[0-9a-f]+)$"), "cancel"),
+        ("GET", re.compile(r"^/jobs/(?P<job_id>[0-9a-f]+)/events$"), "events"),
+        ("GET", re.compile(SCAN_ROUTE + r"$"), "volume_info"),
+        ("GET", re.compile(SCAN_ROUTE + r"/block$"), "volume_block"),
+        ("GET", re.compile(SCAN_ROUTE + r"/(?P<axis>" + "|".join(AXES) + r")/(?P<index>[0-9]+)$"), "volume_slice"),
+    )
+
+    def __init__(self, manager: JobManager, slice_store: SliceStore, host: str = "127.0.0.1", port: int = 8080):
+        self.manager = manager
+        self.slice_store = slice_store
+        self.host = host
+        self.port = port
+        self.server = None
+        self.reader_executor = ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix="slice-reader")
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        logger.info(f"### API : listening on http://{self.host}:{self.port} ###")
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.reader_executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict]:
+        """Read one request: its method, path and a dict of 'query', 'headers' and 'body'."""
+        request_line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            raise HTTPError(400, "Malformed request line")
+        method, target, _ = parts
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return method, url.path, {'query': query, 'headers': headers, 'body': body}
+
+    @staticmethod
+    async def send_response(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str,
+                            cache_control: str = "no-store") -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Cache-Control: {cache_control}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    @staticmethod
+    async def send_json(writer: asyncio.StreamWriter, status: int, payload) -> None:
+        await JobServer.send_response(writer, status, json.dumps(payload).encode(), "application/json")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, request = await self.read_request(reader)
+            for route_method, pattern, handler_name in self.ROUTES:
+                match = pattern.match(path)
+                if match and route_method == method:
+                    await getattr(self, handler_name)(writer, request, **match.groupdict())
+                    break
+            else:
+                allowed = any(pattern.match(path) for _, pattern, _ in self.ROUTES)
+                raise HTTPError(405 if allowed else 404, f"No route for {method} {path}")
+        except HTTPError as error_exc:
+            await self.send_json(writer, error_exc.status, {'error': str(error_exc)})
+        except JobError as error_exc:
+            payload = {'error': str(error_exc)}
+            if error_exc.job is not None:
+                payload['job'] = error_exc.job.to_dict()
+            await self.send_json(writer, error_exc.status, payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as error_exc:
+            logger.error(f"#!!# API ERROR #**# {error_exc}")
+            await self.send_json(writer, 500, {'error': str(error_exc)})
+        finally:
+            writer.close()
+
+    async def health(self, writer, request) -> None:
+        jobs = self.manager.jobs.values()
+        await self.send_json(writer, 200, {
+            'status': 'ok',
+            'pools': {kind: {'workers': workers, 'cpus_per_worker': cpus} for kind, (workers, cpus) in self.manager.pools.items()},
+            'jobs': {state: sum(1 for x in jobs if x.state == state) for state in ("queued", "running") + FINISHED_STATES},
+            'cache': self.slice_store.stats(),
+        })
+
+    async def submit(self, writer, request) -> None:
+        try:
+            job_request = json.loads(request['body'] or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Request body is not valid JSON")
+        job = self.manager.submit(job_request)
+        await self.send_json(writer, 202, job.to_dict())
+
+    async def list_jobs(self, writer, request) -> None:
+        await self.send_json(writer, 200, [x.to_dict() for x in self.manager.jobs.values()])
+
+    async def job_status(self, writer, request, job_id: str) -> None:
+        await self.send_json(writer, 200, self.manager.get(job_id).to_dict())
+
+    async def cancel(self, writer, request, job_id: str) -> None:
+        job = self.manager.cancel(job_id)
+        await self.send_json(writer, 202, job.to_dict())
+
+    async def events(self, writer, request, job_id: str) -> None:
+        """Stream the job's events, replaying those after Last-Event-ID first."""
+        job = self.manager.get(job_id)
+        try:
+            after = int(request['headers'].get("last-event-id", -1))
+        except ValueError:
+            after = -1
+
+        queue = self.manager.subscribe(job, after)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+            await writer.drain()
+
+            while True:
+                try:
+                    index, event, data = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")
+                    await writer.drain()
+                    continue
+
+                writer.write(f"id: {index}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                await writer.drain()
+                if event == "status" and data['state'] in FINISHED_STATES:
+                    break
+        finally:
+            self.manager.unsubscribe(job, queue)
+
+    async def read_volume(self, function, *args):
+        """Run a SliceStore read on the reader threads, mapping its errors to HTTP errors."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.reader_executor, function, *args)
+        except LookupError as error_exc:
+            raise HTTPError(404, str(error_exc))
+        except ValueError as error_exc:
+            raise HTTPError(400, str(error_exc))
+
+    async def volume_info(self, writer, request, scan_id: str, volume: str) -> None:
+        await self.send_json(writer, 200, await self.read_volume(self.slice_store.describe, scan_id, volume))
+
+    async def volume_slice(self, writer, request, scan_id: str, volume: str, axis: str, index: str) -> None:
+        query = request['query']
+        slice_format = query.get('format', "png")
+        window = None
+        if 'min' in query or 'max' in query:
+            try:
+                window = (float(query['min']), float(query['max']))
+            except (KeyError, ValueError):
+                raise HTTPError(400, "'min' and 'max' must both be numbers")
+
+        encoded = await self.read_volume(self.slice_store.read_slice, scan_id, volume, axis, int(index), slice_format, window)
+        content_type = "image/png" if slice_format == "png" else "application/octet-stream"
+        await self.send_response(writer, 200, encoded, content_type, cache_control="private, max-age=60")
+
+    async def volume_block(self, writer, request, scan_id: str, volume: str) -> None:
+        bounds = []
+        for name in ("x", "y", "z"):
+            value = request['query'].get(name)
+            if value is None:
+                bounds.append(None)
+                continue
+            try:
+                start, stop = (int(x) for x in value.split(":"))
+            except ValueError:
+                raise HTTPError(400, f"'{name}' must be start:stop")
+            bounds.append((start, stop))
+
+        encoded = await self.read_volume(self.slice_store.read_block, scan_id, volume, bounds)
+        await self.send_response(writer, 200, encoded, "application/octet-stream", cache_control="private, max-age=60")
@@ -0,0 +1,344 @@
+import os
+import re
+import time
+import uuid
+import signal
+import asyncio
+import multiprocessing
+from loguru import logger
+
+from .job_worker import worker_main, OPERATIONS
+
+# Required and optional arguments of every operation
+OPERATION_ARGUMENTS = {
+    'dicom': (('scan_id', 'root_dir'), ()),
+    'nifti': (('scan_id', 'file_name'), ('volume', 'resampler', 'compress_level', 'numpy_format')),
+    'preprocess': (('scan_id',), ('force_from', 'refrence_vectors')),
+}
+
+# Stages 'force_from' may name, mirrors PIPELINE_STAGES of preprosesing_system/utils/processing_wrapper.py
+# (the service process does not import the pipeline)
+PIPELINE_STAGES = ("skullstrip", "segmentation", "grouping", "orientation", "reorient", "preview")
+
+ACTIVE_STATES = ("queued", "running")
+FINISHED_STATES = ("succeeded", "failed", "cancelled")
+
+# Finished jobs kept for status queries, the oldest are forgotten first
+MAX_FINISHED_JOBS = 1000
+
+SCAN_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
+class JobError(Exception):
+    """A job request that cannot be accepted, with the HTTP status to answer it with."""
+
+    def __init__(self, status: int, message: str, job: "Job" = None):
+        super().__init__(message)
+        self.status = status
+        self.job = job
+
+
+class Job:
+    """
+    One submitted ingest or preprocessing job and the events published about it.
+    """
+
+    def __init__(self, operation: str, arguments: dict):
+        self.job_id = uuid.uuid4().hex
+        self.operation = operation
+        self.kind = OPERATIONS[operation]
+        self.arguments = arguments
+        self.state = "queued"
+        self.progress = {'current_step': 0, 'total_steps': None, 'message': "Queued"}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+        self.worker = None
+        self.history = []
+        self.subscribers = set()
+
+    def to_dict(self) -> dict:
+        """Status of the job as returned by the API."""
+        return {
+            'job_id': self.job_id,
+            'operation': self.operation,
+            'scan_id': self.arguments['scan_id'],
+            'arguments': self.arguments,
+            'state': self.state,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class WorkerProcess:
+    """
+    A long-lived worker process running the jobs of one kind, and its pipe.
+    """
+
+    def __init__(self, kind: str, cpu_budget: int, options: dict):
+        context = multiprocessing.get_context("spawn")
+        self.kind = kind
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(kind, child_connection, cpu_budget, options), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    async def receive(self):
+        """
+        Wait for the next message without blocking the event loop.
+
+        Raises:
+            EOFError: If the worker process exited.
+        """
+        loop = asyncio.get_running_loop()
+        file_descriptor = self.connection.fileno()
+        while not self.connection.poll():
+            readable = loop.create_future()
+            loop.add_reader(file_descriptor, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(file_descriptor)
+        return self.connection.recv()
+
+    def kill(self) -> None:
+        """Kill the worker and every process it started."""
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            self.process.kill()
+
+    def close(self) -> None:
+        """Stop the worker, waiting briefly for it to leave on its own."""
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class JobManager:
+    """
+    Queues jobs per worker kind and runs them on a bounded set of worker processes.
+
+    Ingest and preprocessing jobs run in separate pools: each pool slot keeps one worker
+    process alive between jobs, so torch/MONAI are imported once per worker rather than
+    once per job. Jobs of a scan are rejected while another job of that scan is active.
+    """
+
+    def __init__(self, pools: dict[str, tuple[int, int]], options: dict = None):
+        """
+        Initializes the manager.
+
+        Args:
+            pools (dict[str, tuple[int, int]]): Worker kind -> (worker processes, CPUs per worker).
+            options (dict): Options passed to every worker, see JobRunner.
+        """
+        self.pools = pools
+        self.options = dict(options or {})
+        self.jobs = {}
+        self.queues = {}
+        self.workers = set()
+        self.slot_tasks = []
+
+    def start(self) -> None:
+        """Start the pool slots (workers are spawned by their first job)."""
+        for kind, (workers, cpus) in self.pools.items():
+            self.queues[kind] = asyncio.Queue()
+            for _ in range(workers):
+                self.slot_tasks.append(asyncio.create_task(self._run_slot(kind, cpus)))
+
+    async def stop(self) -> None:
+        """Cancel the pool slots and stop every worker process."""
+        for task in self.slot_tasks:
+            task.cancel()
+        await asyncio.gather(*self.slot_tasks, return_exceptions=True)
+        for worker in list(self.workers):
+            worker.close()
+        self.workers.clear()
+
+    @staticmethod
+    def validate(request: dict) -> tuple[str, dict]:
+        """
+        Check a job request.
+
+        Args:
+            request (dict): 'operation' plus the arguments of OPERATION_ARGUMENTS.
+
+        Returns:
+            tuple[str, dict]: The operation and its arguments.
+
+        Raises:
+            JobError: If the request is malformed.
+        """
+        if not isinstance(request, dict):
+            raise JobError(400, "Request body must be a JSON object")
+
+        operation = request.get('operation')
+        if operation not in OPERATION_ARGUMENTS:
+            raise JobError(400, f"'operation' must be one of {', '.join(OPERATION_ARGUMENTS)}")
+
+        required, optional = OPERATION_ARGUMENTS[operation]
+        missing = [x for x in required if x not in request]
+        if missing:
+            raise JobError(400, f"Missing arguments: {', '.join(missing)}")
+        unknown = [x for x in request if x != 'operation' and x not in required + optional]
+        if unknown:
+            raise JobError(400, f"Unknown arguments: {', '.join(unknown)}")
+
+        scan_id = request['scan_id']
+        if not isinstance(scan_id, str) or not SCAN_ID_PATTERN.match(scan_id):
+            raise JobError(400, "'scan_id' may only contain letters, digits, '.', '_' and '-'")
+        if request.get('force_from') is not None and request['force_from'] not in PIPELINE_STAGES:
+            raise JobError(400, f"'force_from' must be one of {', '.join(PIPELINE_STAGES)}")
+
+        return operation, {x: request[x] for x in required + optional if x in request}
+
+    def submit(self, request: dict) -> Job:
+        """
+        Queue a job.
+
+        Raises:
+            JobError: If the request is malformed or the scan already has an active job.
+        """
+        operation, arguments = self.validate(request)
+        for job in self.jobs.values():
+            if job.state in ACTIVE_STATES and job.arguments['scan_id'] == arguments['scan_id']:
+                raise JobError(409, f"Scan '{arguments['scan_id']}' already has an active job", job)
+
+        job = Job(operation, arguments)
+        self.jobs[job.job_id] = job
+        self._publish(job, "status", job.to_dict())
+        self.queues[job.kind].put_nowait(job)
+        logger.info(f"### JOB {job.job_id} : {operation} {arguments['scan_id']} - QUEUED ###")
+        return job
+
+    def get(self, job_id: str) -> Job:
+        """
+        Look up a job.
+
+        Raises:
+            JobError: If the job is unknown.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise JobError(404, f"Job '{job_id}' not found")
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        """
+        Cancel a queued or running job; a running job's worker is killed and replaced.
+
+        Raises:
+            JobError: If the job is unknown or already finished.
+        """
+        job = self.get(job_id)
+        if job.state in FINISHED_STATES:
+            raise JobError(409, f"Job '{job_id}' already {job.state}", job)
+
+        job.cancel_requested = True
+        if job.state == "queued":
+            self._finish(job, "cancelled")
+        elif job.worker is not None:
+            logger.info(f"### JOB {job.job_id} - CANCELLING ###")
+            job.worker.kill()
+        return job
+
+    def subscribe(self, job: Job, after: int = -1) -> asyncio.Queue:
+        """
+        Subscribe to the events of a job; events after index ``after`` are replayed first.
+
+        Returns:
+            asyncio.Queue: Receives (index, event, data) tuples.
+        """
+        queue = asyncio.Queue()
+        for index, (event, data) in enumerate(job.history):
+            if index > after:
+                queue.put_nowait((index, event, data))
+        job.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, job: Job, queue: asyncio.Queue) -> None:
+        job.subscribers.discard(queue)
+
+    def _publish(self, job: Job, event: str, data: dict) -> None:
+        """Record an event of a job and pass it to its subscribers."""
+        job.history.append((event, data))
+        for queue in job.subscribers:
+            queue.put_nowait((len(job.history) - 1, event, data))
+
+    def _finish(self, job: Job, state: str, result: dict = None, error: str = None) -> None:
+        """Move a job to a finished state and forget the oldest finished jobs."""
+        job.state = state
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        job.worker = None
+        self._publish(job, "status", job.to_dict())
+        logger.info(f"### JOB {job.job_id} : {job.operation} {job.arguments['scan_id']} - {state.upper()} ###")
+
+        finished = [x for x in self.jobs.values() if x.state in FINISHED_STATES]
+        for old_job in sorted(finished, key=lambda x: x.finished)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[old_job.job_id]
+
+    async def _run_slot(self, kind: str, cpus: int) -> None:
+        """Run the jobs of one pool slot, one after another, on its worker process."""
+        worker = None
+        try:
+            while True:
+                job = await self.queues[kind].get()
+                if job.state != "queued":
+                    continue
+
+                if worker is None or not worker.is_alive():
+                    if worker is not None:
+                        self.workers.discard(worker)
+                        worker.close()
+                    worker = WorkerProcess(kind, cpus, self.options)
+                    self.workers.add(worker)
+
+                job.worker = worker
+                job.state = "running"
+                job.started = time.time()
+                self._publish(job, "status", job.to_dict())
+                worker.connection.send((job.job_id, job.operation, job.arguments))
+
+                while job.state == "running":
+                    try:
+                        message_type, _, payload = await worker.receive()
+                    except (EOFError, OSError):
+                        self.workers.discard(worker)
+                        worker.close()
+                        worker = None
+                        if job.cancel_requested:
+                            self._finish(job, "cancelled")
+                        else:
+                            self._finish(job, "failed", error="Worker process exited")
+                        break
+
+                    if message_type == "progress":
+                        job.progress = payload
+                        self._publish(job, "progress", payload)
+                    elif message_type == "result":
+                        self._finish(job, "succeeded", result={**payload['result'], 'seconds': payload['seconds']})
+                    elif message_type == "failed":
+                        self._finish(job, "failed", error=payload['error'])
+        finally:
+            if worker is not None:
+                self.workers.discard(worker)
+                worker.close()
@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import signal
+import threading
+from loguru import logger
+
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# Worker kind -> system directory whose 'utils' package the worker imports
+WORKER_SYSTEMS = {
+    'ingest': "ingest_system",
+    'preprocess': "preprosesing_system",
+}
+
+# Operation -> worker kind running it
+OPERATIONS = {
+    'dicom': 'ingest',
+    'nifti': 'ingest',
+    'preprocess': 'preprocess',
+}
+
+# Telemetry steps of the ingest operations, reported as progress
+INGEST_STEPS = {
+    'dicom': ("stage", "group", "fingerprint", "convert"),
+    'nifti': ("read", "fingerprint", "write_raw", "resample", "write_sampled"),
+}
+
+
+def worker_main(kind: str, connection, cpu_budget: int, options: dict) -> None:
+    """
+    Entry point of a worker process: runs the jobs received on the pipe until it is closed.
+
+    The worker leads its own process group, so cancelling a job also stops the FreeSurfer
+    processes it started.
+    """
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sys.path.append(os.path.join(REPOSITORY_ROOT, "helpers"))
+    sys.path.append(os.path.join(REPOSITORY_ROOT, WORKER_SYSTEMS[kind]))
+
+    logger.remove()
+    logger.add(sys.stderr, format="<red>[{level}]</red> <green>{message}</green> ", colorize=True)
+    JobRunner(kind, connection, cpu_budget, options).serve()
+
+
+class JobRunner:
+    """
+    Runs the jobs of one worker process and sends their progress back through its pipe.
+
+    Messages are (message_type, job_id, payload) tuples: 'progress' with the current step,
+    then 'result' or 'failed'.
+    """
+
+    def __init__(self, kind: str, connection, cpu_budget: int, options: dict):
+        """
+        Initializes the runner, importing the pipeline of its kind once.
+
+        Args:
+            kind (str): 'ingest' or 'preprocess'.
+            connection (multiprocessing.connection.Connection): Pipe to the service.
+            cpu_budget (int): CPUs of this worker.
+            options (dict): 'telemetry' events file, 'refrence_vectors' file, 'compress_level' and 'preview_dtype'.
+        """
+        from parameters import Becik4UParameters
+        from telemetry import Telemetry
+
+        self.kind = kind
+        self.connection = connection
+        self.cpu_budget = cpu_budget
+        self.options = options
+        self.send_lock = threading.Lock()
+        self.job_id = None
+        self.operation = None
+        self.last_error = None
+
+        self.params = Becik4UParameters()
+        self.telemetry = Telemetry(events_path=options.get('telemetry'))
+        self.telemetry.add_listener(self._on_event)
+        logger.add(self._on_error_log, level="ERROR", format="{message}")
+
+        if kind == "preprocess":
+            import torch
+            import monai.transforms  # noqa: F401, imported lazily by the pipeline, loaded before the first job
+            from output_writer import OutputWriter
+            from utils.processing_wrapper import PreprocessingWrapper
+
+            torch.set_num_threads(cpu_budget)
+            self.wrapper = PreprocessingWrapper(
+                cpu_budget=cpu_budget,
+                output_writer=OutputWriter(compress_level=options.get('compress_level', 6), threads=cpu_budget),
+                telemetry=self.telemetry,
+                status_callback=self._on_status,
+                preview_dtype=options.get('preview_dtype')
+            )
+
+    def send(self, message_type: str, payload: dict) -> None:
+        """Send a message about the current job (safe from the pipeline's threads)."""
+        with self.send_lock:
+            self.connection.send((message_type, self.job_id, payload))
+
+    def _on_status(self, current_step: int, total_steps: int, message: str, elapsed: float = None) -> None:
+        """Forward a pipeline status update as progress."""
+        from utils.processing_wrapper import PreprocessingWrapper
+
+        PreprocessingWrapper.print_status(current_step, total_steps, message, elapsed)
+        progress = {'current_step': current_step, 'total_steps': total_steps, 'message': message}
+        if elapsed is not None:
+            progress['elapsed_seconds'] = round(elapsed, 3)
+        self.send("progress", progress)
+
+    def _on_event(self, record: dict) -> None:
+        """Forward the telemetry events of the ingest steps as progress."""
+        steps = INGEST_STEPS.get(self.operation)
+        if record['event'] != "ingest" or steps is None or record['name'] not in steps:
+            return
+        self.send("progress", {
+            'current_step': steps.index(record['name']) + 1,
+            'total_steps': len(steps),
+            'message': record['name'],
+            'elapsed_seconds': record.get('wall_seconds'),
+        })
+
+    def _on_error_log(self, message) -> None:
+        """Keep the last error logged by the current job, the pipeline reports failures this way."""
+        if self.job_id is not None:
+            self.last_error = str(message).strip()
+
+    def serve(self) -> None:
+        """Run jobs until the service closes the pipe or sends None."""
+        while True:
+            try:
+                message = self.connection.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+
+            self.job_id, self.operation, arguments = message
+            self.last_error = None
+            start_time = time.perf_counter()
+            try:
+                result = self.run(self.operation, arguments)
+                self.send("result", {'result': result, 'seconds': round(time.perf_counter() - start_time, 3)})
+            except Exception as error_exc:
+                logger.error(f"#!!# JOB {self.job_id} FAILED #**# {error_exc}")
+                self.send("failed", {'error': str(error_exc), 'seconds': round(time.perf_counter() - start_time, 3)})
+            finally:
+                self.job_id = self.operation = None
+                # The events are already in the events file, the worker lives as long as the service
+                with self.telemetry.lock:
+                    self.telemetry.events.clear()
+
+    def run(self, operation: str, arguments: dict) -> dict:
+        """
+        Run one job.
+
+        Args:
+            operation (str): 'dicom', 'nifti' or 'preprocess'.
+            arguments (dict): Validated job arguments, always including 'scan_id'.
+
+        Returns:
+            dict: The result reported to the caller.
+        """
+        scan_id = arguments['scan_id']
+
+        if operation == "dicom":
+            from utils.dicom_ingestion import DICOMIngestion
+            from utils.directory_scanner import DirectoryScanner
+
+            self.send("progress", {'current_step': 0, 'total_steps': len(INGEST_STEPS[operation]), 'message': "Setup"})
+            report = DICOMIngestion.ingest_and_convert(self.params, scan_id, arguments['root_dir'], self.telemetry, self.cpu_budget)
+            return {'scan_id': scan_id, **report, 'files': DirectoryScanner().scan(report['nifti_root'])}
+
+        if operation == "nifti":
+            from output_writer import OutputWriter
+            from utils.nifti_ingestion import NIFTIIngestion
+
+            self.send("progress", {'current_step': 0, 'total_steps': len(INGEST_STEPS[operation]), 'message': "Setup"})
+            writer = OutputWriter(
+                compress_level=arguments.get('compress_level', self.options.get('compress_level', 6)),
+                threads=self.cpu_budget,
+                numpy_format=arguments.get('numpy_format', "npz")
+            )
+            NIFTIIngestion.internal_ingest(
+                self.params, scan_id, arguments['file_name'], writer,
+                arguments.get('volume', 0), arguments.get('resampler', "builtin"), self.telemetry
+            )
+            return {'scan_id': scan_id, 'data_root': os.path.join(self.params.get_root_scan_dir(scan_id), "data")}
+
+        if operation == "preprocess":
+            from utils.processing_base import PreprocessingBase
+
+            vectors_file = arguments.get('refrence_vectors') or self.options.get('refrence_vectors') \
+                or os.path.join(self.params.becik4u_core, "refrence_vectors.json")
+            success = self.wrapper.preprocessing_pipeline(
+                prams=self.params,
+                scan_id=scan_id,
+                refrence_vectors=PreprocessingBase.load_refrence_vectors(vectors_file),
+                force_from=arguments.get('force_from')
+            )
+            if not success:
+                raise Exception(self.last_error or "Preprocessing failed")
+            return {'scan_id': scan_id, 'data_root': os.path.join(self.params.get_root_scan_dir(scan_id), "data")}
+
+        raise Exception(f"Unknown operation '{operation}'")
@@ -0,0 +1,257 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from parameters import Becik4UParameters
+from output_writer import OutputWriter
+from nifti_reader import NiftiReader
+
+# Files of each served volume in the scan's data directory, fastest first: memory-mappable
+# copies are sliced in place, compressed ones are decoded once and kept in the volume cache
+VOLUME_SOURCES = {
+    'palapa': ("{id}_palapa.npy", "{id}_palapa.nii", "{id}_palapa.npz", "{id}_palapa.nii.gz"),
+    'sampled': ("{id}_sampled.nii", "{id}_sampled.nii.gz"),
+}
+
+# Slice name -> voxel axis
+AXES = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+
+SLICE_FORMATS = ("png", "npy")
+
+# Stride of the sample the default PNG window is computed from, and its percentiles
+WINDOW_STRIDE = 4
+WINDOW_PERCENTILES = (1, 99)
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its values.
+
+    Values with a size of 0 (memory-mapped volumes) only count towards ``max_entries``.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = 256):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int) -> None:
+        """Insert a value, evicting the least recently used ones; a value larger than the cache is not kept."""
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class SliceStore:
+    """
+    Reads single slices and sub-blocks of the processed volumes of a scan.
+
+    Uncompressed copies ('.npy', '.nii') are memory-mapped, so a slice only reads its own
+    pages; compressed volumes are decoded once into a bounded LRU cache. Encoded slices
+    are cached as well, so scrolling back and forth through a study is served from memory.
+    Cache keys include the file's size and modification time, so rewritten outputs are
+    picked up on the next request.
+    """
+
+    def __init__(self, params: Becik4UParameters, volume_cache_bytes: int = 1 << 30, slice_cache_bytes: int = 64 << 20):
+        """
+        Initializes the store.
+
+        Args:
+            params (Becik4UParameters): Instance of the Becik4UParameters class.
+            volume_cache_bytes (int): Bytes of decoded (not memory-mapped) volumes kept in memory.
+            slice_cache_bytes (int): Bytes of encoded slices kept in memory.
+        """
+        self.params = params
+        self.volumes = LRUCache(volume_cache_bytes, max_entries=64)
+        self.slices = LRUCache(slice_cache_bytes, max_entries=4096)
+        self.loading_locks = {}
+        self.lock = threading.Lock()
+
+    def find_source(self, scan_id: str, volume: str) -> tuple[str, tuple]:
+        """
+        Finds the fastest available file of a volume.
+
+        Returns:
+            tuple[str, tuple]: The file path and its cache key (path, size, mtime).
+
+        Raises:
+            LookupError: If the volume has no file.
+        """
+        if volume not in VOLUME_SOURCES:
+            raise LookupError(f"Unknown volume '{volume}'")
+
+        data_root = os.path.join(self.params.get_root_scan_dir(scan_id), "data")
+        for pattern in VOLUME_SOURCES[volume]:
+            file_path = os.path.join(data_root, pattern.format(id=scan_id))
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            return file_path, (file_path, file_stat.st_size, file_stat.st_mtime_ns)
+        raise LookupError(f"No '{volume}' volume for scan '{scan_id}'")
+
+    @staticmethod
+    def load_array(file_path: str) -> np.ndarray:
+        """Memory-map an uncompressed volume, or decode a compressed one."""
+        if file_path.endswith(".npy"):
+            return np.load(file_path, mmap_mode="r")
+        if file_path.endswith(".npz"):
+            with np.load(file_path) as npz_ref:
+                return npz_ref[npz_ref.files[0]]
+
+        nib_image = NiftiReader.load(file_path)
+        return np.asanyarray(nib_image.dataobj)
+
+    def open_volume(self, scan_id: str, volume: str) -> dict:
+        """
+        Returns the cached volume entry, loading it once even under concurrent requests.
+
+        Returns:
+            dict: 'array', 'path', 'key', 'mapped' and the default PNG 'window'.
+        """
+        file_path, key = self.find_source(scan_id, volume)
+        entry = self.volumes.get(key)
+        if entry is not None:
+            return entry
+
+        with self.lock:
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+        with loading_lock:
+            entry = self.volumes.get(key)
+            if entry is None:
+                array = self.load_array(file_path)
+                if array.ndim < 3:
+                    raise ValueError(f"'{volume}' of scan {scan_id} has {array.ndim} dimensions, not a 3D volume")
+                if array.ndim > 3:
+                    # The first volume of a 4D (or higher) file is served, decoded files keep only that volume
+                    array = array[(slice(None),) * 3 + (0,) * (array.ndim - 3)]
+                    if not isinstance(array, np.memmap):
+                        array = array.copy()
+                sample = np.asarray(array[::WINDOW_STRIDE, ::WINDOW_STRIDE, ::WINDOW_STRIDE], dtype=np.float64)
+                low, high = np.percentile(sample, WINDOW_PERCENTILES) if sample.size else (0.0, 1.0)
+                mapped = isinstance(array, np.memmap)
+                entry = {'array': array, 'path': file_path, 'key': key, 'mapped': mapped,
+                         'window': (float(low), float(high))}
+                self.volumes.put(key, entry, 0 if mapped else array.nbytes)
+        with self.lock:
+            self.loading_locks.pop(key, None)
+        return entry
+
+    def describe(self, scan_id: str, volume: str) -> dict:
+        """Shape, dtype and source file of a volume."""
+        entry = self.open_volume(scan_id, volume)
+        return {
+            'scan_id': scan_id,
+            'volume': volume,
+            'shape': list(entry['array'].shape),
+            'dtype': str(entry['array'].dtype),
+            'source': os.path.basename(entry['path']),
+            'memory_mapped': entry['mapped'],
+            'window': list(entry['window']),
+        }
+
+    def read_slice(self, scan_id: str, volume: str, axis: str, index: int, slice_format: str = "png",
+                   window: tuple = None) -> bytes:
+        """
+        Reads one slice as a PNG or '.npy' file.
+
+        PNG slices are 8-bit grayscale, scaled from ``window`` (defaults to the volume's 1st-99th
+        percentile) and displayed with the second in-plane axis pointing up. '.npy' slices keep
+        the voxel values and the voxel axis order.
+
+        Raises:
+            LookupError: If the volume has no file.
+            ValueError: If the axis, index or format is invalid.
+        """
+        if axis not in AXES:
+            raise ValueError(f"'axis' must be one of {', '.join(AXES)}")
+        if slice_format not in SLICE_FORMATS:
+            raise ValueError(f"'format' must be one of {', '.join(SLICE_FORMATS)}")
+
+        entry = self.open_volume(scan_id, volume)
+        window = tuple(window) if window is not None else entry['window']
+        cache_key = (entry['key'], axis, index, slice_format, window if slice_format == "png" else None)
+        encoded = self.slices.get(cache_key)
+        if encoded is not None:
+            return encoded
+
+        array = entry['array']
+        size = array.shape[AXES[axis]]
+        if not 0 <= index < size:
+            raise ValueError(f"Index {index} outside the {axis} range 0-{size - 1}")
+        plane = np.asarray(np.take(array, index, axis=AXES[axis]))
+
+        if slice_format == "npy":
+            encoded = self.encode_npy(plane)
+        else:
+            encoded = OutputWriter.encode_png(np.flipud(self.apply_window(plane, window).T))
+        self.slices.put(cache_key, encoded, len(encoded))
+        return encoded
+
+    def read_block(self, scan_id: str, volume: str, bounds: list[tuple[int, int]]) -> bytes:
+        """
+        Reads a sub-block as a '.npy' file.
+
+        Args:
+            bounds (list[tuple[int, int]]): (start, stop) per axis, stop exclusive; None for the whole axis.
+
+        Raises:
+            LookupError: If the volume has no file.
+            ValueError: If a range is empty or outside the volume.
+        """
+        entry = self.open_volume(scan_id, volume)
+        array = entry['array']
+        region = []
+        for axis_bounds, size in zip(bounds, array.shape):
+            start, stop = axis_bounds if axis_bounds is not None else (0, size)
+            if not 0 <= start < stop <= size:
+                raise ValueError(f"Range {start}:{stop} outside 0:{size}")
+            region.append(slice(start, stop))
+        return self.encode_npy(np.asarray(array[tuple(region)]))
+
+    def stats(self) -> dict:
+        return {'volumes': self.volumes.stats(), 'slices': self.slices.stats()}
+
+    @staticmethod
+    def apply_window(plane: np.ndarray, window: tuple) -> np.ndarray:
+        """Scale a plane linearly from window (low, high) to uint8."""
+        low, high = window
+        scale = 255.0 / (high - low) if high > low else 0.0
+        scaled = (plane.astype(np.float32) - low) * scale
+        return np.clip(scaled, 0, 255).astype(np.uint8)
+
+    @staticmethod
+    def encode_npy(array: np.ndarray) -> bytes:
+        """Encode an array as a '.npy' file."""
+        buffer = io.BytesIO()
+        np.lib.format.write_array(buffer, np.ascontiguousarray(array))
+        return buffer.getvalue()
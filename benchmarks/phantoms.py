@@ -0,0 +1,241 @@
+"""
+Synthetic head phantoms for the benchmark suite.
+
+The phantom is defined in world (RAS, millimetre) coordinates, so the same anatomy can be
+sampled on any grid: the benchmark writes it at several sizes and voxel spacings, and the
+FreeSurfer stand-ins in ``freesurfer_stub/bin`` evaluate it on whatever grid they receive.
+"""
+import os
+
+import numpy as np
+
+# SynthSeg labels used by the phantom (cortex / white matter per hemisphere)
+LEFT_CEREBRAL_WHITE_MATTER = 2
+LEFT_CEREBRAL_CORTEX = 3
+LEFT_CEREBELLUM_WHITE_MATTER = 7
+LEFT_CEREBELLUM_CORTEX = 8
+BRAIN_STEM = 16
+RIGHT_CEREBRAL_WHITE_MATTER = 41
+RIGHT_CEREBRAL_CORTEX = 42
+RIGHT_CEREBELLUM_WHITE_MATTER = 46
+RIGHT_CEREBELLUM_CORTEX = 47
+
+# Ellipsoids as (center, semi-axes) in millimetres
+BRAIN = (np.array([0.0, 0.0, 10.0]), np.array([62.0, 80.0, 60.0]))
+HEAD = (np.array([0.0, 0.0, 5.0]), np.array([76.0, 96.0, 80.0]))
+SKULL_INNER_SCALE = 1.08
+SKULL_OUTER_SCALE = 0.94
+CORTEX_RADIUS = 0.85
+
+# NIfTI world coordinates are RAS, DICOM patient coordinates are LPS
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+INTENSITIES = {
+    LEFT_CEREBRAL_WHITE_MATTER: 110.0, RIGHT_CEREBRAL_WHITE_MATTER: 110.0,
+    LEFT_CEREBRAL_CORTEX: 75.0, RIGHT_CEREBRAL_CORTEX: 75.0,
+    LEFT_CEREBELLUM_WHITE_MATTER: 100.0, RIGHT_CEREBELLUM_WHITE_MATTER: 100.0,
+    LEFT_CEREBELLUM_CORTEX: 70.0, RIGHT_CEREBELLUM_CORTEX: 70.0,
+    BRAIN_STEM: 95.0,
+}
+CSF_INTENSITY = 30.0
+SKULL_INTENSITY = 15.0
+SCALP_INTENSITY = 60.0
+
+# Reference vectors matching the canonical orientation of the phantom
+REFERENCE_VECTORS = {
+    "VECTOR_ALPHA": np.array([1.0, 0.0, 0.0]),
+    "VECTOR_BETA": np.array([0.0, 1.0, 0.0]),
+    "VECTOR_GAMMA": np.array([0.0, 0.0, 1.0]),
+}
+
+
+def make_affine(shape: tuple, spacing: tuple) -> np.ndarray:
+    """Diagonal RAS affine placing the world origin at the center of the grid."""
+    spacing = np.asarray(spacing, dtype=np.float64)
+    affine = np.diag(list(spacing) + [1.0])
+    affine[:3, 3] = -spacing * (np.asarray(shape) - 1) / 2
+    return affine
+
+
+def _radius(points: np.ndarray, ellipsoid: tuple) -> np.ndarray:
+    """Normalised ellipsoidal radius of world points (..., 3)."""
+    center, axes = ellipsoid
+    return np.sqrt(np.sum(((points - center) / axes) ** 2, axis=-1))
+
+
+def _label_points(points: np.ndarray) -> np.ndarray:
+    """SynthSeg-style labels of world points (..., 3)."""
+    x, y, z = points[..., 0], points[..., 1], points[..., 2]
+    brain_radius = _radius(points, BRAIN)
+    inside = brain_radius < 1
+    left = x < 0
+    cortex = brain_radius > CORTEX_RADIUS
+
+    labels = np.zeros(points.shape[:-1], dtype=np.uint8)
+    labels[inside & left] = np.where(cortex, LEFT_CEREBRAL_CORTEX, LEFT_CEREBRAL_WHITE_MATTER)[inside & left]
+    labels[inside & ~left] = np.where(cortex, RIGHT_CEREBRAL_CORTEX, RIGHT_CEREBRAL_WHITE_MATTER)[inside & ~left]
+
+    # Cerebellum in the posterior, inferior part of the brain
+    cerebellum_radius = _radius(points, (np.array([0.0, -52.0, -25.0]), np.array([48.0, 26.0, 22.0])))
+    cerebellum = inside & (cerebellum_radius < 1)
+    cerebellum_cortex = cerebellum_radius > 0.7
+    labels[cerebellum & left] = np.where(cerebellum_cortex, LEFT_CEREBELLUM_CORTEX, LEFT_CEREBELLUM_WHITE_MATTER)[cerebellum & left]
+    labels[cerebellum & ~left] = np.where(cerebellum_cortex, RIGHT_CEREBELLUM_CORTEX, RIGHT_CEREBELLUM_WHITE_MATTER)[cerebellum & ~left]
+
+    # Brain stem as a vertical elliptic cylinder below the cerebrum
+    stem = ((x / 11.0) ** 2 + ((y + 16.0) / 13.0) ** 2 < 1) & (z < -5.0) & (z > -62.0)
+    labels[stem] = BRAIN_STEM
+    return labels
+
+
+def _grid_points(affine: np.ndarray, shape: tuple, index: int) -> np.ndarray:
+    """World coordinates of the voxels of one slice along the first axis."""
+    j, k = np.meshgrid(np.arange(shape[1]), np.arange(shape[2]), indexing="ij")
+    voxels = np.stack([np.full(j.shape, index), j, k, np.ones(j.shape)], axis=-1).astype(np.float64)
+    return voxels.dot(affine.T)[..., :3]
+
+
+def label_volume(affine: np.ndarray, shape: tuple) -> np.ndarray:
+    """Evaluate the phantom labels on a grid, one slice at a time."""
+    labels = np.zeros(shape, dtype=np.uint8)
+    for index in range(shape[0]):
+        labels[index] = _label_points(_grid_points(affine, shape, index))
+    return labels
+
+
+def head_volume(affine: np.ndarray, shape: tuple, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Evaluate the phantom intensities and labels on a grid.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: float32 intensities (with skull, scalp, bias field
+        and noise) and uint8 SynthSeg labels.
+    """
+    rng = np.random.default_rng(seed)
+    lookup = np.zeros(256, dtype=np.float32)
+    for label, value in INTENSITIES.items():
+        lookup[label] = value
+
+    intensity = np.zeros(shape, dtype=np.float32)
+    labels = np.zeros(shape, dtype=np.uint8)
+    for index in range(shape[0]):
+        points = _grid_points(affine, shape, index)
+        slice_labels = _label_points(points)
+        head_radius = _radius(points, HEAD)
+        brain_radius = _radius(points, BRAIN)
+
+        values = lookup[slice_labels]
+        background = slice_labels == 0
+        values[background & (brain_radius < SKULL_INNER_SCALE)] = CSF_INTENSITY
+        values[background & (brain_radius >= SKULL_INNER_SCALE) & (head_radius < SKULL_OUTER_SCALE)] = SKULL_INTENSITY
+        values[background & (head_radius >= SKULL_OUTER_SCALE) & (head_radius < 1)] = SCALP_INTENSITY
+
+        # Smooth multiplicative bias field plus noise inside the head
+        bias = 1 + 0.1 * np.sin(points[..., 0] / 40.0) * np.cos(points[..., 1] / 50.0)
+        noise = rng.normal(0, 2.0, size=values.shape).astype(np.float32)
+        intensity[index] = np.where(head_radius < 1, values * bias + noise, 0)
+        labels[index] = slice_labels
+
+    return np.clip(intensity, 0, None), labels
+
+
+def write_nifti(file_path: str, shape: tuple, spacing: tuple, dtype=np.int16) -> np.ndarray:
+    """Write the phantom as a scanner-like NIfTI file and return its affine."""
+    import nibabel as nib
+
+    affine = make_affine(shape, spacing)
+    intensity, _ = head_volume(affine, shape)
+    nifti_img = nib.Nifti1Image(np.round(intensity).astype(dtype), affine)
+    nifti_img.set_sform(affine, code=1)
+    nifti_img.set_qform(affine, code=1)
+    nib.save(nifti_img, file_path)
+    return affine
+
+
+def write_dicom_series(output_dir: str, shape: tuple, spacing: tuple) -> int:
+    """
+    Write the phantom as an axial MR DICOM series, one file per slice.
+
+    Returns:
+        int: Number of files written.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+    os.makedirs(output_dir, exist_ok=True)
+    affine = make_affine(shape, spacing)
+    intensity, _ = head_volume(affine, shape)
+    pixels = np.round(intensity).astype(np.int16)
+
+    # Row and column directions of the pixel data (voxel axes 0 and 1) in DICOM patient coordinates
+    orientation = [float(x) + 0.0 for x in RAS_TO_LPS.dot(affine[:3, :2] / np.linalg.norm(affine[:3, :2], axis=0)).T.ravel()]
+
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    for k in range(shape[2]):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_uid
+        ds.Modality = "MR"
+        ds.PatientName = "Phantom^Benchmark"
+        ds.PatientID = "PHANTOM"
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = k + 1
+        ds.ImageOrientationPatient = orientation
+        ds.ImagePositionPatient = [float(x) + 0.0 for x in RAS_TO_LPS.dot(affine.dot([0, 0, k, 1])[:3])]
+        ds.PixelSpacing = [float(spacing[1]), float(spacing[0])]
+        ds.SliceThickness = float(spacing[2])
+        ds.Rows, ds.Columns = shape[1], shape[0]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleIntercept = 0
+        ds.RescaleSlope = 1
+        ds.PixelData = np.ascontiguousarray(pixels[:, :, k].T).tobytes()
+        ds.save_as(os.path.join(output_dir, f"slice_{k:04d}.dcm"), enforce_file_format=True)
+
+    return shape[2]
+
+
+
+def write_archive(archive_path: str, source_dir: str) -> int:
+    """
+    Pack a DICOM series directory as an upload would arrive: a zip or (compressed) tar archive
+    with the series in a subdirectory and a non-DICOM member next to it.
+
+    Returns:
+        int: Number of members written.
+    """
+    import io
+    import tarfile
+    import zipfile
+
+    folder = os.path.basename(source_dir.rstrip(os.sep))
+    members = [(os.path.join(source_dir, x), f"{folder}/{x}") for x in sorted(os.listdir(source_dir))]
+    notes = b"Synthetic phantom study, not a DICOM file.\n"
+
+    if archive_path.endswith(".zip"):
+        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zip_ref:
+            for file_path, name in members:
+                zip_ref.write(file_path, name)
+            zip_ref.writestr("README.txt", notes)
+    else:
+        with tarfile.open(archive_path, "w:gz" if archive_path.endswith("gz") else "w") as tar_ref:
+            for file_path, name in members:
+                tar_ref.add(file_path, name)
+            info = tarfile.TarInfo("README.txt")
+            info.size = len(notes)
+            tar_ref.addfile(info, io.BytesIO(notes))
+
+    return len(members) + 1
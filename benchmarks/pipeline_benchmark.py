@@ -0,0 +1,399 @@
+#!/usr/bin/python3
+"""
+Benchmark suite for NIfTI/DICOM ingest and the preprocessing pipeline on synthetic phantoms.
+
+Every case writes a head phantom at its own size and voxel spacing, then times each stage
+and tracks its peak RSS. FreeSurfer is replaced by the stand-ins in ``freesurfer_stub``,
+so no FreeSurfer installation is needed. Each target runs in its own process so that peak
+memory is measured independently:
+
+    python benchmarks/pipeline_benchmark.py --output results.json
+    python benchmarks/pipeline_benchmark.py --cases small:128:1.5 aniso:192,192,56:1,1,3 --baseline results.json
+
+Results are JSON; with ``--baseline`` every stage is compared against a saved result and
+the exit status is 1 when one got slower or larger than the tolerance allows. The pipeline
+peak RSS of a case with a target (by default the 256³ 'full' case) must also stay below it:
+
+    python benchmarks/pipeline_benchmark.py --cases full:256:1 --peak-rss-target full:300
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+
+BENCHMARK_ROOT = os.path.abspath(os.path.dirname(__file__))
+REPOSITORY_ROOT = os.path.dirname(BENCHMARK_ROOT)
+FREESURFER_STUB = os.path.join(BENCHMARK_ROOT, "freesurfer_stub")
+
+sys.path.append(BENCHMARK_ROOT)
+
+# name:shape:spacing, a single value applies to all three axes
+DEFAULT_CASES = ("small:128:1.5", "standard:192:1.2", "aniso:192,192,56:1,1,3", "full:256:1")
+TARGETS = ("dicom_ingest", "dicom_archive_ingest", "nifti_ingest", "pipeline")
+
+# Relative slowdown or growth tolerated against the baseline, and absolute noise floors
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+MIN_MEGABYTES = 8.0
+
+MEGABYTE = 1 << 20
+
+# Pipeline peak RSS limit of a case in MB (without torch/MONAI, which the pipeline does not import)
+PEAK_RSS_TARGETS = {'full': 300.0}
+
+
+def parse_case(case: str) -> dict:
+    """Parse a 'name:shape:spacing' case description."""
+    try:
+        name, shape, spacing = case.split(":")
+        shape = [int(x) for x in shape.split(",")]
+        spacing = [float(x) for x in spacing.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid case '{case}', expected name:shape:spacing")
+    shape = shape * 3 if len(shape) == 1 else shape
+    spacing = spacing * 3 if len(spacing) == 1 else spacing
+    if len(shape) != 3 or len(spacing) != 3:
+        raise argparse.ArgumentTypeError(f"Invalid case '{case}', shape and spacing need 1 or 3 values")
+    return {'name': name, 'shape': shape, 'spacing': spacing}
+
+
+class RssSampler:
+    """Samples the process RSS in a background thread and tracks the peak of each open window."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.windows = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def current(self) -> int:
+        """Resident set size of this process in bytes."""
+        with open("/proc/self/statm") as statm_ref:
+            return int(statm_ref.read().split()[1]) * self.page_size
+
+    def _sample(self) -> None:
+        rss = self.current()
+        with self.lock:
+            for window in self.windows:
+                window['peak'] = max(window['peak'], rss)
+
+    def _run(self) -> None:
+        while self.running:
+            self._sample()
+            time.sleep(self.interval)
+
+    @contextlib.contextmanager
+    def measure(self, name: str, records: dict):
+        """Record wall time, peak RSS and peak child RSS of the enclosed block under ``name``."""
+        import resource
+
+        window = {'start': self.current()}
+        window['peak'] = window['start']
+        with self.lock:
+            self.windows.append(window)
+        start_time = time.perf_counter()
+        record = {}
+        try:
+            yield
+        except Exception as error_exc:
+            record['error'] = str(error_exc)
+            raise
+        finally:
+            self._sample()
+            with self.lock:
+                self.windows.remove(window)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record.update({
+                'seconds': round(time.perf_counter() - start_time, 3),
+                'peak_rss_mb': round(window['peak'] / MEGABYTE, 1),
+                'rss_delta_mb': round((window['peak'] - window['start']) / MEGABYTE, 1),
+                'children_peak_rss_mb': round(children.ru_maxrss / 1024, 1),
+            })
+            records[name] = record
+
+    def close(self) -> None:
+        self.running = False
+        self.thread.join()
+
+
+def instrument(owner, attribute: str, name: str, sampler: RssSampler, records: dict) -> None:
+    """Replace a callable attribute by a version that records its cost under ``name``."""
+    function = getattr(owner, attribute)
+
+    def measured(*args, **kwargs):
+        with sampler.measure(name, records):
+            return function(*args, **kwargs)
+
+    setattr(owner, attribute, measured)
+
+
+def run_nifti_ingest(params, scan_id: str, sampler: RssSampler, stages: dict) -> None:
+    """Run NIFTIIngestion._process_nifti with its read, resample and write steps measured."""
+    sys.path.append(os.path.join(REPOSITORY_ROOT, "ingest_system"))
+    from output_writer import OutputWriter
+    from utils import nifti_ingestion
+    from utils.nifti_ingestion import NIFTIIngestion
+
+    writer = OutputWriter()
+    instrument(nifti_ingestion.NiftiReader, "load", "load", sampler, stages)
+    instrument(writer, "write_numpy", "write_raw", sampler, stages)
+    instrument(nifti_ingestion.IsotropicResampler, "resample", "resample", sampler, stages)
+    instrument(writer, "write_nifti", "write_sampled", sampler, stages)
+
+    file_path = os.path.join(params.get_root_scan_dir(scan_id), "raw", "nifti", f"{scan_id}.nii.gz")
+    NIFTIIngestion._process_nifti(params, scan_id, file_path, writer)
+
+
+def run_dicom_ingest(params, scan_id: str, sampler: RssSampler, stages: dict, archive: bool = False) -> None:
+    """Run DICOMIngestion.ingest_and_convert on the series directory or its zip archive, with its steps measured."""
+    sys.path.append(os.path.join(REPOSITORY_ROOT, "ingest_system"))
+    from utils.dicom_ingestion import DICOMIngestion
+
+    instrument(DICOMIngestion, "stage_files", "stage", sampler, stages)
+    instrument(DICOMIngestion, "stage_archive", "stage", sampler, stages)
+    instrument(DICOMIngestion, "group_series", "group", sampler, stages)
+    instrument(DICOMIngestion, "fingerprint_series", "fingerprint", sampler, stages)
+    instrument(DICOMIngestion, "convert_series", "convert", sampler, stages)
+
+    source_root = os.path.join(params.becik4u_root, "source", f"{scan_id}.zip" if archive else scan_id)
+    DICOMIngestion.ingest_and_convert(params, scan_id, source_root)
+
+
+def run_pipeline(params, scan_id: str, sampler: RssSampler, stages: dict, cpus: int) -> None:
+    """Run preprocessing_pipeline with every DAG stage measured."""
+    sys.path.append(os.path.join(REPOSITORY_ROOT, "preprosesing_system"))
+    from phantoms import REFERENCE_VECTORS
+    from utils.stage_scheduler import PipelineStage
+    from utils.processing_wrapper import PreprocessingWrapper
+
+    class MeasuredWrapper(PreprocessingWrapper):
+        def build_stages(self, freesurfer_root: str) -> list[PipelineStage]:
+            measured_stages = []
+            for stage in super().build_stages(freesurfer_root):
+                def measured(context, stage_cpus, stage=stage):
+                    with sampler.measure(stage.name, stages):
+                        return stage.function(context, stage_cpus)
+                measured_stages.append(PipelineStage(
+                    stage.name, stage.description, measured,
+                    inputs=stage.inputs, outputs=stage.outputs,
+                    min_cpus=stage.min_cpus, max_cpus=stage.max_cpus,
+                    params=stage.params, restore=stage.restore, cacheable=stage.cacheable
+                ))
+            return measured_stages
+
+    wrapper = MeasuredWrapper(cpu_budget=cpus)
+    if not wrapper.preprocessing_pipeline(params, scan_id, REFERENCE_VECTORS):
+        failed = [name for name, record in stages.items() if 'error' in record]
+        raise Exception(f"Pipeline failed in stage {failed[0] if failed else 'setup'}")
+
+
+def run_target(target: str, scan_id: str, cpus: int) -> dict:
+    """Run one target in this process and return its measurements."""
+    sys.path.append(os.path.join(REPOSITORY_ROOT, "helpers"))
+    from loguru import logger
+    from parameters import Becik4UParameters
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    params = Becik4UParameters()
+    sampler = RssSampler()
+    stages, totals = {}, {}
+    result = {'status': 'ok'}
+    try:
+        with sampler.measure("total", totals):
+            if target == "nifti_ingest":
+                run_nifti_ingest(params, scan_id, sampler, stages)
+            elif target in ("dicom_ingest", "dicom_archive_ingest"):
+                run_dicom_ingest(params, scan_id, sampler, stages, archive=target == "dicom_archive_ingest")
+            else:
+                run_pipeline(params, scan_id, sampler, stages, cpus)
+    except Exception:
+        result['status'] = 'failed'
+    finally:
+        sampler.close()
+
+    result.update(totals['total'])
+    result['stages'] = stages
+    return result
+
+
+def prepare_case(case: dict, work_root: str) -> None:
+    """Write the NIfTI and DICOM phantoms of a case into a fresh BECIK4U_ROOT, the DICOM series also as a zip archive."""
+    from phantoms import write_nifti, write_dicom_series, write_archive
+
+    scan_id = case['name']
+    nifti_root = os.path.join(work_root, "media", "storage", scan_id, "raw", "nifti")
+    os.makedirs(nifti_root, exist_ok=True)
+    write_nifti(os.path.join(nifti_root, f"{scan_id}.nii.gz"), case['shape'], case['spacing'])
+
+    try:
+        dicom_root = os.path.join(work_root, "source", f"{scan_id}_dicom")
+        write_dicom_series(dicom_root, case['shape'], case['spacing'])
+        write_archive(os.path.join(work_root, "source", f"{scan_id}_archive.zip"), dicom_root)
+    except ImportError:
+        pass
+
+
+def run_case(case: dict, cpus: int, keep: bool) -> dict:
+    """Run every target of a case, each in its own process."""
+    work_root = tempfile.mkdtemp(prefix=f"becik4u-benchmark-{case['name']}-")
+    environment = dict(os.environ, FREESURFER_HOME=FREESURFER_STUB, BECIK4U_ROOT=work_root, BECIK4U_CORE=REPOSITORY_ROOT)
+
+    results = {'shape': case['shape'], 'spacing': case['spacing']}
+    try:
+        prepare_case(case, work_root)
+        for target in TARGETS:
+            scan_id = {'dicom_ingest': f"{case['name']}_dicom", 'dicom_archive_ingest': f"{case['name']}_archive"}.get(target, case['name'])
+            if target.startswith("dicom") and not os.path.isdir(os.path.join(work_root, "source", f"{case['name']}_dicom")):
+                results[target] = {'status': 'skipped', 'error': "pydicom is not installed"}
+                continue
+
+            completed = subprocess.run(
+                [sys.executable, __file__, "--target", target, "--scan-id", scan_id, "--cpus", str(cpus)],
+                env=environment, capture_output=True, text=True
+            )
+            lines = completed.stdout.strip().splitlines()
+            if completed.returncode != 0 or not lines:
+                error_lines = completed.stderr.strip().splitlines() or ["no output"]
+                results[target] = {'status': 'failed', 'error': error_lines[-1]}
+            else:
+                results[target] = json.loads(lines[-1])
+            print(f"{case['name']:>12} {target:<20} {results[target]['status']:<8} {results[target].get('seconds', '-')} s", file=sys.stderr)
+    finally:
+        if keep:
+            print(f"Kept benchmark data in {work_root}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    return results
+
+
+def parse_target(target: str) -> tuple[str, float]:
+    """Parse a 'name:megabytes' peak RSS target."""
+    try:
+        name, limit = target.split(":")
+        return name, float(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid target '{target}', expected name:megabytes")
+
+
+def check_targets(results: dict, targets: dict[str, float]) -> list[dict]:
+    """
+    Check the pipeline peak RSS of every benchmarked case that has a target.
+
+    A targeted case whose pipeline failed or did not report a peak fails its check, so a
+    crashing run cannot pass the gate.
+
+    Returns:
+        list[dict]: One entry per checked case, with 'exceeded' set when the peak is above the
+            limit or the pipeline did not complete ('status' then holds its status).
+    """
+    checks = []
+    for case, limit in targets.items():
+        if case not in results['cases']:
+            continue
+        pipeline = results['cases'][case].get('pipeline')
+        status = pipeline.get('status', 'missing') if isinstance(pipeline, dict) else 'missing'
+        peak = pipeline.get('peak_rss_mb') if isinstance(pipeline, dict) else None
+        checks.append({'case': case, 'target': 'pipeline', 'status': status, 'peak_rss_mb': peak, 'limit_mb': limit,
+                       'exceeded': status != 'ok' or peak is None or peak > limit})
+    return checks
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list[dict]:
+    """
+    Compare two benchmark results stage by stage.
+
+    Returns:
+        list[dict]: One entry per metric outside the tolerance, with 'regression' set when it got worse.
+    """
+    metrics = (('seconds', MIN_SECONDS), ('peak_rss_mb', MIN_MEGABYTES))
+    changes = []
+    for case, targets in results['cases'].items():
+        for target, result in targets.items():
+            base = baseline.get('cases', {}).get(case, {}).get(target)
+            if not isinstance(result, dict) or not isinstance(base, dict):
+                continue
+            if base.get('status') == 'ok' and result.get('status') != 'ok':
+                changes.append({'case': case, 'target': target, 'stage': None, 'metric': 'status',
+                                'baseline': base['status'], 'value': result.get('status'), 'regression': True})
+                continue
+
+            entries = [(None, result, base)] + [
+                (stage, record, base.get('stages', {}).get(stage)) for stage, record in result.get('stages', {}).items()
+            ]
+            for stage, record, base_record in entries:
+                if base_record is None:
+                    continue
+                for metric, floor in metrics:
+                    value, reference = record.get(metric), base_record.get(metric)
+                    if value is None or reference is None or abs(value - reference) <= max(floor, tolerance * reference):
+                        continue
+                    changes.append({'case': case, 'target': target, 'stage': stage, 'metric': metric,
+                                    'baseline': reference, 'value': value, 'regression': value > reference})
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Becik4U ingest and preprocessing benchmark suite")
+    parser.add_argument('--cases', nargs='+', type=parse_case, default=[parse_case(x) for x in DEFAULT_CASES],
+                        help="Phantom cases as name:shape:spacing (e.g. small:128:1.5 or aniso:192,192,56:1,1,3).")
+    parser.add_argument('--cpus', type=int, default=1, help='CPU budget of the preprocessing pipeline.')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file.')
+    parser.add_argument('--baseline', default=None, help='Compare against a previously saved JSON result.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Relative change tolerated against the baseline.')
+    parser.add_argument('--peak-rss-target', nargs='+', type=parse_target, default=[],
+                        help=f"Pipeline peak RSS limits as name:megabytes (default: {' '.join(f'{x}:{y:g}' for x, y in PEAK_RSS_TARGETS.items())}).")
+    parser.add_argument('--keep', action='store_true', help='Keep the generated scan directories.')
+    parser.add_argument('--target', choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument('--scan-id', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.target is not None:
+        print(json.dumps(run_target(args.target, args.scan_id, args.cpus)))
+        return
+
+    results = {
+        'platform': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        },
+        'cpus': args.cpus,
+        'cases': {case['name']: run_case(case, args.cpus, args.keep) for case in args.cases},
+    }
+
+    exit_code = 0
+    results['peak_rss_targets'] = check_targets(results, {**PEAK_RSS_TARGETS, **dict(args.peak_rss_target)})
+    if any(x['exceeded'] for x in results['peak_rss_targets']):
+        exit_code = 1
+
+    if args.baseline is not None:
+        with open(args.baseline) as jsn_ref:
+            baseline = json.load(jsn_ref)
+        results['comparison'] = compare(results, baseline, args.tolerance)
+        if any(x['regression'] for x in results['comparison']):
+            exit_code = 1
+
+    # Saved with the target checks and the comparison the exit status depends on
+    if args.output is not None:
+        with open(args.output, "w") as jsn_ref:
+            json.dump(results, jsn_ref, indent=2)
+
+    print(json.dumps(results, indent=2))
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
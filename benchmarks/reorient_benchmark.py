@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+"""
+Benchmark of the fused reorient kernel against the shift / convert_size / rotate_array path.
+
+Each variant runs in its own process so that peak RSS is measured independently:
+
+    python benchmarks/reorient_benchmark.py --size 378 --threads 4
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'preprosesing_system')))
+
+# Maximum absolute difference allowed between both paths, relative to the peak intensity
+TOLERANCE = 1e-4
+
+CENTER_OFFSET = np.array([-6.0, 4.0, 3.0])
+ROTATION_RADIANS = np.array([0.1, -0.2, 0.15])
+
+
+def make_volume(size: int) -> np.ndarray:
+    """Smooth ellipsoidal phantom centered like a padded, cropped brain."""
+    import scipy.ndimage as scimg
+
+    rng = np.random.default_rng(0)
+    x, y, z = np.ogrid[:size, :size, :size]
+    center = size / 2
+    radius = size / 4.5
+    inside = ((x - center) / radius) ** 2 + ((y - center) / (radius * 1.2)) ** 2 + ((z - center) / (radius * 0.9)) ** 2 < 1
+    volume = inside * (rng.random((size, size, size), dtype=np.float32) * 100 + 50)
+    return scimg.gaussian_filter(volume.astype(np.float32), 1.0)
+
+
+def run_variant(variant: str, size: int, threads: int, output_file: str) -> None:
+    """Run one variant and write its result and timing."""
+    import torch
+    import scipy.ndimage as scimg
+    from utils.processing_base import PreprocessingBase
+
+    torch.set_num_threads(threads)
+    volume = make_volume(size)
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start_time = time.perf_counter()
+    if variant == "legacy":
+        moved_array = scimg.shift(volume, shift=CENTER_OFFSET, cval=0).astype(np.float32)
+        resized_array = PreprocessingBase.convert_size(moved_array)
+        result = PreprocessingBase.rotate_array(resized_array, ROTATION_RADIANS)
+    else:
+        result = PreprocessingBase.reorient_array(volume, CENTER_OFFSET, ROTATION_RADIANS, threads=threads)
+    elapsed = time.perf_counter() - start_time
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    np.save(output_file, np.asarray(result, dtype=np.float32))
+    print(json.dumps({
+        'variant': variant,
+        'seconds': round(elapsed, 3),
+        'peak_rss_mb': round(peak_rss / 1024, 1),
+        'stage_rss_mb': round((peak_rss - baseline_rss) / 1024, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fused reorient kernel benchmark")
+    parser.add_argument('--size', type=int, default=378, help='Edge length of the padded input volume.')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--variant', choices=("legacy", "fused"), help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant is not None:
+        run_variant(args.variant, args.size, args.threads, args.output)
+        return
+
+    results = {}
+    arrays = {}
+    for variant in ("legacy", "fused"):
+        output_file = f"/tmp/reorient_benchmark_{variant}_{os.getpid()}.npy"
+        completed = subprocess.run(
+            [sys.executable, __file__, "--size", str(args.size), "--threads", str(args.threads),
+             "--variant", variant, "--output", output_file],
+            check=True, capture_output=True, text=True
+        )
+        results[variant] = json.loads(completed.stdout.strip().splitlines()[-1])
+        arrays[variant] = np.load(output_file)
+        os.remove(output_file)
+
+    max_error = float(np.max(np.abs(arrays["legacy"] - arrays["fused"])))
+    relative_error = max_error / max(float(np.max(np.abs(arrays["legacy"]))), 1e-12)
+
+    report = {
+        'size': args.size,
+        'threads': args.threads,
+        'legacy': results["legacy"],
+        'fused': results["fused"],
+        'speedup': round(results["legacy"]['seconds'] / max(results["fused"]['seconds'], 1e-9), 2),
+        'stage_rss_saved_mb': round(results["legacy"]['stage_rss_mb'] - results["fused"]['stage_rss_mb'], 1),
+        'max_abs_error': max_error,
+        'max_relative_error': relative_error,
+        'within_tolerance': relative_error <= TOLERANCE,
+    }
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['within_tolerance'] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""
+Startup benchmark for the ingest and preprocessing command-line entry points.
+
+Every command is started in a fresh interpreter: once under ``-X importtime`` for the
+per-module import breakdown, then ``--repeat`` times for its wall time. Cheap commands
+(help, argument errors, the directory report) must not pull in the heavy dependencies,
+and must start within ``--max-seconds``:
+
+    python benchmarks/startup_benchmark.py --output startup.json
+    python benchmarks/startup_benchmark.py --baseline startup.json --max-seconds 1.0
+
+Results are JSON; the exit status is 1 when a command is slower than the threshold,
+imports a heavy dependency it does not need, or regressed against the baseline.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+INGEST_MAIN = os.path.join(REPOSITORY_ROOT, "ingest_system", "main.py")
+PREPROCESSING_MAIN = os.path.join(REPOSITORY_ROOT, "preprosesing_system", "main.py")
+API_MAIN = os.path.join(REPOSITORY_ROOT, "api_system", "main.py")
+FREESURFER_STUB = os.path.join(REPOSITORY_ROOT, "benchmarks", "freesurfer_stub")
+
+# Packages that must only be imported at the point of use
+HEAVY_MODULES = ("torch", "monai", "scipy", "nibabel", "nilearn", "dicom2nifti", "pydicom")
+
+# Command name -> (arguments, expected exit status, heavy modules it may import); nibabel
+# probes scipy and pydicom as optional dependencies when it is imported
+COMMANDS = {
+    'ingest_help': ([INGEST_MAIN, "--help"], 0, ()),
+    'ingest_dicom_help': ([INGEST_MAIN, "dicom", "--help"], 0, ()),
+    'ingest_nifti_help': ([INGEST_MAIN, "nifti", "--help"], 0, ()),
+    'ingest_argument_error': ([INGEST_MAIN, "nifti"], 2, ()),
+    'ingest_report': ([INGEST_MAIN, "report", "--id", "startup"], 0, ("nibabel", "scipy", "pydicom")),
+    'preprocess_help': ([PREPROCESSING_MAIN, "--help"], 0, ()),
+    'preprocess_argument_error': ([PREPROCESSING_MAIN], 2, ()),
+    'api_help': ([API_MAIN, "--help"], 0, ()),
+}
+
+MAX_SECONDS = 1.0
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+TOP_MODULES = 10
+
+
+def parse_importtime(stderr: str) -> dict:
+    """
+    Summarise ``-X importtime`` output.
+
+    Returns:
+        dict: Total import seconds, the slowest top-level imports (cumulative seconds) and
+        the heavy packages that were imported.
+    """
+    total_us = 0
+    top_level = []
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        total_us += int(self_us)
+        packages.add(name.strip().split(".")[0])
+        if not name[1:].startswith(" "):
+            top_level.append((name.strip(), int(cumulative_us)))
+
+    top_level.sort(key=lambda x: x[1], reverse=True)
+    return {
+        'import_seconds': round(total_us / 1e6, 4),
+        'slowest_imports': {name: round(us / 1e6, 4) for name, us in top_level[:TOP_MODULES]},
+        'heavy_imports': sorted(x for x in HEAVY_MODULES if x in packages),
+    }
+
+
+def prepare_root(work_root: str) -> None:
+    """Create the scan directory read by the report command, with one small NIfTI file."""
+    import numpy as np
+    import nibabel as nib
+
+    nifti_root = os.path.join(work_root, "media", "storage", "startup", "raw", "nifti")
+    os.makedirs(nifti_root, exist_ok=True)
+    nib.save(nib.Nifti1Image(np.zeros((8, 8, 8), dtype=np.int16), np.eye(4)), os.path.join(nifti_root, "startup.nii.gz"))
+
+
+def run_command(name: str, environment: dict, repeat: int, max_seconds: float) -> dict:
+    """Start one command under -X importtime, then time it repeat times."""
+    arguments, expected_status, allowed = COMMANDS[name]
+    completed = subprocess.run([sys.executable, "-X", "importtime"] + arguments, env=environment, capture_output=True, text=True)
+    result = {'status': 'ok', **parse_importtime(completed.stderr)}
+    if completed.returncode != expected_status:
+        error_lines = [x for x in completed.stderr.splitlines() if not x.startswith("import time:")] or ["no output"]
+        result.update({'status': 'failed', 'error': error_lines[-1]})
+
+    wall_times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, env=environment, capture_output=True)
+        wall_times.append(time.perf_counter() - start_time)
+    result['seconds'] = round(min(wall_times), 4)
+    result['median_seconds'] = round(statistics.median(wall_times), 4)
+
+    problems = []
+    unexpected = [x for x in result['heavy_imports'] if x not in allowed]
+    if unexpected:
+        problems.append(f"imports {', '.join(unexpected)}")
+    if result['seconds'] > max_seconds:
+        problems.append(f"{result['seconds']} s exceeds {max_seconds} s")
+    if problems:
+        result['problems'] = problems
+
+    print(f"{name:>26} {result['status']:<7} {result['seconds']:.3f} s  imports {result['import_seconds']:.3f} s"
+          f"{'  ' + '; '.join(problems) if problems else ''}", file=sys.stderr)
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list[dict]:
+    """
+    Compare startup times command by command.
+
+    Returns:
+        list[dict]: One entry per metric outside the tolerance, with 'regression' set when it got slower.
+    """
+    changes = []
+    for name, result in results['commands'].items():
+        base = baseline.get('commands', {}).get(name)
+        if base is None:
+            continue
+        for metric in ('seconds', 'import_seconds'):
+            value, reference = result.get(metric), base.get(metric)
+            if value is None or reference is None or abs(value - reference) <= max(MIN_SECONDS, tolerance * reference):
+                continue
+            changes.append({'command': name, 'metric': metric, 'baseline': reference, 'value': value,
+                            'regression': value > reference})
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Becik4U command-line startup benchmark")
+    parser.add_argument('--commands', nargs='+', choices=COMMANDS, default=list(COMMANDS), help='Commands to measure.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed starts per command (the fastest one is reported).')
+    parser.add_argument('--max-seconds', type=float, default=MAX_SECONDS, help='Maximum wall time of a command start.')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file.')
+    parser.add_argument('--baseline', default=None, help='Compare against a previously saved JSON result.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Relative change tolerated against the baseline.')
+    args = parser.parse_args()
+
+    work_root = tempfile.mkdtemp(prefix="becik4u-startup-")
+    environment = dict(os.environ, FREESURFER_HOME=FREESURFER_STUB, BECIK4U_ROOT=work_root, BECIK4U_CORE=REPOSITORY_ROOT)
+    try:
+        prepare_root(work_root)
+        results = {
+            'platform': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+            },
+            'max_seconds': args.max_seconds,
+            'commands': {name: run_command(name, environment, args.repeat, args.max_seconds) for name in args.commands},
+        }
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as jsn_ref:
+            json.dump(results, jsn_ref, indent=2)
+
+    failed = any(x['status'] != 'ok' or 'problems' in x for x in results['commands'].values())
+    if args.baseline is not None:
+        with open(args.baseline) as jsn_ref:
+            baseline = json.load(jsn_ref)
+        results['comparison'] = compare(results, baseline, args.tolerance)
+        failed = failed or any(x['regression'] for x in results['comparison'])
+
+    print(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import io
+import os
+import zlib
+import bisect
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import nibabel as nib
+
+# Gzip extra subfields giving the size of their member: written by GzipBlockStream ('B4',
+# 4 bytes) and by bgzip/htslib ('BC', BGZF block size minus one, 2 bytes)
+BLOCK_SUBFIELDS = {b"B4": ("<I", 0), b"BC": ("<H", 1)}
+
+# Uncompressed bytes between two in-memory checkpoints of a gzip stream without member sizes
+CHECKPOINT_SPAN = 4 << 20
+
+# Compressed bytes read at a time from a gzip stream without member sizes
+READ_CHUNK = 256 << 10
+
+# Decompressed members kept per open file, for consecutive small reads
+MEMBER_CACHE = 4
+
+# Indexes of files kept by the process, keyed by (path, size, mtime)
+INDEX_CACHE_ENTRIES = 64
+
+
+def _fast_inflate():
+    """The fastest installed zlib-compatible module: python-isal, zlib-ng or zlib."""
+    try:
+        from isal import isal_zlib
+        return isal_zlib
+    except ImportError:
+        pass
+    try:
+        from zlib_ng import zlib_ng
+        return zlib_ng
+    except ImportError:
+        return zlib
+
+
+class GzipIndex:
+    """
+    Seek points of a gzip file: the members of a block-gzip file, read from their headers,
+    or in-memory decompressor checkpoints of any other gzip stream.
+
+    Block-gzip members record their compressed size in an extra subfield, so the member table
+    is built by hopping from header to header without inflating anything. Other streams are
+    indexed as they are read: every CHECKPOINT_SPAN uncompressed bytes a copy of the zlib state
+    is kept, so a later read resumes from the closest checkpoint instead of the start.
+    """
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.members = self._read_members(file_path)
+        self.member_starts = [x[2] for x in self.members] if self.members is not None else None
+
+        # (uncompressed offset, compressed offset, decompressor) of the streamed file
+        self.checkpoints = [(0, 0, None)]
+        self.size = sum(x[3] for x in self.members) if self.members is not None else None
+
+    @classmethod
+    def get(cls, file_path: str) -> "GzipIndex":
+        """Returns the cached index of a file, building it when the file is new or changed."""
+        file_stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+        with cls._cache_lock:
+            index = cls._cache.get(key)
+            if index is not None:
+                cls._cache.move_to_end(key)
+                return index
+
+        index = cls(file_path)
+        with cls._cache_lock:
+            cls._cache[key] = index
+            while len(cls._cache) > INDEX_CACHE_ENTRIES:
+                cls._cache.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _member_size(header: bytes) -> int:
+        """Total size of a member from its header's size subfield, or None."""
+        extra_length = struct.unpack_from("<H", header, 10)[0]
+        extra = header[12:12 + extra_length]
+        position = 0
+        while position + 4 <= len(extra):
+            subfield_id, length = extra[position:position + 2], struct.unpack_from("<H", extra, position + 2)[0]
+            if subfield_id in BLOCK_SUBFIELDS:
+                size_format, adjust = BLOCK_SUBFIELDS[subfield_id]
+                if length == struct.calcsize(size_format):
+                    return struct.unpack_from(size_format, extra, position + 4)[0] + adjust
+            position += 4 + length
+        return None
+
+    @staticmethod
+    def _read_members(file_path: str) -> list[tuple]:
+        """
+        Reads the member table of a block-gzip file.
+
+        Returns:
+            list[tuple]: (compressed offset, compressed size, uncompressed offset, uncompressed
+                size) per member, or None when a member does not record its size.
+        """
+        members = []
+        file_size = os.path.getsize(file_path)
+        offset, uncompressed_offset = 0, 0
+        with open(file_path, "rb") as file_ref:
+            while offset < file_size:
+                file_ref.seek(offset)
+                header = file_ref.read(12)
+                if len(header) < 12 or header[:3] != b"\x1f\x8b\x08" or not header[3] & 0x04:
+                    return None
+                header += file_ref.read(struct.unpack_from("<H", header, 10)[0])
+                member_size = GzipIndex._member_size(header)
+                if member_size is None or offset + member_size > file_size:
+                    return None
+
+                file_ref.seek(offset + member_size - 4)
+                uncompressed_size = struct.unpack("<I", file_ref.read(4))[0]
+                members.append((offset, member_size, uncompressed_offset, uncompressed_size))
+                offset += member_size
+                uncompressed_offset += uncompressed_size
+        return members
+
+    def overlapping(self, start: int, stop: int) -> range:
+        """Indices of the members overlapping the uncompressed range [start, stop)."""
+        first = max(bisect.bisect_right(self.member_starts, start) - 1, 0)
+        last = bisect.bisect_left(self.member_starts, stop)
+        return range(first, last)
+
+    def stream(self, file_descriptor: int, start: int, stop: int, output: memoryview) -> int:
+        """
+        Decompresses [start, stop) of a stream without member sizes into ``output``, resuming
+        from the closest checkpoint and adding checkpoints on the way.
+
+        Returns:
+            int: Bytes written, less than requested at the end of the stream.
+        """
+        with self.lock:
+            position = bisect.bisect_right([x[0] for x in self.checkpoints], start) - 1
+            uncompressed_offset, compressed_offset, decompressor = self.checkpoints[position]
+        decompressor = decompressor.copy() if decompressor is not None else zlib.decompressobj(31)
+
+        written = 0
+        while uncompressed_offset < stop:
+            chunk = os.pread(file_descriptor, READ_CHUNK, compressed_offset)
+            if not chunk:
+                with self.lock:
+                    self.size = uncompressed_offset
+                break
+            compressed_offset += len(chunk)
+
+            data = decompressor.decompress(chunk)
+            # A concatenated gzip stream starts a new member after the end of the previous one
+            while decompressor.eof and decompressor.unused_data.strip(b"\x00"):
+                rest = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                data += decompressor.decompress(rest)
+
+            if uncompressed_offset + len(data) > start:
+                begin = max(start - uncompressed_offset, 0)
+                end = min(stop - uncompressed_offset, len(data))
+                output[written:written + end - begin] = data[begin:end]
+                written += end - begin
+            uncompressed_offset += len(data)
+
+            with self.lock:
+                if uncompressed_offset >= self.checkpoints[-1][0] + CHECKPOINT_SPAN and not decompressor.eof:
+                    self.checkpoints.append((uncompressed_offset, compressed_offset, decompressor.copy()))
+        return written
+
+
+class IndexedGzipFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a gzip file that only decompresses what is read.
+
+    Block-gzip members overlapping a read are inflated in parallel threads (with python-isal
+    or zlib-ng when installed) and the last MEMBER_CACHE members are kept for the next reads.
+    Other gzip streams are decompressed from their closest checkpoint (see GzipIndex).
+    """
+
+    def __init__(self, file_path: str, threads: int = None):
+        self.file_path = file_path
+        self.name = file_path
+        self.index = GzipIndex.get(file_path)
+        self.file_ref = open(file_path, "rb")
+        self.position = 0
+        self.threads = threads or os.cpu_count() or 1
+        self.inflate = _fast_inflate()
+        self.member_cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            if self.index.size is None:
+                self.index.stream(self.file_ref.fileno(), 1 << 62, 1 << 62, memoryview(bytearray()))
+            self.position = self.index.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self.position
+
+    def _read_member(self, member_index: int) -> bytes:
+        """Inflates one member, from the member cache when possible."""
+        with self.lock:
+            data = self.member_cache.get(member_index)
+            if data is not None:
+                self.member_cache.move_to_end(member_index)
+                return data
+
+        compressed_offset, compressed_size, _, uncompressed_size = self.index.members[member_index]
+        compressed = os.pread(self.file_ref.fileno(), compressed_size, compressed_offset)
+        data = self.inflate.decompress(compressed, 31, max(uncompressed_size, 1))
+
+        with self.lock:
+            self.member_cache[member_index] = data
+            while len(self.member_cache) > MEMBER_CACHE:
+                self.member_cache.popitem(last=False)
+        return data
+
+    def readinto(self, buffer) -> int:
+        output = memoryview(buffer).cast("B")
+        start, stop = self.position, self.position + len(output)
+        if self.index.size is not None:
+            stop = min(stop, self.index.size)
+        if stop <= start:
+            return 0
+
+        if self.index.members is None:
+            written = self.index.stream(self.file_ref.fileno(), start, stop, output)
+            self.position += written
+            return written
+
+        def copy_member(member_index: int) -> None:
+            _, _, member_start, _ = self.index.members[member_index]
+            data = self._read_member(member_index)
+            begin, end = max(start, member_start), min(stop, member_start + len(data))
+            output[begin - start:end - start] = data[begin - member_start:end - member_start]
+
+        member_indices = self.index.overlapping(start, stop)
+        if len(member_indices) > 1 and self.threads > 1:
+            with ThreadPoolExecutor(max_workers=min(self.threads, len(member_indices))) as executor:
+                list(executor.map(copy_member, member_indices))
+        else:
+            for member_index in member_indices:
+                copy_member(member_index)
+
+        self.position = stop
+        return stop - start
+
+    def close(self) -> None:
+        if not self.closed:
+            self.file_ref.close()
+        super().close()
+
+
+class NiftiReader:
+    """
+    Opens NIfTI files so that reading a region or a slice only decompresses its byte ranges.
+    """
+
+    @staticmethod
+    def load(file_path: str, threads: int = None) -> "nib.Nifti1Image":
+        """
+        Loads a NIfTI image whose data proxy reads through an IndexedGzipFile.
+
+        '.nii' files are loaded (memory-mapped) by nibabel as usual. For '.nii.gz' files the
+        returned image is a regular nibabel image: slicing its ``dataobj`` only inflates the
+        members (or stream span) holding the requested voxels, and reading all of it inflates
+        the members in parallel. The values are the same as those of ``nib.load``.
+
+        Args:
+            file_path (str): Path to the NIfTI file.
+            threads (int): Threads inflating members of one read (defaults to all CPUs).
+
+        Returns:
+            nib.Nifti1Image | nib.Nifti2Image: The image.
+        """
+        import nibabel as nib
+
+        if not file_path.endswith(".gz"):
+            return nib.load(file_path)
+
+        stream = IndexedGzipFile(file_path, threads)
+        # sizeof_hdr tells NIfTI-2 (540 bytes) from NIfTI-1, in either byte order
+        sizeof_hdr = stream.read(4)
+        stream.seek(0)
+        image_class = nib.Nifti2Image if 540 in struct.unpack("<i", sizeof_hdr) + struct.unpack(">i", sizeof_hdr) else nib.Nifti1Image
+        return image_class.from_stream(stream)
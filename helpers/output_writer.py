@@ -0,0 +1,296 @@
+import io
+import os
+import time
+import zlib
+import struct
+import zipfile
+import tempfile
+import numpy as np
+from typing import TYPE_CHECKING
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+if TYPE_CHECKING:
+    import nibabel as nib
+
+NUMPY_FORMATS = ("npz", "npy")
+
+# Process umask, temporary files get the permissions a plain open() would have given the output
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+
+# Gzip member header with the 'B4' extra subfield holding the member's total size, so readers
+# can find every member without inflating (see nifti_reader.GzipIndex): magic, deflate,
+# FEXTRA, mtime 0, no XFL, OS Unix, XLEN 8, subfield 'B4' of 4 bytes
+GZIP_BLOCK_HEADER = struct.Struct("<4sIBBH2sHI")
+GZIP_TRAILER = struct.Struct("<II")
+
+
+class GzipBlockStream(io.RawIOBase):
+    """
+    Write-only file object compressing its input as independent gzip members in parallel.
+
+    Data is cut into ``block_size`` blocks as it arrives and members are written in order,
+    with at most ``max_pending`` blocks in flight, so memory stays bounded by the blocks
+    rather than the size of the written file. Every member records its size in its header.
+    """
+
+    def __init__(self, file_ref, executor: ThreadPoolExecutor, compress_level: int, block_size: int, max_pending: int):
+        self.file_ref = file_ref
+        self.executor = executor
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.position = 0
+        self.members = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def _compress(self, block: bytes) -> bytes:
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        member_size = GZIP_BLOCK_HEADER.size + len(deflated) + GZIP_TRAILER.size
+        header = GZIP_BLOCK_HEADER.pack(b"\x1f\x8b\x08\x04", 0, 0, 3, 8, b"B4", 4, member_size)
+        return header + deflated + GZIP_TRAILER.pack(zlib.crc32(block), len(block) & 0xFFFFFFFF)
+
+    def _submit(self, block: bytes) -> None:
+        # zlib releases the GIL, so the blocks compress concurrently
+        self.pending.append(self.executor.submit(self._compress, block))
+        self.members += 1
+        while len(self.pending) > self.max_pending:
+            self.file_ref.write(self.pending.popleft().result())
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        size = len(view)
+        offset = 0
+        if self.buffer:
+            offset = min(size, self.block_size - len(self.buffer))
+            self.buffer += view[:offset]
+            if len(self.buffer) == self.block_size:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+        while size - offset >= self.block_size:
+            self._submit(bytes(view[offset:offset + self.block_size]))
+            offset += self.block_size
+        self.buffer += view[offset:]
+        self.position += size
+        return size
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        """Only the current position is reachable (nibabel then pads with writes)."""
+        if whence != 0 or offset != self.position:
+            raise OSError("GzipBlockStream cannot seek")
+        return self.position
+
+    def finish(self) -> None:
+        """Compress the last block and write every pending member."""
+        if self.buffer or not self.members:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.file_ref.write(self.pending.popleft().result())
+
+
+class OutputWriter:
+    """
+    A class to write pipeline outputs with configurable, multi-threaded compression.
+    """
+
+    def __init__(self, compress_level: int = 6, threads: int = None, numpy_format: str = "npz", block_size: int = 4 << 20):
+        """
+        Initializes the writer.
+
+        Args:
+            compress_level (int): zlib compression level (0-9) for .nii.gz and .npz outputs.
+            threads (int): Threads used to compress gzip blocks (defaults to all CPUs).
+            numpy_format (str): 'npz' (compressed) or 'npy' (uncompressed, memory-mappable).
+            block_size (int): Uncompressed bytes per gzip member.
+        """
+        if numpy_format not in NUMPY_FORMATS:
+            raise Exception(f"Unknown numpy output format '{numpy_format}'")
+        self.compress_level = compress_level
+        self.threads = threads or os.cpu_count() or 1
+        self.numpy_format = numpy_format
+        self.block_size = block_size
+
+    def numpy_path(self, path_stem: str) -> str:
+        """
+        Gets the numpy output path for a path without extension.
+
+        Args:
+            path_stem (str): Output path without the '.npz'/'.npy' extension.
+
+        Returns:
+            str: The output path with the configured extension.
+        """
+        return f"{path_stem}.{self.numpy_format}"
+
+    @staticmethod
+    def load_numpy(file_path: str, name: str = "image_array", mmap_mode: str = None) -> np.ndarray:
+        """
+        Loads an array written by write_numpy in either format.
+
+        Args:
+            file_path (str): Path to the '.npz' or '.npy' file.
+            name (str): Array name inside an '.npz' file.
+            mmap_mode (str): Memory-map mode for '.npy' files (e.g. 'r').
+
+        Returns:
+            np.ndarray: The stored array.
+        """
+        if file_path.endswith(".npy"):
+            return np.load(file_path, mmap_mode=mmap_mode)
+        with np.load(file_path) as npz_data:
+            return npz_data[name]
+
+    def _write_atomic(self, file_path: str, write_function) -> dict:
+        """Write through a temporary file, removed if the write fails, and report time and size."""
+        start_time = time.perf_counter()
+        # A unique temporary file, so concurrent writers of the same output do not share one
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", prefix=f".{os.path.basename(file_path)}.",
+                                             suffix=".tmp")
+        try:
+            os.fchmod(handle, 0o666 & ~FILE_UMASK)
+            with open(handle, "wb") as file_ref:
+                write_function(file_ref)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.lexists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        report = {
+            'file': os.path.basename(file_path),
+            'bytes': os.path.getsize(file_path),
+            'seconds': round(time.perf_counter() - start_time, 3),
+        }
+        logger.info(f"### WRITTEN {report['file']} : {report['bytes']} bytes in {report['seconds']} seconds ###")
+        return report
+
+    def write_nifti(self, nifti_img: "nib.Nifti1Image", file_path: str) -> dict:
+        """
+        Writes a NIfTI image; '.nii.gz' paths use multi-threaded block gzip.
+
+        The image is serialized slice by slice straight into the file (or the compressor), so
+        no full-size copy of the encoded volume is made. The result is a multi-member gzip
+        stream, readable as a standard '.nii.gz'.
+
+        Args:
+            nifti_img (nib.Nifti1Image): The image to write.
+            file_path (str): Output path ('.nii' or '.nii.gz').
+
+        Returns:
+            dict: File name, size in bytes and write time in seconds.
+        """
+        def write_stream(file_ref) -> None:
+            if not file_path.endswith(".gz"):
+                nifti_img.to_file_map(nifti_img.make_file_map({'image': file_ref, 'header': file_ref}))
+                return
+
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                stream = GzipBlockStream(file_ref, executor, self.compress_level, self.block_size, max_pending=2 * self.threads)
+                nifti_img.to_file_map(nifti_img.make_file_map({'image': stream, 'header': stream}))
+                stream.finish()
+
+        return self._write_atomic(file_path, write_stream)
+
+    def write_numpy(self, array: np.ndarray, file_path: str, name: str = "image_array") -> dict:
+        """
+        Writes an array as '.npy' (uncompressed) or '.npz' (at the configured level).
+
+        Args:
+            array (np.ndarray): The array to write.
+            file_path (str): Output path, its extension selects the format.
+            name (str): Array name inside an '.npz' file.
+
+        Returns:
+            dict: File name, size in bytes and write time in seconds.
+        """
+        if file_path.endswith(".npy"):
+            return self._write_atomic(file_path, lambda file_ref: np.lib.format.write_array(file_ref, np.asanyarray(array)))
+        return self.write_arrays({name: array}, file_path)
+
+    def write_arrays(self, arrays: dict[str, np.ndarray], file_path: str) -> dict:
+        """
+        Writes several named arrays as one '.npz' file (at the configured level).
+
+        Args:
+            arrays (dict[str, np.ndarray]): Array name -> array.
+            file_path (str): Output '.npz' path.
+
+        Returns:
+            dict: File name, size in bytes and write time in seconds.
+        """
+        def write_npz(file_ref) -> None:
+            with zipfile.ZipFile(file_ref, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=self.compress_level) as zip_ref:
+                for name, array in arrays.items():
+                    with zip_ref.open(f"{name}.npy", mode="w", force_zip64=True) as member_ref:
+                        np.lib.format.write_array(member_ref, np.asanyarray(array))
+
+        return self._write_atomic(file_path, write_npz)
+
+    @staticmethod
+    def encode_png(image: np.ndarray, compress_level: int = 1) -> bytes:
+        """
+        Encodes a 2D uint8 array as an 8-bit grayscale PNG, first row at the top.
+
+        Args:
+            image (np.ndarray): The image (rows, columns).
+            compress_level (int): zlib compression level of the pixel data.
+
+        Returns:
+            bytes: The PNG file.
+        """
+        height, width = image.shape
+
+        def chunk(chunk_type: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+        # Every row starts with filter type 0 (none)
+        rows = np.zeros((height, width + 1), dtype=np.uint8)
+        rows[:, 1:] = image
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), compress_level))
+            + chunk(b"IEND", b"")
+        )
+
+    def write_png(self, image: np.ndarray, file_path: str) -> dict:
+        """
+        Writes a 2D uint8 array as a grayscale PNG (at the configured level).
+
+        Args:
+            image (np.ndarray): The image (rows, columns).
+            file_path (str): Output '.png' path.
+
+        Returns:
+            dict: File name, size in bytes and write time in seconds.
+        """
+        encoded = self.encode_png(image, self.compress_level)
+        return self._write_atomic(file_path, lambda file_ref: file_ref.write(encoded))
+
+    def write_outputs(self, nifti_outputs: list[tuple] = (), numpy_outputs: list[tuple] = ()) -> list[dict]:
+        """
+        Encodes several outputs concurrently.
+
+        Args:
+            nifti_outputs (list[tuple]): (nifti_img, file_path) pairs.
+            numpy_outputs (list[tuple]): (array, file_path) pairs.
+
+        Returns:
+            list[dict]: One write report per output.
+        """
+        jobs = [(self.write_nifti, x) for x in nifti_outputs] + [(self.write_numpy, x) for x in numpy_outputs]
+        with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+            futures = [executor.submit(function, *arguments) for function, arguments in jobs]
+            return [future.result() for future in futures]
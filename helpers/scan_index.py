@@ -0,0 +1,206 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import datetime
+import contextlib
+import numpy as np
+from loguru import logger
+
+from parameters import Becik4UParameters
+
+INDEX_VERSION = 1
+INDEX_FILE_NAME = "scan_fingerprints.json"
+
+# Fingerprint kinds: one ingested NIfTI volume, or one converted DICOM series
+INDEX_KINDS = ("nifti", "dicom_series")
+
+# Files the pipeline rewrites in place are copied, every other output is replaced on write and hardlinked
+COPIED_SUFFIXES = (".json",)
+
+
+class ScanIndex:
+    """
+    Local index of scan content fingerprints under BECIK4U_ROOT, used to reuse the outputs of
+    re-uploaded studies.
+
+    The index is one JSON file mapping each fingerprint to the scans it was ingested as.
+    Updates hold an exclusive lock on a sidecar lock file and replace the index atomically,
+    so concurrent ingest processes do not lose each other's entries.
+    """
+
+    def __init__(self, params: Becik4UParameters):
+        """
+        Initializes the index.
+
+        Args:
+            params (Becik4UParameters): Instance of the Becik4UParameters class.
+        """
+        self.params = params
+        self.index_path = os.path.join(params.becik4u_root, "index", INDEX_FILE_NAME)
+
+    @staticmethod
+    def array_fingerprint(array: np.ndarray, affine: np.ndarray) -> str:
+        """
+        Fingerprints a volume from its voxel data, dtype, shape and affine.
+
+        Args:
+            array (np.ndarray): The voxel data.
+            affine (np.ndarray): The voxel to world transform.
+
+        Returns:
+            str: Hex digest of the content.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(np.ascontiguousarray(affine, dtype=np.float64).tobytes())
+        digest.update(memoryview(np.ascontiguousarray(array)).cast("B"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def series_fingerprint(instances: list[tuple[str, str]]) -> str:
+        """
+        Fingerprints a DICOM series from its instances, in SOPInstanceUID order.
+
+        Args:
+            instances (list[tuple[str, str]]): (SOPInstanceUID, pixel data digest) of every file.
+
+        Returns:
+            str: Hex digest of the series.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for sop_uid, pixel_digest in sorted(instances):
+            digest.update(f"{sop_uid}:{pixel_digest};".encode())
+        return digest.hexdigest()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the exclusive index lock."""
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(f"{self.index_path}.lock", "a") as lock_ref:
+            fcntl.flock(lock_ref, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_ref, fcntl.LOCK_UN)
+
+    def _load(self) -> dict:
+        """Load the index, starting fresh if it is missing or from another version."""
+        try:
+            with open(self.index_path) as jsn_ref:
+                index = json.load(jsn_ref)
+            if index.get('version') == INDEX_VERSION:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {'version': INDEX_VERSION, **{x: {} for x in INDEX_KINDS}}
+
+    def lookup(self, kind: str, fingerprint: str, exclude: str = None) -> list[dict]:
+        """
+        Finds the scans ingested with a fingerprint, most recent first.
+
+        Args:
+            kind (str): Fingerprint kind, from INDEX_KINDS.
+            fingerprint (str): The fingerprint.
+            exclude (str): Scan ID left out of the result (the scan being ingested).
+
+        Returns:
+            list[dict]: The index records, each with 'scan_id', 'registered' and the values given to register.
+        """
+        records = self._load()[kind].get(fingerprint, [])
+        return [x for x in reversed(records) if x['scan_id'] != exclude]
+
+    def register(self, kind: str, fingerprint: str, scan_id: str, **values) -> None:
+        """
+        Records that a scan was ingested with a fingerprint, replacing its earlier record of this kind.
+
+        Args:
+            kind (str): Fingerprint kind, from INDEX_KINDS.
+            fingerprint (str): The fingerprint.
+            scan_id (str): The scan.
+            **values: Extra values of the record (e.g. the ingest parameters).
+        """
+        key = values.get('name')
+        with self._locked():
+            index = self._load()
+            for entry_fingerprint in list(index[kind]):
+                records = [x for x in index[kind][entry_fingerprint] if (x['scan_id'], x.get('name')) != (scan_id, key)]
+                if records:
+                    index[kind][entry_fingerprint] = records
+                else:
+                    del index[kind][entry_fingerprint]
+
+            index[kind].setdefault(fingerprint, []).append({
+                'scan_id': scan_id,
+                'registered': datetime.datetime.now().isoformat(timespec='seconds'),
+                **values,
+            })
+
+            temp_path = f"{self.index_path}.tmp"
+            with open(temp_path, "w") as jsn_ref:
+                json.dump(index, jsn_ref, indent=2, sort_keys=True)
+            os.replace(temp_path, self.index_path)
+
+    @staticmethod
+    def link_file(source: str, target: str) -> str:
+        """
+        Links or copies a file into place, replacing the target.
+
+        Returns:
+            str: 'hardlink' or 'copy'.
+        """
+        if os.path.lexists(target):
+            os.remove(target)
+        if not source.endswith(COPIED_SUFFIXES):
+            try:
+                os.link(source, target)
+                return "hardlink"
+            except OSError:
+                pass
+        shutil.copy2(source, target)
+        return "copy"
+
+    @staticmethod
+    def link_outputs(source_dir: str, source_id: str, target_dir: str, target_id: str, exclude: tuple = ()) -> list[str]:
+        """
+        Links the '{source_id}_*' files of a data directory into another scan's, renamed to '{target_id}_*'.
+
+        The source manifest is rewritten for the target (its recorded output names), so the target's
+        pipeline reuses every stage whose inputs match.
+
+        Args:
+            source_dir (str): The data directory of the processed scan.
+            source_id (str): The processed scan.
+            target_dir (str): The data directory of the new scan.
+            target_id (str): The new scan.
+            exclude (tuple): Suffixes after '{source_id}_' that are not linked (e.g. 'metadata.json').
+
+        Returns:
+            list[str]: The linked file names in the target directory.
+        """
+        os.makedirs(target_dir, exist_ok=True)
+        prefix = f"{source_id}_"
+        linked = []
+        for file_name in sorted(os.listdir(source_dir)):
+            suffix = file_name[len(prefix):]
+            if not file_name.startswith(prefix) or suffix in exclude or file_name.endswith(".tmp"):
+                continue
+
+            target_path = os.path.join(target_dir, f"{target_id}_{suffix}")
+            if suffix == "manifest.json":
+                with open(os.path.join(source_dir, file_name)) as jsn_ref:
+                    manifest = json.load(jsn_ref)
+                for entry in manifest.get('stages', {}).values():
+                    for output in entry.get('outputs', {}).values():
+                        if output.get('path', "").startswith(prefix):
+                            output['path'] = f"{target_id}_{output['path'][len(prefix):]}"
+                with open(f"{target_path}.tmp", "w") as jsn_ref:
+                    json.dump(manifest, jsn_ref, indent=2, sort_keys=True)
+                os.replace(f"{target_path}.tmp", target_path)
+            else:
+                ScanIndex.link_file(os.path.join(source_dir, file_name), target_path)
+            linked.append(os.path.basename(target_path))
+
+        logger.info(f"### REUSED {len(linked)} OUTPUTS OF {source_id} ###")
+        return linked
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import datetime
+import resource
+import threading
+import contextlib
+import subprocess
+from loguru import logger
+
+# Metrics exported to the Prometheus textfile, with their help text
+PROMETHEUS_METRICS = {
+    'wall_seconds': "Wall time of the step.",
+    'cpu_seconds': "User and system CPU time of the process during the step.",
+    'max_rss_delta_bytes': "Growth of the process peak resident set size during the step.",
+    'read_bytes': "Bytes read by the process during the step.",
+    'write_bytes': "Bytes written by the process during the step.",
+    'children_cpu_seconds': "User and system CPU time of child processes reaped during the step.",
+    'children_max_rss_bytes': "Largest peak resident set size of a child process reaped during the step.",
+    'success': "1 when the step completed, 0 when it failed.",
+}
+
+
+class Telemetry:
+    """
+    A class that records per-step resource usage as JSON-lines events and Prometheus metrics.
+
+    Every measured step reports wall time, CPU time, growth of the peak RSS, bytes read and
+    written and the resource usage of child processes. CPU, RSS and I/O counters are per
+    process, so steps running concurrently include each other's usage.
+    """
+
+    def __init__(self, events_path: str = None, prometheus_path: str = None, labels: dict = None):
+        """
+        Initializes the recorder.
+
+        Args:
+            events_path (str): JSON-lines file the events are appended to (None disables it).
+            prometheus_path (str): Prometheus textfile written by write_prometheus (None disables it).
+            labels (dict): Labels added to every event and metric (e.g. the scan ID).
+        """
+        self.events_path = events_path
+        self.prometheus_path = prometheus_path
+        self.labels = dict(labels or {})
+        self.events = []
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def bind(self, **labels) -> "Telemetry":
+        """
+        Returns a recorder sharing this one's outputs, with extra labels on its events.
+
+        Args:
+            **labels: Labels added to every event of the returned recorder (e.g. scan_id).
+
+        Returns:
+            Telemetry: The bound recorder.
+        """
+        bound = Telemetry(self.events_path, self.prometheus_path, {**self.labels, **labels})
+        bound.events = self.events
+        bound.listeners = self.listeners
+        bound.lock = self.lock
+        return bound
+
+    @staticmethod
+    def read_io_counters() -> dict:
+        """
+        Reads the I/O counters of this process from /proc/self/io.
+
+        Returns:
+            dict: 'rchar'/'wchar' (all reads and writes) and 'read_bytes'/'write_bytes'
+            (storage only); empty when the counters are unavailable.
+        """
+        try:
+            with open("/proc/self/io") as io_ref:
+                return {key: int(value) for key, value in (line.split(":") for line in io_ref)}
+        except OSError:
+            return {}
+
+    @staticmethod
+    def snapshot() -> dict:
+        """Current CPU, memory and I/O counters of this process and its reaped children."""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_counters = Telemetry.read_io_counters()
+        return {
+            'wall': time.perf_counter(),
+            'cpu': usage.ru_utime + usage.ru_stime,
+            'max_rss': usage.ru_maxrss * 1024,
+            'read': io_counters.get('rchar', 0),
+            'write': io_counters.get('wchar', 0),
+            'disk_read': io_counters.get('read_bytes', 0),
+            'disk_write': io_counters.get('write_bytes', 0),
+            'children_cpu': children.ru_utime + children.ru_stime,
+            'children_max_rss': children.ru_maxrss * 1024,
+        }
+
+    def emit(self, event: str, name: str, values: dict, labels: dict = None) -> dict:
+        """
+        Records one event and appends it to the JSON-lines file.
+
+        Args:
+            event (str): Event type (e.g. 'stage', 'ingest', 'subprocess').
+            name (str): Name of the step.
+            values (dict): Measured values.
+            labels (dict): Extra labels of this event.
+
+        Returns:
+            dict: The recorded event.
+        """
+        record = {
+            'timestamp': datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'event': event,
+            'name': name,
+            'labels': {**self.labels, **(labels or {})},
+            **values,
+        }
+        with self.lock:
+            self.events.append(record)
+            if self.events_path is not None:
+                with open(self.events_path, "a") as events_ref:
+                    events_ref.write(json.dumps(record) + "\n")
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            listener(record)
+        return record
+
+    def add_listener(self, listener) -> None:
+        """
+        Calls a function with every event recorded from now on, by this recorder or a bound one.
+
+        Args:
+            listener (Callable[[dict], None]): Receives each recorded event; it runs in the emitting thread.
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def record(self, events: list[dict]) -> None:
+        """
+        Adds events recorded elsewhere (e.g. by a worker process) without writing them again.
+
+        Args:
+            events (list[dict]): Events returned by another recorder.
+        """
+        with self.lock:
+            self.events.extend(events)
+
+    @contextlib.contextmanager
+    def measure(self, name: str, event: str = "stage", **labels):
+        """
+        Measures the enclosed block and emits it as an event, also when it raises.
+
+        Args:
+            name (str): Name of the step.
+            event (str): Event type.
+            **labels: Extra labels of this event.
+        """
+        start = self.snapshot()
+        values = {'status': 'ok'}
+        try:
+            yield values
+        except BaseException as error_exc:
+            values.update({'status': 'failed', 'error': str(error_exc)})
+            raise
+        finally:
+            stop = self.snapshot()
+            values.update({
+                'wall_seconds': round(stop['wall'] - start['wall'], 6),
+                'cpu_seconds': round(stop['cpu'] - start['cpu'], 6),
+                'max_rss_bytes': stop['max_rss'],
+                'max_rss_delta_bytes': stop['max_rss'] - start['max_rss'],
+                'read_bytes': stop['read'] - start['read'],
+                'write_bytes': stop['write'] - start['write'],
+                'disk_read_bytes': stop['disk_read'] - start['disk_read'],
+                'disk_write_bytes': stop['disk_write'] - start['disk_write'],
+                'children_cpu_seconds': round(stop['children_cpu'] - start['children_cpu'], 6),
+                'children_max_rss_bytes': stop['children_max_rss'] if stop['children_max_rss'] > start['children_max_rss'] else 0,
+            })
+            self.emit(event, name, values, labels)
+
+    def run_subprocess(self, command: list[str], name: str, **labels) -> dict:
+        """
+        Runs a command and emits the exact resource usage of that child process.
+
+        The child is reaped with os.wait4, so its usage is not mixed with other
+        subprocesses running at the same time.
+
+        Args:
+            command (list[str]): The command to run.
+            name (str): Name of the step.
+            **labels: Extra labels of this event.
+
+        Returns:
+            dict: The recorded event.
+
+        Raises:
+            subprocess.CalledProcessError: If the command exits with a non-zero status.
+        """
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command)
+        try:
+            _, wait_status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        process.returncode = os.waitstatus_to_exitcode(wait_status)
+
+        record = self.emit("subprocess", name, {
+            'status': 'ok' if process.returncode == 0 else 'failed',
+            'returncode': process.returncode,
+            'wall_seconds': round(time.perf_counter() - start_time, 6),
+            'children_cpu_seconds': round(usage.ru_utime + usage.ru_stime, 6),
+            'children_user_seconds': round(usage.ru_utime, 6),
+            'children_system_seconds': round(usage.ru_stime, 6),
+            'children_max_rss_bytes': usage.ru_maxrss * 1024,
+            'children_read_blocks': usage.ru_inblock,
+            'children_write_blocks': usage.ru_oublock,
+        }, labels)
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return record
+
+    @staticmethod
+    def _format_labels(labels: dict) -> str:
+        """Format labels for the Prometheus text format."""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+    def write_prometheus(self) -> None:
+        """Atomically writes the recorded events as a Prometheus textfile (node_exporter textfile collector)."""
+        if self.prometheus_path is None:
+            return
+
+        # Keep the latest event of each step, a series may appear only once per file
+        with self.lock:
+            latest = {}
+            for record in self.events:
+                key = (record['event'], record['name'], tuple(sorted(record['labels'].items())))
+                latest[key] = record
+            events = list(latest.values())
+
+        lines = []
+        for metric, help_text in PROMETHEUS_METRICS.items():
+            samples = []
+            for record in events:
+                if metric == 'success':
+                    value = 1 if record.get('status') == 'ok' else 0
+                else:
+                    value = record.get(metric)
+                if value is None:
+                    continue
+                labels = {**record['labels'], 'event': record['event'], 'step': record['name']}
+                samples.append(f"becik4u_step_{metric}{self._format_labels(labels)} {value}")
+
+            if samples:
+                lines.append(f"# HELP becik4u_step_{metric} {help_text}")
+                lines.append(f"# TYPE becik4u_step_{metric} gauge")
+                lines.extend(samples)
+
+        temp_path = f"{self.prometheus_path}.tmp"
+        with open(temp_path, "w") as prom_ref:
+            prom_ref.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.prometheus_path)
+        logger.info(f"### TELEMETRY : {len(events)} events written to {self.prometheus_path} ###")
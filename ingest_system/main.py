@@ -7,63 +7,98 @@ import argparse
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'helpers')))
 from parameters import Becik4UParameters
+from output_writer import OutputWriter, NUMPY_FORMATS
+from telemetry import Telemetry
 from utils.dicom_ingestion import DICOMIngestion
 from utils.nifti_ingestion import NIFTIIngestion
+from utils.directory_scanner import DirectoryScanner
+from utils.isotropic_resampler import RESAMPLERS
 
 class IngestSystem:
     """
     Main class for managing DICOM and NIfTI file ingestion.
     """
 
-    def __init__(self):
+    def __init__(self, telemetry: Telemetry = None):
         logger.remove(0)
         logger.add(sys.stderr, format = "<red>[{level}]</red> <green>{message}</green> ", colorize=True)
         self.params = Becik4UParameters()
+        self.telemetry = telemetry or Telemetry()
 
-    def ingest_dicom(self, id: str, source_root: str) -> None:
-        """Ingest DICOM files and display results."""
-        dcm_nft_root = DICOMIngestion.ingest_and_convert(self.params, id, source_root)
+    def ingest_dicom(self, id: str, source_root: str, workers: int = None) -> None:
+        """Ingest DICOM files and display results, with the staging and per-series conversion timings."""
+        ingest_report = DICOMIngestion.ingest_and_convert(self.params, id, source_root, self.telemetry, workers)
         logger.info("JSON REPORT #")
-        self.get_dir_info(dcm_nft_root)
+        report = {
+            'staging': ingest_report['staging'],
+            'skipped_files': ingest_report['skipped_files'],
+            'series': ingest_report['series'],
+            'files': DirectoryScanner().scan(ingest_report['nifti_root']),
+        }
+        logger.info(json.dumps(report, indent=2))
 
-    def ingest_nifti(self, id: str, file_name: str) -> None:
+    def ingest_nifti(self, id: str, file_name: str, writer: OutputWriter = None, volume_index: int = 0,
+                     resampler: str = "builtin") -> None:
         """Ingest NIfTI files (always internal)."""
-        NIFTIIngestion.internal_ingest(self.params, id, file_name)
+        NIFTIIngestion.internal_ingest(self.params, id, file_name, writer, volume_index, resampler, self.telemetry)
 
     def get_dir_info(self, root_dir: str) -> None:
-        """Get directory information of NIfTI files."""
-        full_path = os.path.abspath(root_dir)
-        files = [os.path.join(full_path, x) for x in os.listdir(full_path)]
-        report = [NIFTIIngestion.get_nifti_file_info(x) for x in files]
+        """Get directory information of NIfTI files (header-only, parallel and cached)."""
+        report = DirectoryScanner().scan(root_dir)
         dir_jstr = json.dumps(report, indent=2)
         logger.info(dir_jstr)
 
+    def report_scan(self, id: str, sub_dir: str) -> None:
+        """Report the NIfTI files of a scan directory."""
+        root_dir = os.path.join(self.params.get_root_scan_dir(id), sub_dir)
+        logger.info("JSON REPORT #")
+        self.get_dir_info(root_dir)
+
 def main():
     """
     Main function to parse command-line arguments and run the ingestion system.
     """
     parser = argparse.ArgumentParser(description="Becik4U Ingest System")
+    parser.add_argument('--telemetry', default=None, help='Append per-step resource usage events to this JSON-lines file')
+    parser.add_argument('--prometheus', default=None, help='Write per-step metrics to this Prometheus textfile')
 
     subparsers = parser.add_subparsers(dest="option", required=True)
 
     # Option DICOM
     parser_dicom = subparsers.add_parser('dicom', help='Option for DICOM ingestion')
     parser_dicom.add_argument('--id', required=True, type=str)
-    parser_dicom.add_argument('--root_dir', required=True, type=str)
+    parser_dicom.add_argument('--root_dir', required=True, type=str, help='Directory of DICOM files, or a zip/tar(.gz) archive of them')
+    parser_dicom.add_argument('--workers', type=int, default=None, help='Processes converting series in parallel (default: all CPUs)')
 
     # Option NIFTI
     parser_nifti = subparsers.add_parser('nifti', help='Option for NIfTI ingestion')
     parser_nifti.add_argument('--id', required=True, type=str)
     parser_nifti.add_argument('--file_name', required=True, type=str)
+    parser_nifti.add_argument('--compress_level', type=int, choices=range(0, 10), default=6)
+    parser_nifti.add_argument('--numpy_format', choices=NUMPY_FORMATS, default="npz")
+    parser_nifti.add_argument('--volume', type=int, default=0, help='Volume to ingest from a 4D series')
+    parser_nifti.add_argument('--resampler', choices=RESAMPLERS, default="builtin", help='Isotropic resampling backend')
+
+    # Option REPORT
+    parser_report = subparsers.add_parser('report', help='Report NIfTI header information of a scan directory')
+    parser_report.add_argument('--id', required=True, type=str)
+    parser_report.add_argument('--sub_dir', default=os.path.join("raw", "nifti"), type=str)
 
     args = parser.parse_args()
 
-    ingest_system = IngestSystem()
+    telemetry = Telemetry(events_path=args.telemetry, prometheus_path=args.prometheus)
+    ingest_system = IngestSystem(telemetry)
 
-    if args.option == "dicom":
-        ingest_system.ingest_dicom(args.id, args.root_dir)
-    elif args.option == "nifti":
-        ingest_system.ingest_nifti(args.id, args.file_name)
+    try:
+        if args.option == "dicom":
+            ingest_system.ingest_dicom(args.id, args.root_dir, args.workers)
+        elif args.option == "nifti":
+            writer = OutputWriter(compress_level=args.compress_level, numpy_format=args.numpy_format)
+            ingest_system.ingest_nifti(args.id, args.file_name, writer, args.volume, args.resampler)
+        elif args.option == "report":
+            ingest_system.report_scan(args.id, args.sub_dir)
+    finally:
+        telemetry.write_prometheus()
 
 
 if __name__ == "__main__":
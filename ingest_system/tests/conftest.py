@@ -0,0 +1,10 @@
+import os
+import sys
+
+INGEST_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+REPOSITORY_ROOT = os.path.dirname(INGEST_ROOT)
+
+# Same import layout as main.py: the ingest 'utils' package, the shared helpers and the benchmark phantoms
+for path in (INGEST_ROOT, os.path.join(REPOSITORY_ROOT, 'helpers'), os.path.join(REPOSITORY_ROOT, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,176 @@
+import os
+import io
+import hashlib
+import tarfile
+import zipfile
+
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("dicom2nifti")
+
+import phantoms
+from scan_index import ScanIndex
+from utils.dicom_ingestion import DICOMIngestion
+
+ARCHIVE_FORMATS = ["study.zip", "study.tar.gz"]
+
+
+def write_series(root: str, folder: str, shape: tuple) -> str:
+    """Write a phantom series into root/folder and return its directory."""
+    series_dir = os.path.join(root, folder)
+    assert phantoms.write_dicom_series(series_dir, shape, (1.0, 1.0, 2.0)) == shape[2]
+    return series_dir
+
+
+def expected_fingerprint(series_dir: str) -> tuple[str, str]:
+    """The SeriesInstanceUID and fingerprint of a series, read back with pydicom from the source files."""
+    instances, uids = [], set()
+    for file_name in os.listdir(series_dir):
+        dataset = pydicom.dcmread(os.path.join(series_dir, file_name))
+        uids.add(dataset.SeriesInstanceUID)
+        instances.append((dataset.SOPInstanceUID, hashlib.blake2b(dataset.PixelData, digest_size=20).hexdigest()))
+    assert len(uids) == 1
+    return uids.pop(), ScanIndex.series_fingerprint(instances)
+
+
+def pack(archive_path: str, members: list[tuple[str, bytes]]) -> None:
+    """Write the (name, content) members as given, including names phantoms.write_archive never produces."""
+    if archive_path.endswith(".zip"):
+        with zipfile.ZipFile(archive_path, "w") as zip_ref:
+            for name, data in members:
+                zip_ref.writestr(name, data)
+        return
+
+    with tarfile.open(archive_path, "w:gz") as tar_ref:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar_ref.addfile(info, io.BytesIO(data))
+
+
+def read_members(series_dir: str, folder: str) -> list[tuple[str, bytes]]:
+    members = []
+    for file_name in sorted(os.listdir(series_dir)):
+        with open(os.path.join(series_dir, file_name), "rb") as file_ref:
+            members.append((f"{folder}/{file_name}", file_ref.read()))
+    return members
+
+
+@pytest.mark.parametrize("archive_name", ARCHIVE_FORMATS)
+def test_stage_phantom_archive(tmp_path, archive_name):
+    series_dir = write_series(str(tmp_path / "source"), "T1", (16, 16, 6))
+    archive_path = str(tmp_path / archive_name)
+    assert phantoms.write_archive(archive_path, series_dir) == 7
+    assert DICOMIngestion.is_archive(archive_path)
+
+    target_root = str(tmp_path / "dicom")
+    staging, series, skipped = DICOMIngestion.stage_archive(archive_path, target_root, threads=2)
+
+    # The README.txt member is not DICOM
+    assert skipped == 1
+    assert staging['files'] == 6
+    assert staging['modes'] == {'extract': 6}
+    assert staging['bytes'] == sum(os.path.getsize(os.path.join(series_dir, x)) for x in os.listdir(series_dir))
+
+    series_uid, fingerprint = expected_fingerprint(series_dir)
+    assert list(series) == [series_uid]
+    assert series[series_uid]['name'] == "1"
+    assert sorted(series[series_uid]['files']) == [os.path.join(target_root, "T1", x) for x in sorted(os.listdir(series_dir))]
+    assert series[series_uid]['fingerprint'] == fingerprint
+    assert sorted(os.listdir(target_root)) == ["T1"]
+    for file_name in os.listdir(series_dir):
+        with open(os.path.join(series_dir, file_name), "rb") as source, open(os.path.join(target_root, "T1", file_name), "rb") as staged:
+            assert source.read() == staged.read()
+
+
+@pytest.mark.parametrize("archive_name", ARCHIVE_FORMATS)
+def test_stage_archive_groups_series_and_rejects_escaping_members(tmp_path, archive_name):
+    source_root = str(tmp_path / "source")
+    first_dir = write_series(source_root, "first", (16, 16, 6))
+    second_dir = write_series(source_root, "second", (12, 12, 4))
+    escaping = read_members(second_dir, "second")[0][1]
+
+    archive_path = str(tmp_path / archive_name)
+    members = read_members(first_dir, "first") + read_members(second_dir, "study/second")
+    members += [
+        ("README.txt", b"not a DICOM file\n"),
+        ("first/notes.json", b"{}"),
+        ("../escape.dcm", escaping),
+        ("study/../../escape_nested.dcm", escaping),
+        ("/absolute/inside.dcm", escaping),
+    ]
+    pack(archive_path, members)
+
+    target_root = tmp_path / "scan" / "dicom"
+    staging, series, skipped = DICOMIngestion.stage_archive(archive_path, str(target_root), threads=2)
+
+    # Two non-DICOM and two escaping members, the absolute name is staged relative to the directory
+    assert skipped == 4
+    assert staging['files'] == 6 + 4 + 1
+    assert not (tmp_path / "scan" / "escape.dcm").exists()
+    assert not (tmp_path / "scan" / "escape_nested.dcm").exists()
+    assert sorted(os.listdir(tmp_path / "scan")) == ["dicom"]
+    assert (target_root / "absolute" / "inside.dcm").is_file()
+
+    first_uid, first_fingerprint = expected_fingerprint(first_dir)
+    second_uid, second_fingerprint = expected_fingerprint(second_dir)
+    assert sorted(series) == sorted([first_uid, second_uid])
+    assert len(series[first_uid]['files']) == 6
+    assert series[first_uid]['fingerprint'] == first_fingerprint
+    # The absolute member duplicates an instance of the second series
+    assert len(series[second_uid]['files']) == 5
+    assert series[second_uid]['fingerprint'] != second_fingerprint
+    # Both series have SeriesNumber 1 and no description, the second name is made unique
+    assert sorted(x['name'] for x in series.values()) == ["1", "1_1"]
+
+    # Fingerprints from the archive buffers match a directory ingest of the staged files
+    grouped, grouped_skipped = DICOMIngestion.group_series(str(target_root), threads=2)
+    DICOMIngestion.fingerprint_series(grouped, threads=2)
+    assert grouped_skipped == 0
+    assert {uid: entry['fingerprint'] for uid, entry in grouped.items()} == {uid: entry['fingerprint'] for uid, entry in series.items()}
+
+
+def test_fingerprints_do_not_depend_on_archive_format(tmp_path):
+    series_dir = write_series(str(tmp_path / "source"), "T1", (12, 12, 4))
+    fingerprints = []
+    for archive_name in ARCHIVE_FORMATS + ["study.tar"]:
+        archive_path = str(tmp_path / archive_name)
+        phantoms.write_archive(archive_path, series_dir)
+        _, series, _ = DICOMIngestion.stage_archive(archive_path, str(tmp_path / archive_name.replace(".", "_")), threads=1)
+        fingerprints.append({uid: entry['fingerprint'] for uid, entry in series.items()})
+
+    assert fingerprints[0] == fingerprints[1] == fingerprints[2]
+    assert len(fingerprints[0]) == 1
+
+
+def test_repeated_tar_member_is_staged_once(tmp_path):
+    series_dir = write_series(str(tmp_path / "source"), "T1", (12, 12, 4))
+    members = read_members(series_dir, "T1")
+    archive_path = str(tmp_path / "study.tar.gz")
+    pack(archive_path, members + [members[1]])
+
+    target_root = str(tmp_path / "dicom")
+    staging, series, skipped = DICOMIngestion.stage_archive(archive_path, target_root, threads=2)
+
+    series_uid, fingerprint = expected_fingerprint(series_dir)
+    assert skipped == 1
+    assert staging['files'] == 4
+    assert staging['bytes'] == sum(len(data) for _, data in members)
+    assert len(series[series_uid]['files']) == len(set(series[series_uid]['files'])) == 4
+    assert series[series_uid]['fingerprint'] == fingerprint
+    assert sorted(os.listdir(os.path.join(target_root, "T1"))) == sorted(os.listdir(series_dir))
+
+
+def test_names_starting_with_dots_are_staged(tmp_path):
+    series_dir = write_series(str(tmp_path / "source"), "T1", (12, 12, 4))
+    archive_path = str(tmp_path / "study.zip")
+    pack(archive_path, read_members(series_dir, "..series"))
+
+    target_root = tmp_path / "dicom"
+    staging, series, skipped = DICOMIngestion.stage_archive(archive_path, str(target_root), threads=2)
+
+    assert skipped == 0
+    assert staging['files'] == 4
+    assert sorted(os.listdir(target_root / "..series")) == sorted(os.listdir(series_dir))
+    assert [x['fingerprint'] for x in series.values()] == [expected_fingerprint(series_dir)[1]]
@@ -0,0 +1,72 @@
+import os
+import json
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from utils.directory_scanner import DirectoryScanner, CACHE_FILE_NAME
+
+
+def write_image(file_path: str, image_class=nib.Nifti1Image, extension_bytes: int = 0, dtype=np.int16) -> None:
+    """Write a small volume, optionally with a comment header extension."""
+    image = image_class(np.arange(6 * 7 * 5, dtype=dtype).reshape(6, 7, 5), np.diag([1.5, 1.2, 2.0, 1.0]))
+    if extension_bytes:
+        image.header.extensions.append(nib.nifti1.Nifti1Extension("comment", b"x" * extension_bytes))
+    nib.save(image, file_path)
+
+
+def expected_report(file_path: str) -> dict:
+    """The report built from nibabel's full read of the file."""
+    header = nib.load(file_path).header
+    return {
+        'fname': os.path.basename(file_path),
+        'full_path': os.path.abspath(file_path),
+        'valid': True,
+        'dshape': [int(x) for x in header.get_data_shape()],
+        'dtype': str(header.get_data_dtype()),
+        'dsize': [round(float(x), 3) for x in header.get_zooms()],
+    }
+
+
+@pytest.mark.parametrize("file_name", ["plain.nii", "plain.nii.gz", "extended.nii", "extended.nii.gz"])
+@pytest.mark.parametrize("image_class", [nib.Nifti1Image, nib.Nifti2Image])
+def test_header_report_matches_nibabel(tmp_path, file_name, image_class):
+    file_path = str(tmp_path / file_name)
+    write_image(file_path, image_class, extension_bytes=200 if file_name.startswith("extended") else 0)
+
+    assert DirectoryScanner.get_header_info(file_path) == expected_report(file_path)
+
+
+def test_big_endian_header(tmp_path):
+    file_path = str(tmp_path / "big_endian.nii.gz")
+    write_image(file_path, extension_bytes=200, dtype=">i2")
+
+    assert DirectoryScanner.get_header_info(file_path) == expected_report(file_path)
+
+
+def test_invalid_files(tmp_path):
+    (tmp_path / "notes.txt").write_text("not a volume")
+    (tmp_path / "truncated.nii").write_bytes(b"\x5c\x01\x00\x00" + b"\x00" * 100)
+
+    assert DirectoryScanner.get_header_info(str(tmp_path / "notes.txt"))['valid'] is False
+    assert DirectoryScanner.get_header_info(str(tmp_path / "truncated.nii"))['valid'] is False
+
+
+def test_scan_reuses_and_refreshes_cache(tmp_path):
+    file_path = str(tmp_path / "extended.nii.gz")
+    write_image(file_path, extension_bytes=200)
+    cache_path = tmp_path / CACHE_FILE_NAME
+
+    # A report cached by an earlier scanner version is read again
+    file_stat = os.stat(file_path)
+    cache_path.write_text(json.dumps({file_path: {
+        'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'report': {'valid': False}
+    }}))
+    assert DirectoryScanner(threads=2).scan(str(tmp_path)) == [expected_report(file_path)]
+
+    # The refreshed cache is used as is for unchanged files
+    cache = json.loads(cache_path.read_text())
+    cache['files'][file_path]['report']['cached'] = True
+    cache_path.write_text(json.dumps(cache))
+    assert DirectoryScanner(threads=2).scan(str(tmp_path))[0]['cached'] is True
@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy.spatial.transform import Rotation
+
+from utils.isotropic_resampler import IsotropicResampler
+
+# Axis flips and rotations (radians about x, y and z) of the source affines
+AFFINE_KINDS = {
+    'axis_aligned': (False, False),
+    'flipped': (True, False),
+    'oblique': (False, True),
+    'flipped_oblique': (True, True),
+}
+SPACINGS = (0.8, 1.0, 1.2, 1.5, 2.0, 3.0)
+
+
+def make_image(rng: np.random.Generator, flipped: bool, oblique: bool, dtype) -> nib.Nifti1Image:
+    """A random anisotropic volume with values in 0-200."""
+    shape = tuple(int(x) for x in rng.integers(12, 40, 3))
+    flips = rng.choice([-1, 1], 3) if flipped else np.ones(3)
+    angles = rng.choice([0.1, -0.25, 0.4], 3) if oblique else np.zeros(3)
+
+    affine = np.eye(4)
+    affine[:3, :3] = Rotation.from_euler("xyz", angles).as_matrix() @ np.diag(flips * rng.choice(SPACINGS, 3))
+    affine[:3, 3] = rng.normal(0, 20, 3)
+    return nib.Nifti1Image((rng.random(shape) * 200).astype(dtype), affine)
+
+
+def reference(image: nib.Nifti1Image) -> nib.Nifti1Image:
+    """nilearn's resample_img with the options of the 'nilearn' ingest resampler."""
+    from nilearn.image import resample_img
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return resample_img(image, target_affine=np.eye(3), interpolation="linear", force_resample=True, copy_header=True)
+
+
+@pytest.mark.parametrize("kind", list(AFFINE_KINDS))
+@pytest.mark.parametrize("dtype", [np.float32, np.int16])
+def test_matches_nilearn(kind, dtype):
+    pytest.importorskip("nilearn")
+    rng = np.random.default_rng(5)
+    for _ in range(40):
+        image = make_image(rng, *AFFINE_KINDS[kind], dtype)
+        expected = reference(image)
+        resampled = IsotropicResampler.resample(image, voxel_size=1.0, threads=4)
+
+        assert resampled.shape == expected.shape
+        np.testing.assert_array_equal(resampled.affine, expected.affine)
+        # Edge voxels included: every sample falls on the same side of the volume's boundary
+        np.testing.assert_array_equal(np.asanyarray(resampled.dataobj), np.asanyarray(expected.dataobj))
+
+
+@pytest.mark.parametrize("threads", [1, 2, 7])
+def test_result_does_not_depend_on_threads(threads):
+    image = make_image(np.random.default_rng(11), True, True, np.float32)
+    single = IsotropicResampler.resample(image, threads=1)
+
+    np.testing.assert_array_equal(np.asanyarray(IsotropicResampler.resample(image, threads=threads).dataobj),
+                                  np.asanyarray(single.dataobj))
+
+
+def test_target_grid_covers_corners():
+    affine = np.diag([-1.5, 1.2, 3.0, 1.0])
+    affine[:3, 3] = [40.0, -10.0, 5.0]
+    target_affine, target_shape = IsotropicResampler.compute_target_grid(affine, (20, 30, 10), voxel_size=1.0)
+
+    np.testing.assert_array_equal(target_affine[:3, :3], np.eye(3))
+    np.testing.assert_allclose(target_affine[:3, 3], [40.0 - 19 * 1.5, -10.0, 5.0])
+    assert target_shape == (30, 36, 28)
@@ -0,0 +1,97 @@
+import gzip
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_reader
+from nifti_reader import NiftiReader, GzipIndex
+from output_writer import OutputWriter
+
+SHAPE = (40, 36, 30)
+
+# Bounding boxes crossing many members and checkpoints, single slices and single voxels
+REGIONS = [
+    (slice(None), slice(None), slice(None)),
+    (slice(None), slice(None), slice(29, 30)),
+    (slice(None), slice(None), slice(0, 1)),
+    (slice(3, 37), slice(5, 31), slice(7, 23)),
+    (slice(0, 40), slice(0, 36), slice(12, 13)),
+    (slice(None), slice(17, 18), slice(None)),
+    (slice(39, 40), slice(35, 36), slice(29, 30)),
+    (slice(1, 2), slice(2, 3), slice(3, 4)),
+    (slice(10, 20), slice(None), slice(5, 25)),
+]
+
+
+@pytest.fixture(autouse=True)
+def small_checkpoints(monkeypatch):
+    """Read 1 kB and checkpoint every 4 kB of streamed gzip, so the test volume spans many checkpoints."""
+    monkeypatch.setattr(nifti_reader, "CHECKPOINT_SPAN", 4 << 10)
+    monkeypatch.setattr(nifti_reader, "READ_CHUNK", 1 << 10)
+
+
+def make_image(dtype) -> nib.Nifti1Image:
+    rng = np.random.default_rng(7)
+    array = (rng.standard_normal(SHAPE) * 1000).astype(dtype)
+    return nib.Nifti1Image(array, np.diag([1.2, 1.0, 2.5, 1.0]))
+
+
+def write_standard(image: nib.Nifti1Image, file_path: str) -> None:
+    nib.save(image, file_path)
+
+
+def write_multi_member(image: nib.Nifti1Image, file_path: str) -> None:
+    """Concatenated gzip members of uneven sizes without size subfields, like 'cat a.gz b.gz'."""
+    raw_path = file_path[:-len(".gz")]
+    nib.save(image, raw_path)
+    with open(raw_path, "rb") as raw_ref:
+        data = raw_ref.read()
+    with open(file_path, "wb") as file_ref:
+        position, size = 0, 3000
+        while position < len(data):
+            file_ref.write(gzip.compress(data[position:position + size], compresslevel=1))
+            position += size
+            size = size * 3 // 2 + 517
+
+
+def write_block_gzip(image: nib.Nifti1Image, file_path: str) -> None:
+    OutputWriter(compress_level=1, threads=3, block_size=8 << 10).write_nifti(image, file_path)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32])
+@pytest.mark.parametrize("write", [write_standard, write_multi_member, write_block_gzip])
+def test_regions_match_nibabel(tmp_path, write, dtype):
+    file_path = str(tmp_path / "volume.nii.gz")
+    write(make_image(dtype), file_path)
+    expected = nib.load(file_path)
+
+    image = NiftiReader.load(file_path, threads=3)
+    assert image.shape == expected.shape
+    assert np.array_equal(image.affine, expected.affine)
+    assert image.get_data_dtype() == expected.get_data_dtype()
+
+    # Forward and then backward, so later reads resume from earlier checkpoints and cached members
+    for region in REGIONS + REGIONS[::-1]:
+        actual = np.asanyarray(image.dataobj[region])
+        reference = np.asanyarray(expected.dataobj[region])
+        assert actual.dtype == reference.dtype
+        assert np.array_equal(actual, reference)
+
+    # A fresh reader of the same file starts from the cached index
+    assert np.array_equal(np.asanyarray(NiftiReader.load(file_path, threads=1).dataobj), np.asanyarray(expected.dataobj))
+
+
+@pytest.mark.parametrize("write, has_members", [(write_standard, False), (write_multi_member, False), (write_block_gzip, True)])
+def test_index_kind(tmp_path, write, has_members):
+    file_path = str(tmp_path / "volume.nii.gz")
+    write(make_image(np.float32), file_path)
+    np.asanyarray(NiftiReader.load(file_path).dataobj)
+
+    index = GzipIndex.get(file_path)
+    if has_members:
+        assert len(index.members) > 10
+        assert index.size == sum(x[3] for x in index.members)
+    else:
+        assert index.members is None
+        assert len(index.checkpoints) > 10
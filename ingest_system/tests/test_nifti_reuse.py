@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+import phantoms
+from output_writer import OutputWriter
+from parameters import Becik4UParameters
+from utils.nifti_ingestion import NIFTIIngestion
+
+
+@pytest.fixture
+def params(tmp_path, monkeypatch):
+    monkeypatch.setenv("BECIK4U_ROOT", str(tmp_path / "root"))
+    monkeypatch.setenv("BECIK4U_CORE", str(tmp_path / "core"))
+    monkeypatch.setenv("FREESURFER_HOME", str(tmp_path / "freesurfer"))
+    return Becik4UParameters()
+
+
+def ingest(params: Becik4UParameters, scan_id: str, writer: OutputWriter) -> dict:
+    """Ingest the same phantom volume as scan_id and return its metadata."""
+    raw_root = os.path.join(params.get_root_scan_dir(scan_id), "raw", "nifti")
+    os.makedirs(raw_root, exist_ok=True)
+    phantoms.write_nifti(os.path.join(raw_root, "t1.nii.gz"), (24, 24, 20), (1.5, 1.5, 1.5))
+    NIFTIIngestion.internal_ingest(params, scan_id, "t1.nii.gz", writer=writer)
+    data_root = os.path.join(params.get_root_scan_dir(scan_id), "data")
+    return NIFTIIngestion.update_metadata(data_root, scan_id, {})
+
+
+def test_duplicate_reuses_outputs_with_same_writer(params):
+    ingest(params, "first", OutputWriter(compress_level=1, threads=1))
+    metadata = ingest(params, "second", OutputWriter(compress_level=1, threads=1))
+
+    assert metadata['reused_from'] == "first"
+    data_root = os.path.join(params.get_root_scan_dir("second"), "data")
+    assert os.path.isfile(os.path.join(data_root, "second_raw.npz"))
+    assert os.path.isfile(os.path.join(data_root, "second_sampled.nii.gz"))
+
+
+@pytest.mark.parametrize("writer_options", [{'numpy_format': "npy"}, {'compress_level': 6}])
+def test_duplicate_with_other_writer_settings_is_rewritten(params, writer_options):
+    ingest(params, "first", OutputWriter(compress_level=1, threads=1))
+    writer = OutputWriter(**{'compress_level': 1, 'threads': 1, **writer_options})
+    metadata = ingest(params, "second", writer)
+
+    assert metadata['reused_from'] is None
+    data_root = os.path.join(params.get_root_scan_dir("second"), "data")
+    assert os.path.isfile(writer.numpy_path(os.path.join(data_root, "second_raw")))
+    assert not os.path.samefile(os.path.join(data_root, "second_sampled.nii.gz"),
+                                os.path.join(params.get_root_scan_dir("first"), "data", "first_sampled.nii.gz"))
+
+    # A third ingest with the same settings reuses the rewritten scan
+    assert ingest(params, "third", writer)['reused_from'] == "second"
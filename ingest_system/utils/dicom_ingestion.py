@@ -1,8 +1,57 @@
+import io
 import os
+import time
+import errno
 import shutil
+import tarfile
+import hashlib
+import zipfile
+import threading
+import unicodedata
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from loguru import logger
-import dicom2nifti
 from parameters import Becik4UParameters
+from telemetry import Telemetry
+from scan_index import ScanIndex
+
+# Staging modes, cheapest first; links and reflinks are only tried on the same filesystem
+STAGING_MODES = ("reflink", "hardlink", "copy")
+
+# ioctl(2) request cloning a whole file (Linux FICLONE, btrfs/XFS/bcachefs)
+FICLONE = 0x40049409
+
+# Errors meaning a staging mode is not available for this source and destination
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EOPNOTSUPP, errno.ENOTTY,
+                      errno.EINVAL, errno.EMLINK, errno.ENOSYS)
+
+# Tags read by the header-only scan: series grouping, output naming and the image check
+SERIES_TAGS = ["SeriesInstanceUID", "SeriesNumber", "SeriesDescription", "SequenceName", "ProtocolName", "Rows"]
+
+# Characters dicom2nifti keeps in the NIfTI file names it derives from the series
+FILE_NAME_CHARACTERS = frozenset("-_.() 0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+
+def _convert_series(files: list[str], nifti_file: str) -> dict:
+    """
+    Converts one series in a worker process.
+
+    Returns:
+        dict: 'seconds' of the conversion and the worker's peak RSS in bytes.
+    """
+    import resource
+    import dicom2nifti
+    from dicom2nifti import compressed_dicom, convert_dicom
+
+    start = time.perf_counter()
+    dicom_input = [compressed_dicom.read_file(x, defer_size="1 KB", stop_before_pixels=False,
+                                              force=dicom2nifti.settings.pydicom_read_force) for x in files]
+    convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, True)
+    return {
+        'seconds': round(time.perf_counter() - start, 3),
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
 
 class DICOMIngestion:
     """
@@ -10,20 +59,405 @@ class DICOMIngestion:
     """
 
     @staticmethod
-    def ingest_and_convert(params: Becik4UParameters, id: str, source_root: str) -> str:
+    def _reflink(source: str, target: str) -> None:
+        """Clone a file into a new copy-on-write file sharing its blocks."""
+        import fcntl
+
+        with open(source, "rb") as source_ref, open(target, "wb") as target_ref:
+            fcntl.ioctl(target_ref.fileno(), FICLONE, source_ref.fileno())
+
+    @staticmethod
+    def _stage_file(source: str, target: str, mode: str) -> None:
+        """Stage one file with the given mode, replacing (not overwriting) an older staged file."""
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            if mode == "copy":
+                shutil.copy2(source, target)
+            elif mode == "reflink":
+                DICOMIngestion._reflink(source, target)
+            else:
+                os.link(source, target)
+        except OSError:
+            if os.path.lexists(target):
+                os.remove(target)
+            raise
+
+    @staticmethod
+    def stage_files(source_root: str, target_root: str, threads: int = None) -> dict:
+        """
+        Stages a DICOM tree into the scan directory without copying its bytes when possible.
+
+        On the same filesystem every file is reflinked (copy-on-write clone) or, where reflinks
+        are not supported, hardlinked; otherwise files are copied in a thread pool. The first
+        mode that fails as unsupported is not tried again for the following files. Files
+        already linked by an earlier ingest are skipped.
+
+        Args:
+            source_root (str): The source directory of DICOM files.
+            target_root (str): The raw DICOM directory of the scan.
+            threads (int): Threads copying files (defaults to min(32, CPUs + 4)).
+
+        Returns:
+            dict: 'files', 'bytes', 'seconds' and the number of files per mode ('modes').
+        """
+        start = time.perf_counter()
+        pairs = []
+        for root, dirs, names in os.walk(source_root, followlinks=True):
+            target_dir = os.path.join(target_root, os.path.relpath(root, source_root))
+            os.makedirs(target_dir, exist_ok=True)
+            pairs.extend((os.path.join(root, x), os.path.join(target_dir, x)) for x in names)
+
+        same_filesystem = os.stat(source_root).st_dev == os.stat(target_root).st_dev
+        modes = list(STAGING_MODES if same_filesystem else STAGING_MODES[-1:])
+        counts = {x: 0 for x in STAGING_MODES + ("skipped",)}
+        lock = threading.Lock()
+
+        def stage(pair: tuple[str, str]) -> int:
+            source, target = pair
+            if os.path.exists(target) and os.path.samefile(source, target):
+                used = "skipped"
+            else:
+                while True:
+                    used = modes[0]
+                    try:
+                        DICOMIngestion._stage_file(source, target, used)
+                        break
+                    except OSError as error_exc:
+                        if used == "copy" or error_exc.errno not in UNSUPPORTED_ERRNOS:
+                            raise
+                        with lock:
+                            if modes[0] == used:
+                                modes.pop(0)
+            with lock:
+                counts[used] += 1
+            return os.path.getsize(target)
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            total_bytes = sum(executor.map(stage, pairs))
+
+        return {
+            'files': len(pairs),
+            'bytes': total_bytes,
+            'seconds': round(time.perf_counter() - start, 3),
+            'modes': {x: y for x, y in counts.items() if y},
+        }
+
+    @staticmethod
+    def series_file_name(header) -> str:
+        """
+        Derives the NIfTI file name of a series the same way dicom2nifti.convert_directory does.
+
+        Args:
+            header (pydicom.Dataset): Header of one file of the series.
+
+        Returns:
+            str: The file name without extension.
+        """
+        if 'SeriesNumber' in header:
+            name = f"{header.SeriesNumber}"
+            for keyword in ("SeriesDescription", "SequenceName", "ProtocolName"):
+                if keyword in header:
+                    name = f"{name}_{header.get(keyword)}"
+                    break
+        else:
+            name = f"{header.SeriesInstanceUID}"
+
+        ascii_name = unicodedata.normalize('NFKD', name).encode('ASCII', 'ignore').decode()
+        return "".join(x for x in ascii_name if x in FILE_NAME_CHARACTERS)
+
+    @staticmethod
+    def read_header(source):
+        """
+        Reads the series tags of a DICOM file, up to its pixel data.
+
+        Args:
+            source (str | file-like): Path or open binary file.
+
+        Returns:
+            pydicom.Dataset: The header, or None for non-DICOM and non-image files.
+        """
+        import pydicom
+        import dicom2nifti
+
+        try:
+            header = pydicom.dcmread(source, stop_before_pixels=True, specific_tags=SERIES_TAGS,
+                                     force=dicom2nifti.settings.pydicom_read_force)
+        except Exception:
+            return None
+        if 'SeriesInstanceUID' not in header or 'Rows' not in header:
+            return None
+        return header
+
+    @staticmethod
+    def pixel_record(source) -> tuple[str, str]:
+        """
+        Reads the SOPInstanceUID and a digest of the pixel data of a DICOM file.
+
+        Args:
+            source (str | file-like): Path or open binary file.
+
+        Returns:
+            tuple[str, str]: The SOPInstanceUID and the hex digest of the (possibly encapsulated) pixel data.
+        """
+        import pydicom
+        import dicom2nifti
+
+        dataset = pydicom.dcmread(source, specific_tags=["SOPInstanceUID", "PixelData"],
+                                  force=dicom2nifti.settings.pydicom_read_force)
+        pixel_data = dataset.get("PixelData") or b""
+        return str(dataset.get("SOPInstanceUID", "")), hashlib.blake2b(pixel_data, digest_size=20).hexdigest()
+
+    @staticmethod
+    def fingerprint_series(series: dict, threads: int = None) -> None:
+        """
+        Adds the content 'fingerprint' of every series: its sorted SOPInstanceUIDs and pixel data digests.
+
+        Args:
+            series (dict): Series from group_series, updated in place.
+            threads (int): Threads reading files (defaults to min(32, CPUs + 4)).
+        """
+        files = [x for entry in series.values() for x in entry['files']]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            records = dict(zip(files, executor.map(DICOMIngestion.pixel_record, files)))
+        for entry in series.values():
+            entry['fingerprint'] = ScanIndex.series_fingerprint([records[x] for x in entry['files']])
+
+    @staticmethod
+    def reuse_series(params: Becik4UParameters, index: ScanIndex, id: str, series: dict, nifti_root: str) -> list[dict]:
+        """
+        Links the NIfTI files of series another scan already converted, and removes them from ``series``.
+
+        Args:
+            params (Becik4UParameters): Instance of the Becik4UParameters class.
+            index (ScanIndex): The fingerprint index.
+            id (str): The identifier for the scan.
+            series (dict): Fingerprinted series, the reused ones are removed.
+            nifti_root (str): The raw NIfTI directory of the scan.
+
+        Returns:
+            list[dict]: One report per reused series, like convert_series with 'status' 'reused' and 'reused_from'.
+        """
+        reports = []
+        for uid, entry in list(series.items()):
+            for record in index.lookup("dicom_series", entry['fingerprint'], exclude=id):
+                source_file = os.path.join(params.get_root_scan_dir(record['scan_id']), "raw", "nifti", record['nifti_file'])
+                if not os.path.isfile(source_file):
+                    continue
+
+                nifti_file = os.path.join(nifti_root, f"{entry['name']}.nii.gz")
+                ScanIndex.link_file(source_file, nifti_file)
+                reports.append({'series_uid': uid, 'name': entry['name'], 'files': len(entry['files']), 'nifti_file': nifti_file,
+                                'fingerprint': entry['fingerprint'], 'status': 'reused', 'reused_from': record['scan_id']})
+                logger.info(f"REUSED SERIES {entry['name']} FROM {record['scan_id']}")
+                del series[uid]
+                break
+        return reports
+
+    @staticmethod
+    def _collect_series(headers: list[tuple]) -> dict:
+        """Group (file path, header) pairs by SeriesInstanceUID and give every series a unique output name."""
+        series = {}
+        for file_path, header in headers:
+            uid = str(header.SeriesInstanceUID)
+            if uid not in series:
+                series[uid] = {'name': DICOMIngestion.series_file_name(header), 'files': []}
+            series[uid]['files'].append(file_path)
+
+        # Series sharing a name would overwrite each other's output
+        names = {}
+        for entry in series.values():
+            count = names.get(entry['name'], 0)
+            names[entry['name']] = count + 1
+            if count:
+                entry['name'] = f"{entry['name']}_{count}"
+        return series
+
+    @staticmethod
+    def group_series(dicom_root: str, threads: int = None) -> tuple[dict, int]:
+        """
+        Groups the DICOM files of a directory into series from a header-only scan.
+
+        Only the tags in SERIES_TAGS are parsed and pixel data is never read. Files that are not
+        DICOM, or not images (no 'Rows'), are skipped like dicom2nifti does.
+
+        Args:
+            dicom_root (str): The raw DICOM directory of the scan.
+            threads (int): Threads reading headers (defaults to min(32, CPUs + 4)).
+
+        Returns:
+            tuple[dict, int]: SeriesInstanceUID -> {'name', 'files'}, and the number of skipped files.
+        """
+        files = sorted(os.path.join(root, x) for root, _, names in os.walk(dicom_root) for x in names)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            headers = list(executor.map(DICOMIngestion.read_header, files))
+
+        series = DICOMIngestion._collect_series([(x, y) for x, y in zip(files, headers) if y is not None])
+        return series, len(files) - sum(len(x['files']) for x in series.values())
+
+    @staticmethod
+    def is_archive(source: str) -> bool:
+        """Whether a DICOM source is a zip or tar (optionally gzip/bzip2/xz compressed) archive."""
+        return os.path.isfile(source) and (zipfile.is_zipfile(source) or tarfile.is_tarfile(source))
+
+    @staticmethod
+    def archive_members(archive_path: str):
+        """
+        Reads the regular files of a zip or tar archive one after another, without extracting it.
+
+        Tar archives are opened as a stream, so compressed tars are decompressed in a single pass.
+
+        Yields:
+            tuple[str, bytes]: The member name and its content.
+        """
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as zip_ref:
+                for info in zip_ref.infolist():
+                    if not info.is_dir():
+                        yield info.filename, zip_ref.read(info)
+            return
+
+        with tarfile.open(archive_path, "r|*") as tar_ref:
+            for member in tar_ref:
+                if member.isfile():
+                    yield member.name, tar_ref.extractfile(member).read()
+
+    @staticmethod
+    def stage_archive(archive_path: str, target_root: str, threads: int = None) -> tuple[dict, dict, int]:
+        """
+        Stages the DICOM files of an archive into the scan directory and groups them into series.
+
+        Every member is read once into memory, its header is parsed from that buffer and DICOM
+        image members are written once to the same relative path under the raw DICOM directory,
+        on writer threads while the next members are read. The writer threads also digest the
+        pixel data from the buffer, so the series come back fingerprinted (see fingerprint_series).
+        Non-DICOM members and members whose path leaves the directory are skipped, and of
+        members repeating a path only the last one is kept.
+
+        Args:
+            archive_path (str): The zip or tar archive of DICOM files.
+            target_root (str): The raw DICOM directory of the scan.
+            threads (int): Threads writing files (defaults to min(32, CPUs + 4)).
+
+        Returns:
+            tuple[dict, dict, int]: The staging summary (see stage_files), the fingerprinted series
+                (see group_series) and the number of skipped members.
+        """
+        start = time.perf_counter()
+        headers, sizes, futures = {}, {}, {}
+        members = 0
+        pending = threading.BoundedSemaphore((threads or min(32, (os.cpu_count() or 1) + 4)) * 2)
+
+        def write(file_path: str, data: bytes) -> tuple[str, str]:
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(f"{file_path}.part", "wb") as file_ref:
+                    file_ref.write(data)
+                # Replace, so a file hardlinked by an earlier directory ingest is not overwritten
+                os.replace(f"{file_path}.part", file_path)
+                return DICOMIngestion.pixel_record(io.BytesIO(data))
+            finally:
+                pending.release()
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for name, data in DICOMIngestion.archive_members(archive_path):
+                members += 1
+                relative_path = os.path.normpath(name.lstrip("/"))
+                if relative_path == ".." or relative_path.startswith("../"):
+                    continue
+                header = DICOMIngestion.read_header(io.BytesIO(data))
+                if header is None:
+                    continue
+
+                # A tar may repeat a name, the last member wins like on extraction
+                file_path = os.path.join(target_root, relative_path)
+                if file_path in futures:
+                    futures[file_path].result()
+                headers[file_path] = header
+                sizes[file_path] = len(data)
+                pending.acquire()
+                futures[file_path] = executor.submit(write, file_path, data)
+
+            records = {x: future.result() for x, future in futures.items()}
+
+        staging = {
+            'files': len(headers),
+            'bytes': sum(sizes.values()),
+            'seconds': round(time.perf_counter() - start, 3),
+            'modes': {'extract': len(headers)} if headers else {},
+        }
+        series = DICOMIngestion._collect_series(list(headers.items()))
+        for entry in series.values():
+            entry['fingerprint'] = ScanIndex.series_fingerprint([records[x] for x in entry['files']])
+        return staging, series, members - len(headers)
+
+    @staticmethod
+    def convert_series(series: dict, nifti_root: str, workers: int = None) -> list[dict]:
+        """
+        Converts every series in its own worker process, largest series first.
+
+        A series that fails is reported and does not stop the others, like dicom2nifti.convert_directory.
+
+        Args:
+            series (dict): Series from group_series.
+            nifti_root (str): The raw NIfTI directory of the scan.
+            workers (int): Worker processes (defaults to the available CPUs).
+
+        Returns:
+            list[dict]: One report per series: 'series_uid', 'name', 'files', 'nifti_file', 'fingerprint',
+                'status', 'seconds' and 'max_rss_bytes' or 'error'.
+        """
+        workers = min(workers or len(os.sched_getaffinity(0)), len(series))
+        ordered = sorted(series.items(), key=lambda x: len(x[1]['files']), reverse=True)
+        reports = []
+
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            futures = {}
+            for uid, entry in ordered:
+                nifti_file = os.path.join(nifti_root, f"{entry['name']}.nii.gz")
+                future = executor.submit(_convert_series, entry['files'], nifti_file)
+                futures[future] = {'series_uid': uid, 'name': entry['name'], 'files': len(entry['files']), 'nifti_file': nifti_file,
+                                   'fingerprint': entry.get('fingerprint')}
+
+            for future in as_completed(futures):
+                report = futures[future]
+                try:
+                    report.update({'status': 'ok', **future.result()})
+                    logger.info(f"CONVERTED SERIES {report['name']} ({report['files']} files, {report['seconds']} s)")
+                except Exception as error_exc:
+                    report.update({'status': 'failed', 'error': str(error_exc)})
+                    logger.warning(f"Unable to convert series {report['name']}: {error_exc}")
+                reports.append(report)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        order = {uid: index for index, (uid, _) in enumerate(ordered)}
+        return sorted(reports, key=lambda x: order[x['series_uid']])
+
+    @staticmethod
+    def ingest_and_convert(params: Becik4UParameters, id: str, source_root: str, telemetry: Telemetry = None,
+                           workers: int = None) -> dict:
         """
         Ingest DICOM files, convert them to NIfTI, and store them in the appropriate directory.
 
+        Series whose fingerprint matches a series another scan already converted are not
+        converted again: that scan's NIfTI file is linked in instead.
+
         Args:
             params (Becik4UParameters): Instance of the Becik4UParameters class.
             id (str): The identifier for the scan.
-            source_root (str): The source directory of DICOM files.
+            source_root (str): The source directory of DICOM files, or a zip/tar archive of them.
+            telemetry (Telemetry): Recorder of per-step resource usage, one 'ingest' event per step.
+            workers (int): Worker processes converting series in parallel (defaults to the available CPUs).
 
         Returns:
-            str: Path to the converted NIfTI files.
+            dict: 'nifti_root' (path to the converted NIfTI files), 'staging' (see stage_files),
+                'skipped_files' (non-DICOM files or members) and 'series' (see convert_series).
         """
+        telemetry = (telemetry or Telemetry()).bind(scan_id=id)
         root_scan_dir = params.get_root_scan_dir(id)
-        
+
         # Define directories for DICOM and NIfTI storage
         raw_dicom_root = os.path.join(root_scan_dir, "raw", "dicom")
         os.makedirs(raw_dicom_root, exist_ok=True)
@@ -31,11 +465,48 @@ class DICOMIngestion:
         raw_nifti_root = os.path.join(root_scan_dir, "raw", "nifti")
         os.makedirs(raw_nifti_root, exist_ok=True)
 
-        logger.info("COPYING RAW FILES")
         source_root = os.path.abspath(source_root)
-        shutil.copytree(source_root, raw_dicom_root, dirs_exist_ok=True)
-        
-        logger.info("CONVERTING TO NIFTI")
-        dicom2nifti.convert_directory(raw_dicom_root, raw_nifti_root)
+        if DICOMIngestion.is_archive(source_root):
+            logger.info("STAGING AND GROUPING ARCHIVE MEMBERS")
+            with telemetry.measure("stage", event="ingest", source="archive"):
+                staging, series, skipped_files = DICOMIngestion.stage_archive(source_root, raw_dicom_root)
+            logger.info(f"STAGED {staging['files']} FILES {staging['modes']}")
+        else:
+            logger.info("STAGING RAW FILES")
+            with telemetry.measure("stage", event="ingest"):
+                staging = DICOMIngestion.stage_files(source_root, raw_dicom_root)
+            logger.info(f"STAGED {staging['files']} FILES {staging['modes']}")
+
+            logger.info("GROUPING SERIES")
+            with telemetry.measure("group", event="ingest"):
+                series, skipped_files = DICOMIngestion.group_series(raw_dicom_root)
+
+            logger.info("FINGERPRINTING SERIES")
+            with telemetry.measure("fingerprint", event="ingest"):
+                DICOMIngestion.fingerprint_series(series)
+        if not series:
+            raise Exception(f"No DICOM image series found in {source_root}")
+
+        index = ScanIndex(params)
+        order = list(series)
+        reports = DICOMIngestion.reuse_series(params, index, id, series, raw_nifti_root)
+
+        if series:
+            logger.info(f"CONVERTING {len(series)} SERIES TO NIFTI")
+            with telemetry.measure("convert", event="ingest"):
+                reports += DICOMIngestion.convert_series(series, raw_nifti_root, workers)
+        if all(x['status'] == 'failed' for x in reports):
+            raise Exception(f"None of the {len(reports)} DICOM series could be converted")
+
+        for report in reports:
+            if report['status'] != 'failed':
+                index.register("dicom_series", report['fingerprint'], id, name=report['name'],
+                               nifti_file=os.path.basename(report['nifti_file']))
+        reports.sort(key=lambda x: order.index(x['series_uid']))
 
-        return raw_nifti_root
+        return {
+            'nifti_root': raw_nifti_root,
+            'staging': staging,
+            'skipped_files': skipped_files,
+            'series': reports,
+        }
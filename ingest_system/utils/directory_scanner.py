@@ -0,0 +1,174 @@
+import os
+import json
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+# NIfTI-2 headers are the larger of both formats
+HEADER_BYTES = 540
+CACHE_FILE_NAME = ".becik4u_report_cache.json"
+
+# Reports cached by another version of the scanner are read again
+CACHE_VERSION = 2
+
+
+class DirectoryScanner:
+    """
+    A class that reports NIfTI header information for every file in a directory.
+
+    Headers are read in a thread pool, gzip files are only inflated up to the end of the
+    header, and results are kept in a sidecar cache keyed by (path, size, mtime).
+    """
+
+    def __init__(self, threads: int = None):
+        """
+        Initializes the scanner.
+
+        Args:
+            threads (int): Worker threads for header reads (defaults to min(32, CPUs + 4)).
+        """
+        self.threads = threads
+
+    @staticmethod
+    def read_header_bytes(file_path: str, length: int = HEADER_BYTES) -> bytes:
+        """
+        Reads the first bytes of a NIfTI file, inflating only what is needed for '.gz' files.
+
+        Args:
+            file_path (str): Path to the NIfTI file.
+            length (int): Number of uncompressed bytes to read.
+
+        Returns:
+            bytes: Up to `length` bytes from the start of the (uncompressed) file.
+        """
+        with open(file_path, "rb") as file_ref:
+            if not file_path.endswith(".gz"):
+                return file_ref.read(length)
+
+            inflater = zlib.decompressobj(wbits=31)
+            header = b""
+            while len(header) < length:
+                chunk = inflater.unconsumed_tail or file_ref.read(4096)
+                if not chunk:
+                    break
+                header += inflater.decompress(chunk, length - len(header))
+            return header
+
+    @staticmethod
+    def get_header_info(file_path: str) -> dict:
+        """
+        Retrieves the report of a NIfTI file from its header only, without reading the image data.
+
+        Args:
+            file_path (str): Path to the NIfTI file.
+
+        Returns:
+            dict: 'fname', 'full_path' and 'valid'; valid files also have 'dshape' (data shape),
+                'dtype' (data type) and 'dsize' (voxel size in mm, rounded to 3 decimals).
+        """
+        fname = os.path.basename(file_path)
+
+        # Initialize report dictionary
+        report = {
+            'fname': fname,
+            'full_path': os.path.abspath(file_path),
+            'valid': False
+        }
+
+        try:
+            # Check if the file is valid or not
+            if not fname.endswith(('nii', 'nii.gz')):
+                raise Exception("Invalid File Format")
+
+            import nibabel as nib
+
+            raw_header = DirectoryScanner.read_header_bytes(file_path)
+            sizeof_hdr = int.from_bytes(raw_header[:4], "little")
+            if sizeof_hdr not in (348, 540):
+                sizeof_hdr = int.from_bytes(raw_header[:4], "big")
+            header_class = nib.Nifti2Header if sizeof_hdr == 540 else nib.Nifti1Header
+            if len(raw_header) < header_class.sizeof_hdr:
+                raise Exception("Truncated NIfTI header")
+
+            # Only the fixed header is parsed, extensions after it are not read
+            nifti_header = header_class(raw_header[:header_class.sizeof_hdr], check=True)
+
+            data_shape = [int(x) for x in nifti_header.get_data_shape()]
+            data_voxel = [round(float(x), 3) for x in nifti_header.get_zooms()]
+
+            # Populate report with metadata
+            report['dshape'] = data_shape
+            report['dtype'] = str(nifti_header.get_data_dtype())
+            report['dsize'] = data_voxel
+            report['valid'] = True
+
+        except Exception as e:
+            logger.error(f"Error processing file {file_path}: {str(e)}")
+
+        return report
+
+    @staticmethod
+    def _load_cache(cache_path: str) -> dict:
+        """Load the sidecar cache, ignoring a missing, corrupt or outdated file."""
+        try:
+            with open(cache_path) as jsn_ref:
+                cache = json.load(jsn_ref)
+            if cache.get('version') == CACHE_VERSION:
+                return cache['files']
+        except (OSError, ValueError, AttributeError, KeyError):
+            pass
+        return {}
+
+    @staticmethod
+    def _save_cache(cache_path: str, cache: dict) -> None:
+        """Atomically write the sidecar cache; a read-only directory just skips caching."""
+        try:
+            temp_path = f"{cache_path}.tmp"
+            with open(temp_path, "w") as jsn_ref:
+                json.dump({'version': CACHE_VERSION, 'files': cache}, jsn_ref)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write report cache {cache_path}: {str(e)}")
+
+    def scan(self, root_dir: str) -> list[dict]:
+        """
+        Reports every file of a directory, reusing cached reports for unchanged files.
+
+        Args:
+            root_dir (str): Directory to scan.
+
+        Returns:
+            list[dict]: One report per file, in directory listing order.
+        """
+        full_path = os.path.abspath(root_dir)
+        cache_path = os.path.join(full_path, CACHE_FILE_NAME)
+        cache = self._load_cache(cache_path)
+
+        files = [os.path.join(full_path, x) for x in os.listdir(full_path) if x not in (CACHE_FILE_NAME, f"{CACHE_FILE_NAME}.tmp")]
+        fresh_cache = {}
+        cache_lock = threading.Lock()
+
+        def report_file(file_path: str) -> dict:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                return self.get_header_info(file_path)
+
+            entry = cache.get(file_path)
+            if entry is not None and entry['size'] == file_stat.st_size and entry['mtime_ns'] == file_stat.st_mtime_ns:
+                report = entry['report']
+            else:
+                report = self.get_header_info(file_path)
+
+            with cache_lock:
+                fresh_cache[file_path] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'report': report}
+            return report
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            report = list(executor.map(report_file, files))
+
+        if fresh_cache != cache:
+            self._save_cache(cache_path, fresh_cache)
+
+        return report
@@ -1,9 +1,13 @@
 import os
-import nibabel as nib
+import json
 import numpy as np
-from nilearn.image import resample_img
 from loguru import logger
 from parameters import Becik4UParameters
+from output_writer import OutputWriter
+from telemetry import Telemetry
+from scan_index import ScanIndex
+from nifti_reader import NiftiReader
+from .isotropic_resampler import IsotropicResampler
 
 
 class NIFTIIngestion:
@@ -12,7 +16,8 @@ class NIFTIIngestion:
     """
 
     @staticmethod
-    def internal_ingest(params: Becik4UParameters, id: str, file_name: str) -> None:
+    def internal_ingest(params: Becik4UParameters, id: str, file_name: str, writer: OutputWriter = None, volume_index: int = 0,
+                        resampler: str = "builtin", telemetry: Telemetry = None) -> None:
         """
         Ingest NIfTI files already present in the Becik4U system.
 
@@ -20,24 +25,45 @@ class NIFTIIngestion:
             params (Becik4UParameters): Instance of the Becik4UParameters class.
             id (str): The identifier for the scan.
             file_name (str): The name of the NIfTI file to ingest.
+            writer (OutputWriter): Writer for the ingested outputs (defaults to OutputWriter()).
+            volume_index (int): Volume to ingest from a 4D (or higher) series.
+            resampler (str): 'builtin' (multi-threaded) or 'nilearn' (reference) isotropic resampler.
+            telemetry (Telemetry): Recorder of per-step resource usage.
         """
         root_scan_dir = params.get_root_scan_dir(id)    
         raw_nifti_root = os.path.join(root_scan_dir, "raw", "nifti")
         internal_file = os.path.join(raw_nifti_root, file_name)
 
         # Process the NIfTI file
-        NIFTIIngestion._process_nifti(params, id, internal_file)
+        NIFTIIngestion._process_nifti(params, id, internal_file, writer, volume_index, resampler, telemetry)
 
     @staticmethod
-    def _process_nifti(params: Becik4UParameters, id: str, file_path: str) -> None:
+    def _process_nifti(params: Becik4UParameters, id: str, file_path: str, writer: OutputWriter = None, volume_index: int = 0,
+                      resampler: str = "builtin", telemetry: Telemetry = None) -> None:
         """
         Processes and resamples a NIfTI file, converting it into the appropriate format.
 
+        For 4D (or higher) series only the selected volume is read from the file, in its
+        native dtype, and only that 3D volume is resampled.
+
+        The volume is fingerprinted from its voxel data and affine. When another scan was
+        ingested with the same fingerprint, resampler and writer settings, its data outputs (and
+        the pipeline manifest, so preprocessing reuses its stages) are linked in instead of being
+        rewritten.
+
         Args:
             params (Becik4UParameters): Instance of the Becik4UParameters class.
             id (str): The identifier for the scan.
             file_path (str): Path to the NIfTI file.
+            writer (OutputWriter): Writer for the ingested outputs (defaults to OutputWriter()).
+            volume_index (int): Volume to ingest from a 4D (or higher) series, in flattened order.
+            resampler (str): 'builtin' (multi-threaded) or 'nilearn' (reference) isotropic resampler.
+            telemetry (Telemetry): Recorder of per-step resource usage, one 'ingest' event per step.
         """
+        import nibabel as nib
+
+        writer = writer or OutputWriter()
+        telemetry = (telemetry or Telemetry()).bind(scan_id=id)
         logger.info("PROCESSING NIFTI FILE")
         root_scan_dir = params.get_root_scan_dir(id)
 
@@ -47,87 +73,149 @@ class NIFTIIngestion:
 
         # Load NIfTI file and convert to numpy array
         try:
-            nifti_img = nib.load(file_path)
+            nifti_img = NiftiReader.load(file_path, writer.threads)
         except Exception as e:
             logger.error(f"Failed to load NIfTI file: {file_path} - {str(e)}")
             raise
 
-        image_array = nifti_img.get_fdata()
-        image_axis = image_array.shape
+        image_axis = nifti_img.shape
 
         # Validate dimensions
         if len(image_axis) < 3:
             logger.error("Data has less than 3 dimensions, please upload correct data.")
             raise Exception("Data has less than 3 dimensions, please upload correct data.")
-        
-        # Resample if needed
-        if len(image_axis) > 3:
-            while len(image_axis) > 3:
-                image_array = image_array[0]
-                image_axis = image_array.shape
-        
-        # Save as numpy compressed file
-        npy_path = os.path.join(data_root, f"{id}_raw.npz")
-        np.savez_compressed(npy_path, image_array=image_array)
-
-        # Resample the image
-        target_affine = np.diag([1.0, 1.0, 1.0])
-        resampled_img = resample_img(
-            nifti_img, 
-            target_affine=target_affine,
-            interpolation='linear',
-            force_resample=True,
-            copy_header=True
-        )
+
+        # Select a single volume from the series
+        n_volumes = int(np.prod(image_axis[3:], dtype=np.int64))
+        if not 0 <= volume_index < n_volumes:
+            logger.error(f"Volume index {volume_index} out of range, the series has {n_volumes} volumes.")
+            raise Exception(f"Volume index {volume_index} out of range, the series has {n_volumes} volumes.")
+
+        with telemetry.measure("read", event="ingest"):
+            if len(image_axis) > 3:
+                volume_slicer = (slice(None),) * 3 + tuple(int(x) for x in np.unravel_index(volume_index, image_axis[3:]))
+                image_array = np.asanyarray(nifti_img.dataobj[volume_slicer])
+            else:
+                image_array = np.asanyarray(nifti_img.dataobj)
+
+        # Reuse the outputs of an identical, already ingested scan
+        index = ScanIndex(params)
+        with telemetry.measure("fingerprint", event="ingest"):
+            fingerprint = ScanIndex.array_fingerprint(image_array, nifti_img.affine)
+        donor_id = NIFTIIngestion.find_donor(params, index, id, fingerprint, resampler, writer)
+
+        metadata = {
+            'source_file': os.path.basename(file_path),
+            'source_shape': [int(x) for x in image_axis],
+            'source_dtype': str(nifti_img.get_data_dtype()),
+            'n_volumes': n_volumes,
+            'volume_index': volume_index,
+            'resampler': resampler,
+            'fingerprint': fingerprint,
+            'reused_from': donor_id,
+        }
+
+        if donor_id is not None:
+            with telemetry.measure("reuse", event="ingest", donor=donor_id):
+                donor_root = os.path.join(params.get_root_scan_dir(donor_id), "data")
+                ScanIndex.link_outputs(donor_root, donor_id, data_root, id, exclude=("metadata.json",))
+            NIFTIIngestion.update_metadata(data_root, id, metadata)
+            index.register("nifti", fingerprint, id, resampler=resampler, numpy_format=writer.numpy_format,
+                           compress_level=writer.compress_level)
+            return
+
+        volume_img = nib.Nifti1Image(image_array, affine=nifti_img.affine, header=nifti_img.header)
+
+        # Save as numpy file
+        with telemetry.measure("write_raw", event="ingest"):
+            npy_path = writer.numpy_path(os.path.join(data_root, f"{id}_raw"))
+            writer.write_numpy(image_array, npy_path)
+
+        # Resample the image to 1 mm isotropic voxels
+        with telemetry.measure("resample", event="ingest", resampler=resampler):
+            if resampler == "nilearn":
+                from nilearn.image import resample_img
+                resampled_img = resample_img(
+                    volume_img,
+                    target_affine=np.diag([1.0, 1.0, 1.0]),
+                    interpolation='linear',
+                    force_resample=True,
+                    copy_header=True
+                )
+            elif resampler == "builtin":
+                resampled_img = IsotropicResampler.resample(volume_img, voxel_size=1.0, threads=writer.threads)
+            else:
+                logger.error(f"Unknown resampler '{resampler}'")
+                raise Exception(f"Unknown resampler '{resampler}'")
 
         # Save resampled version
-        resampled_path = os.path.join(data_root, f"{id}_sampled.nii.gz")
-        nib.save(resampled_img, resampled_path)
+        with telemetry.measure("write_sampled", event="ingest"):
+            resampled_path = os.path.join(data_root, f"{id}_sampled.nii.gz")
+            writer.write_nifti(resampled_img, resampled_path)
+
+        # Record which volume of the source was ingested
+        NIFTIIngestion.update_metadata(data_root, id, metadata)
+        index.register("nifti", fingerprint, id, resampler=resampler, numpy_format=writer.numpy_format,
+                           compress_level=writer.compress_level)
 
     @staticmethod
-    def get_nifti_file_info(file_path: str) -> dict:
+    def find_donor(params: Becik4UParameters, index: ScanIndex, id: str, fingerprint: str, resampler: str,
+                   writer: OutputWriter = None) -> str:
         """
-        Retrieves metadata and validation information for a NIfTI file.
+        Finds an ingested scan whose outputs can be reused, preferring ones already preprocessed.
+
+        The donor must have been written with the same numpy format and compression level, so the
+        linked outputs are the files this ingest would write.
 
         Args:
-            file_path (str): Path to the NIfTI file.
+            params (Becik4UParameters): Instance of the Becik4UParameters class.
+            index (ScanIndex): The fingerprint index.
+            id (str): The identifier for the scan being ingested.
+            fingerprint (str): Fingerprint of the ingested volume.
+            resampler (str): Isotropic resampler of this ingest, outputs of another resampler differ.
+            writer (OutputWriter): Writer of this ingest (defaults to OutputWriter()).
 
         Returns:
-            dict: A dictionary containing metadata about the NIfTI file, including shape, data type, and voxel size.
+            str: The donor scan ID, or None.
         """
-        fname = os.path.basename(file_path)
-
-        # Initialize report dictionary
-        report = {
-            'fname': fname,
-            'full_path': os.path.abspath(file_path),
-            'valid': False
-        }
+        writer = writer or OutputWriter()
+        settings = {'resampler': resampler, 'numpy_format': writer.numpy_format, 'compress_level': writer.compress_level}
+        candidates = []
+        for record in index.lookup("nifti", fingerprint, exclude=id):
+            donor_id = record['scan_id']
+            donor_root = os.path.join(params.get_root_scan_dir(donor_id), "data")
+            if any(record.get(x) != value for x, value in settings.items()):
+                continue
+            donor_files = (os.path.join(donor_root, f"{donor_id}_sampled.nii.gz"), writer.numpy_path(os.path.join(donor_root, f"{donor_id}_raw")))
+            if not all(os.path.isfile(x) for x in donor_files):
+                continue
+            processed = os.path.isfile(os.path.join(donor_root, f"{donor_id}_manifest.json"))
+            candidates.append((not processed, donor_id))
+
+        if not candidates:
+            return None
+        return min(candidates, key=lambda x: x[0])[1]
 
-        try:
-            # Check if the file is valid or not
-            if not fname.endswith(('nii', 'nii.gz')):
-                raise Exception("Invalid File Format")
-
-            nifti_image = nib.load(file_path)
-            nifti_header = nifti_image.header
-
-            data_shape = nifti_header.get_data_shape()
-            data_type = str(nifti_header.get_data_dtype())
-            data_voxel = nifti_header.get_zooms()
-
-            data_shape = [int(x) for x in data_shape]
-            data_voxel = [float(x) for x in data_voxel]
-            data_voxel = [round(x, 3) for x in data_voxel]
-
-            # Populate report with metadata
-            report['dshape'] = data_shape
-            report['dtype'] = data_type
-            report['dsize'] = data_voxel
-            report['valid'] = True
+    @staticmethod
+    def update_metadata(data_root: str, id: str, values: dict) -> dict:
+        """
+        Merges values into the scan metadata file ({id}_metadata.json).
 
-        except Exception as e:
-            logger.error(f"Error processing file {file_path}: {str(e)}")
-            pass
+        Args:
+            data_root (str): The scan's data directory.
+            id (str): The identifier for the scan.
+            values (dict): Metadata entries to add or replace.
 
-        return report
+        Returns:
+            dict: The updated metadata.
+        """
+        metadata_path = os.path.join(data_root, f"{id}_metadata.json")
+        metadata = {}
+        if os.path.isfile(metadata_path):
+            with open(metadata_path) as jsn_ref:
+                metadata = json.load(jsn_ref)
+
+        metadata.update(values)
+        with open(metadata_path, "w") as jsn_ref:
+            json.dump(metadata, jsn_ref, indent=2)
+        return metadata
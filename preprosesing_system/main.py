@@ -2,50 +2,160 @@
 
 import os
 import sys
+import json
 import argparse
 
 from loguru import logger
-from utils.processing_wrapper import PreprocessingWrapper
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'helpers')))
 from parameters import Becik4UParameters
+from output_writer import OutputWriter, NUMPY_FORMATS
+from telemetry import Telemetry
+from utils.processing_wrapper import PreprocessingWrapper, PIPELINE_STAGES, OPTIONAL_INTERMEDIATES, REORIENT_DTYPES
+from utils.processing_base import PreprocessingBase, TARGET_SIZE
+from utils.preview_pyramid import PREVIEW_DTYPES
+from utils.batch_runner import BatchRunner, GIGABYTE, FREESURFER_PEAK_BYTES
 
 class BrainProcessingSystem:
     """
     Command-line interface and brain scan processing system.
     """
-    def __init__(self):
+    def __init__(self, cpus: int = None, write_intermediates: tuple = (), output_writer: OutputWriter = None,
+                 telemetry: Telemetry = None, preview_dtype: str = None):
         logger.remove(0)
         logger.add(sys.stderr, format = "<red>[{level}]</red> <green>{message}</green> ", colorize=True)
         self.params = Becik4UParameters()
-        self.prp_warp = PreprocessingWrapper()
+        self.plp_warp = PreprocessingWrapper(cpu_budget=cpus, write_intermediates=write_intermediates, output_writer=output_writer,
+                                             telemetry=telemetry, preview_dtype=preview_dtype)
 
-    def run_pipeline(self, scan_id: str):
+    def refrence_vectors_file(self, file_name: str = None) -> str:
+        """
+        Gets the reference vectors file, by default 'refrence_vectors.json' in BECIK4U_CORE.
+        """
+        return file_name or os.path.join(self.params.becik4u_core, "refrence_vectors.json")
+
+    def run_pipeline(self, scan_id: str, force_from: str = None, vectors_file: str = None) -> bool:
         """
         Runs the processing pipeline for the given scan ID.
         """
         logger.info(f"Running iBrain2u command with ID: {scan_id}")
-        vector_reference = self.plp_warp.load_refrence_vectors()
+        vector_reference = PreprocessingBase.load_refrence_vectors(self.refrence_vectors_file(vectors_file))
 
-        self.plp_warp.preprocessing_pipeline(
+        return self.plp_warp.preprocessing_pipeline(
             prams=self.params,
             scan_id=scan_id,
-            refrence_vectors=vector_reference
+            refrence_vectors=vector_reference,
+            force_from=force_from
+        )
+
+    def run_batch(self, scan_ids: list[str], force_from: str = None, vectors_file: str = None, workers: int = None,
+                  memory_limit: int = None, freesurfer_memory: int = FREESURFER_PEAK_BYTES) -> dict:
+        """
+        Runs the processing pipeline for many scans in a memory-aware process pool.
+        """
+        vector_reference = PreprocessingBase.load_refrence_vectors(self.refrence_vectors_file(vectors_file))
+        batch_runner = BatchRunner(
+            self.params,
+            cpu_budget=self.plp_warp.cpu_budget,
+            workers=workers,
+            memory_limit=memory_limit,
+            freesurfer_memory=freesurfer_memory
         )
+        wrapper_options = {
+            'write_intermediates': self.plp_warp.write_intermediates,
+            'compress_level': self.plp_warp.output_writer.compress_level,
+            'numpy_format': self.plp_warp.output_writer.numpy_format,
+            'preview_dtype': self.plp_warp.preview_dtype,
+        }
+        summary = batch_runner.run(scan_ids, vector_reference, force_from, wrapper_options, self.plp_warp.telemetry)
+        self.plp_warp.telemetry.write_prometheus()
+        return summary
+
+    def run_reorient(self, scan_ids: list[str], target_size: tuple = TARGET_SIZE, dtype: str = "float32", workers: int = None) -> dict:
+        """
+        Re-orients processed scans from their saved orientation and crop, without FreeSurfer.
+        """
+        return self.plp_warp.reorient_batch(self.params, scan_ids, target_size=target_size, dtype=dtype, workers=workers)
+
+def add_scan_arguments(parser: argparse.ArgumentParser, required: bool, default=None) -> None:
+    """
+    Adds the mutually exclusive --id, --ids and --manifest scan selection.
+    """
+    scan_group = parser.add_mutually_exclusive_group(required=required)
+    scan_group.add_argument('--id', type=str, default=default, help='Unique identifier for the brain scan.')
+    scan_group.add_argument('--ids', nargs='+', type=str, default=default, help='Process several scans in a batch.')
+    scan_group.add_argument('--manifest', type=str, default=default, help='Process the scans listed in this file (one ID per line) in a batch.')
 
 def main():
     """
     Main function to initialize the system and run the pipeline.
     """
     parser = argparse.ArgumentParser(description="Becik4U Brain Processing System")
+    add_scan_arguments(parser, required=False)
+    parser.add_argument('--refrence-vectors', default=None, help='Reference vectors JSON file (default: refrence_vectors.json in BECIK4U_CORE).')
+    parser.add_argument('--workers', type=int, default=None, help='Batch worker processes (default: as many as the memory limit allows).')
+    parser.add_argument('--memory-limit', type=float, default=None, help='Batch memory limit in GB (default: 90%% of available memory).')
+    parser.add_argument('--freesurfer-memory', type=float, default=FREESURFER_PEAK_BYTES / GIGABYTE,
+                        help='Estimated peak memory of the FreeSurfer tools of one scan, in GB.')
+    parser.add_argument('--cpus', type=int, default=None, help='CPU budget shared by concurrent stages (default: all CPUs).')
+    parser.add_argument('--force-from', choices=PIPELINE_STAGES, default=None, help='Rerun this stage and every stage after it, ignoring cached results.')
+    parser.add_argument('--write-intermediates', nargs='+', choices=OPTIONAL_INTERMEDIATES + ("all",), default=[],
+                        help='Intermediate volumes to write to disk (default: none, they stay in memory).')
+    parser.add_argument('--compress-level', type=int, choices=range(0, 10), default=6, help='gzip/zip compression level of the outputs.')
+    parser.add_argument('--numpy-format', choices=NUMPY_FORMATS, default="npz", help="'npz' (compressed) or 'npy' (uncompressed, memory-mappable).")
+    parser.add_argument('--preview', nargs='?', choices=PREVIEW_DTYPES, const="uint8", default=None,
+                        help='Also write a quantized preview pyramid and mid-plane thumbnails (default type: uint8).')
+    parser.add_argument('--telemetry', default=None, help='Append per-stage resource usage events to this JSON-lines file.')
+    parser.add_argument('--prometheus', default=None, help='Write per-stage metrics to this Prometheus textfile.')
 
-    parser.add_argument('--id', required=True, type=str, help='Unique identifier for the brain scan.')
+    # Options of a subcommand keep the values given before it
+    subparsers = parser.add_subparsers(dest="command")
+    parser_reorient = subparsers.add_parser('reorient', help='Re-orient processed scans from their saved orientation, without FreeSurfer.')
+    add_scan_arguments(parser_reorient, required=True, default=argparse.SUPPRESS)
+    parser_reorient.add_argument('--size', nargs='+', type=int, default=list(TARGET_SIZE),
+                                 help='Output size in voxels, one value or one per axis (default: %(default)s).')
+    parser_reorient.add_argument('--dtype', choices=REORIENT_DTYPES, default="float32",
+                                 help='Output type, integer types are rounded and clipped (default: float32).')
+    parser_reorient.add_argument('--workers', type=int, default=argparse.SUPPRESS, help='Scans re-oriented in parallel (default: one per CPU).')
 
     args = parser.parse_args()
+    if args.command is None and args.id is None and args.ids is None and args.manifest is None:
+        parser.error("one of the arguments --id --ids --manifest is required")
+
+    write_intermediates = OPTIONAL_INTERMEDIATES if "all" in args.write_intermediates else tuple(args.write_intermediates)
+    output_writer = OutputWriter(compress_level=args.compress_level, threads=args.cpus, numpy_format=args.numpy_format)
+    telemetry = Telemetry(events_path=args.telemetry, prometheus_path=args.prometheus)
+    processing_system = BrainProcessingSystem(cpus=args.cpus, write_intermediates=write_intermediates, output_writer=output_writer,
+                                              telemetry=telemetry, preview_dtype=args.preview)
+
+    if args.command == "reorient":
+        if len(args.size) not in (1, 3) or min(args.size) < 1:
+            parser.error("--size needs one or three positive values")
+        scan_ids = [args.id] if args.id is not None else args.ids if args.ids is not None else BatchRunner.read_manifest(args.manifest)
+        summary = processing_system.run_reorient(scan_ids, tuple(args.size * 3 if len(args.size) == 1 else args.size), args.dtype, args.workers)
+        logger.info(json.dumps({x: y for x, y in summary.items() if x != 'results'}))
+        if summary['failed']:
+            sys.exit(1)
+        return
+
+    if args.id is not None:
+        if not processing_system.run_pipeline(args.id, force_from=args.force_from, vectors_file=args.refrence_vectors):
+            sys.exit(1)
+        logger.info("Processing completed successfully.")
+        return
 
-    processing_system = BrainProcessingSystem()
-    processing_system.run_pipeline(args.id)
-    logger.info("Processing completed successfully.")
+    scan_ids = args.ids if args.ids is not None else BatchRunner.read_manifest(args.manifest)
+    summary = processing_system.run_batch(
+        scan_ids,
+        force_from=args.force_from,
+        vectors_file=args.refrence_vectors,
+        workers=args.workers,
+        memory_limit=int(args.memory_limit * GIGABYTE) if args.memory_limit else None,
+        freesurfer_memory=int(args.freesurfer_memory * GIGABYTE)
+    )
+    logger.info(json.dumps({x: y for x, y in summary.items() if x != 'results'}))
+    if summary['failed']:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,265 @@
+import os
+import time
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from loguru import logger
+
+from .processing_wrapper import PreprocessingWrapper
+from parameters import Becik4UParameters
+from output_writer import OutputWriter
+from telemetry import Telemetry
+
+GIGABYTE = 1 << 30
+
+# Peak memory model of one scan, calibrated with benchmarks/pipeline_benchmark.py: the
+# interpreter with torch/MONAI loaded, the fixed-size reorient output (224^3 float32) and the
+# volumes held per voxel of the 1 mm grid (float32 stripped image and its brain crop, bool
+# mask, uint16 labels and groups, plus slack for the background writes).
+PROCESS_BASELINE_BYTES = 700 << 20
+REORIENT_BUFFER_BYTES = 224 ** 3 * 4
+BYTES_PER_VOXEL = 16
+
+# Peak memory of the FreeSurfer tools of one scan (SynthStrip and SynthSeg may overlap)
+FREESURFER_PEAK_BYTES = 4 * GIGABYTE
+
+# State of a pool worker, built once by _initialize_worker
+_worker = {}
+
+
+def _initialize_worker(cpu_budget: int, wrapper_options: dict, refrence_vectors: dict, events_path: str) -> None:
+    """Import the pipeline once per worker process and limit its threads to its CPU share."""
+    import sys
+    import torch
+    import monai.transforms  # noqa: F401, imported lazily by the pipeline, loaded before the first scan
+
+    logger.remove()
+    logger.add(sys.stderr, format="<red>[{level}]</red> <green>{message}</green> ", colorize=True)
+    torch.set_num_threads(cpu_budget)
+
+    writer = OutputWriter(
+        compress_level=wrapper_options.get('compress_level', 6),
+        threads=cpu_budget,
+        numpy_format=wrapper_options.get('numpy_format', "npz")
+    )
+    _worker['telemetry'] = Telemetry(events_path=events_path)
+    _worker['wrapper'] = PreprocessingWrapper(
+        cpu_budget=cpu_budget,
+        write_intermediates=wrapper_options.get('write_intermediates', ()),
+        output_writer=writer,
+        telemetry=_worker['telemetry'],
+        preview_dtype=wrapper_options.get('preview_dtype')
+    )
+    _worker['params'] = Becik4UParameters()
+    _worker['refrence_vectors'] = refrence_vectors
+
+
+def _run_scan(scan_id: str, force_from: str = None) -> dict:
+    """Run the pipeline of one scan inside a pool worker."""
+    telemetry = _worker['telemetry']
+    start_time = time.perf_counter()
+    success = _worker['wrapper'].preprocessing_pipeline(
+        prams=_worker['params'],
+        scan_id=scan_id,
+        refrence_vectors=_worker['refrence_vectors'],
+        force_from=force_from
+    )
+    with telemetry.lock:
+        events = list(telemetry.events)
+        telemetry.events.clear()
+
+    return {
+        'scan_id': scan_id,
+        'success': success,
+        'seconds': round(time.perf_counter() - start_time, 3),
+        'worker_pid': os.getpid(),
+        'worker_peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'events': events,
+    }
+
+
+class BatchRunner:
+    """
+    Runs the preprocessing pipeline for many scans in a long-lived process pool.
+
+    Each worker imports torch/MONAI once and processes scans one after another. A scan is
+    only started when its estimated peak memory fits next to the scans already running,
+    and the CPU budget is split evenly between workers; inside a worker the stage
+    scheduler shares that slice between FreeSurfer threads and the Python stages.
+    """
+
+    def __init__(self, params: Becik4UParameters, cpu_budget: int = None, workers: int = None,
+                 memory_limit: int = None, freesurfer_memory: int = FREESURFER_PEAK_BYTES):
+        """
+        Initializes the batch runner.
+
+        Args:
+            params (Becik4UParameters): Instance of the Becik4UParameters class.
+            cpu_budget (int): Total CPUs for all workers (defaults to all CPUs).
+            workers (int): Number of worker processes (defaults to what the memory limit allows).
+            memory_limit (int): Bytes available to all scans together (defaults to 90% of MemAvailable).
+            freesurfer_memory (int): Estimated peak bytes of the FreeSurfer tools of one scan.
+        """
+        self.params = params
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.memory_limit = memory_limit or int(self.available_memory() * 0.9)
+        self.freesurfer_memory = freesurfer_memory
+
+        typical_scan = self.estimate_from_shape((256, 256, 256))
+        self.workers = workers or max(1, min(self.cpu_budget, self.memory_limit // typical_scan))
+        self.worker_cpus = max(1, self.cpu_budget // self.workers)
+
+    @staticmethod
+    def available_memory() -> int:
+        """Read MemAvailable from /proc/meminfo, in bytes."""
+        with open("/proc/meminfo") as meminfo_ref:
+            for line in meminfo_ref:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+        raise Exception("MemAvailable not found in /proc/meminfo")
+
+    @staticmethod
+    def read_manifest(file_path: str) -> list[str]:
+        """
+        Reads scan IDs from a manifest file, one per line ('#' starts a comment).
+
+        Args:
+            file_path (str): Path to the manifest file.
+
+        Returns:
+            list[str]: The scan IDs in file order.
+        """
+        with open(file_path) as manifest_ref:
+            lines = [line.split("#", 1)[0].strip() for line in manifest_ref]
+        return [line for line in lines if line]
+
+    def estimate_from_shape(self, shape: tuple) -> int:
+        """Estimated peak bytes of one scan whose 1 mm grid has the given shape."""
+        voxels = int(np.prod(shape[:3], dtype=np.int64))
+        return PROCESS_BASELINE_BYTES + REORIENT_BUFFER_BYTES + voxels * BYTES_PER_VOXEL + self.freesurfer_memory
+
+    def estimate_peak_memory(self, scan_id: str) -> int:
+        """
+        Estimates the peak memory of a scan from the header of its resampled volume.
+
+        Args:
+            scan_id (str): The identifier for the scan.
+
+        Returns:
+            int: Estimated peak bytes of the scan's pipeline, including FreeSurfer.
+        """
+        import nibabel as nib
+
+        sampled_file = os.path.join(self.params.get_root_scan_dir(scan_id), "data", f"{scan_id}_sampled.nii.gz")
+        try:
+            shape = nib.load(sampled_file).header.get_data_shape()
+        except Exception as error_exc:
+            logger.warning(f"Cannot read header of {sampled_file}, assuming 256^3 : {error_exc}")
+            shape = (256, 256, 256)
+        return self.estimate_from_shape(shape)
+
+    def run(self, scan_ids: list[str], refrence_vectors: dict[str, np.ndarray], force_from: str = None,
+            wrapper_options: dict = None, telemetry: Telemetry = None) -> dict:
+        """
+        Runs the pipeline of every scan, admitting scans while their memory estimate fits.
+
+        A worker that dies (e.g. killed for using more memory than estimated) breaks the pool:
+        the scans running in it are reported as failed and the remaining scans run in a new pool.
+
+        Args:
+            scan_ids (list[str]): Scans to process, started in this order.
+            refrence_vectors (dict[str, np.ndarray]): Reference vectors passed to every pipeline.
+            force_from (str): Stage to rerun in every scan, see PreprocessingWrapper.preprocessing_pipeline.
+            wrapper_options (dict): write_intermediates, compress_level, numpy_format and preview_dtype of the workers.
+            telemetry (Telemetry): Recorder receiving the events of all workers.
+
+        Returns:
+            dict: Per-scan results and aggregate throughput.
+        """
+        estimates = {scan_id: self.estimate_peak_memory(scan_id) for scan_id in scan_ids}
+        logger.info(
+            f"### BATCH : {len(scan_ids)} scans, {self.workers} workers x {self.worker_cpus} cpus, "
+            f"memory limit {self.memory_limit / GIGABYTE:.1f} GB ###"
+        )
+
+        pending = list(scan_ids)
+        running = {}
+        results = []
+        reserved = 0
+        start_time = time.perf_counter()
+        events_path = telemetry.events_path if telemetry is not None else None
+
+        def start_pool() -> ProcessPoolExecutor:
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_initialize_worker,
+                initargs=(self.worker_cpus, wrapper_options or {}, refrence_vectors, events_path)
+            )
+
+        executor = start_pool()
+        try:
+            while pending or running:
+                # Admit scans in order while a worker is free and the estimate fits
+                while pending and len(running) < self.workers:
+                    scan_id = pending[0]
+                    if running and reserved + estimates[scan_id] > self.memory_limit:
+                        break
+                    if estimates[scan_id] > self.memory_limit:
+                        logger.warning(f"### BATCH {scan_id} : estimate {estimates[scan_id] / GIGABYTE:.1f} GB exceeds the memory limit, running alone ###")
+                    try:
+                        future = executor.submit(_run_scan, scan_id, force_from)
+                    except BrokenProcessPool as error_exc:
+                        # A worker died (e.g. killed when the memory estimate was too low); the scans
+                        # it shared the pool with fail below, the remaining ones run in a new pool
+                        logger.error(f"### BATCH : process pool broken, restarting it : {error_exc} ###")
+                        executor.shutdown(wait=False)
+                        executor = start_pool()
+                        continue
+
+                    pending.pop(0)
+                    reserved += estimates[scan_id]
+                    running[future] = scan_id
+                    logger.info(f"### BATCH {scan_id} - START (estimate {estimates[scan_id] / GIGABYTE:.1f} GB) ###")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    scan_id = running.pop(future)
+                    reserved -= estimates[scan_id]
+                    try:
+                        result = future.result()
+                    except Exception as error_exc:
+                        result = {'scan_id': scan_id, 'success': False, 'error': str(error_exc)}
+
+                    events = result.pop('events', [])
+                    if telemetry is not None:
+                        telemetry.record(events)
+
+                    result['estimated_peak_bytes'] = estimates[scan_id]
+                    results.append(result)
+                    state = "Done" if result['success'] else "Failed"
+                    PreprocessingWrapper.print_status(len(results), len(scan_ids), f"{scan_id} {state}", result.get('seconds'))
+        finally:
+            executor.shutdown(wait=True)
+
+        elapsed = time.perf_counter() - start_time
+        succeeded = sum(1 for x in results if x['success'])
+        scan_seconds = [x['seconds'] for x in results if 'seconds' in x]
+        summary = {
+            'scans': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'workers': self.workers,
+            'worker_cpus': self.worker_cpus,
+            'seconds': round(elapsed, 3),
+            'scans_per_hour': round(len(results) * 3600 / elapsed, 2) if elapsed > 0 else None,
+            'mean_scan_seconds': round(float(np.mean(scan_seconds)), 3) if scan_seconds else None,
+            'results': results,
+        }
+        logger.info(
+            f"### BATCH : {succeeded}/{len(results)} scans succeeded in {summary['seconds']} seconds "
+            f"({summary['scans_per_hour']} scans/hour) ###"
+        )
+        return summary
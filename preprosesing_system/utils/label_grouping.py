@@ -0,0 +1,128 @@
+import numpy as np
+
+from .volume_geometry import AxisHistograms
+
+# SynthSeg label -> group value table used for the brain orientation groups
+SYNTHSEG_GROUP_TABLE = {
+    100: (2, 3),     # Left cerebral white matter / cortex
+    200: (7, 8),     # Left cerebellum white matter / cortex
+    300: (41, 42),   # Right cerebral white matter / cortex
+    400: (46, 47),   # Right cerebellum white matter / cortex
+    500: (16,),      # Brain stem
+}
+
+SYNTHSEG_GROUP_NAMES = {
+    100: "LEFT_CEREBRUM",
+    200: "LEFT_CEREBELLUM",
+    300: "RIGHT_CEREBRUM",
+    400: "RIGHT_CEREBELLUM",
+    500: "BRAIN_STEM",
+}
+
+
+class LabelGrouping:
+    """
+    Single-pass label grouping engine.
+
+    The label volume is streamed slice by slice through a lookup table, so every
+    voxel is visited once. Group voxel counts and centroids are accumulated from
+    per-slice bincounts in the same pass, without building a binary mask per group.
+    """
+
+    @staticmethod
+    def grouped_dtype(group_table: dict[int, tuple[int, ...]]) -> np.dtype:
+        """Smallest unsigned dtype that holds every group value."""
+        return np.dtype(np.uint8) if max(group_table) <= np.iinfo(np.uint8).max else np.dtype(np.uint16)
+
+    @staticmethod
+    def build_lookup_tables(group_table: dict[int, tuple[int, ...]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Build the label lookup tables for a group table.
+
+        Returns:
+            tuple: (value_lut, ordinal_lut, group_values) where value_lut maps a label to its
+            group value, ordinal_lut maps a label to its group ordinal (0 is background) and
+            group_values lists the group value for every ordinal.
+        """
+        max_label = max(label for labels in group_table.values() for label in labels)
+
+        # One spare trailing entry so labels above the table clip to background
+        value_lut = np.zeros(max_label + 2, dtype=LabelGrouping.grouped_dtype(group_table))
+        ordinal_lut = np.zeros(max_label + 2, dtype=np.uint8)
+        group_values = np.zeros(len(group_table) + 1, dtype=np.int64)
+
+        for ordinal, (group_value, labels) in enumerate(sorted(group_table.items()), start=1):
+            value_lut[list(labels)] = group_value
+            ordinal_lut[list(labels)] = ordinal
+            group_values[ordinal] = group_value
+
+        return value_lut, ordinal_lut, group_values
+
+    @staticmethod
+    def group_labels(label_array: np.ndarray, group_table: dict[int, tuple[int, ...]] = SYNTHSEG_GROUP_TABLE) -> dict:
+        """
+        Group a label volume and compute per-group voxel counts and centroids in one pass.
+
+        Args:
+            label_array (np.ndarray): 3D label volume (any integer or float dtype).
+            group_table (dict): Mapping of group value to the labels that belong to it.
+
+        Returns:
+            dict: 'grouped_array' (uint8/uint16 volume), 'counts' (group value -> voxel count)
+            and 'centers' (group value -> centroid in voxel coordinates, absent groups are omitted).
+        """
+        value_lut, ordinal_lut, group_values = LabelGrouping.build_lookup_tables(group_table)
+        n_groups = len(group_values)
+        clip_label = len(value_lut) - 1
+
+        # Stream along the slowest-varying axis (NIfTI arrays are Fortran ordered)
+        fortran_order = np.isfortran(label_array)
+        grouped_array = np.empty(label_array.shape, dtype=value_lut.dtype, order='F' if fortran_order else 'C')
+        label_view = label_array.T if fortran_order else label_array
+        grouped_view = grouped_array.T if fortran_order else grouped_array
+
+        histograms = AxisHistograms(label_view.shape, n_groups)
+        for a in range(label_view.shape[0]):
+            labels = label_view[a]
+            if labels.dtype.kind == 'f':
+                labels = np.rint(labels)
+            labels = np.clip(labels, 0, clip_label).astype(np.intp, copy=False)
+
+            np.take(value_lut, labels, out=grouped_view[a])
+            histograms.add_slice(a, np.take(ordinal_lut, labels).astype(np.intp, copy=False))
+
+        counts, weighted = histograms.moments(reverse_axes=fortran_order)
+
+        group_counts = {}
+        group_centers = {}
+        for ordinal in range(1, n_groups):
+            group_value = int(group_values[ordinal])
+            group_counts[group_value] = int(counts[ordinal])
+            if counts[ordinal] > 0:
+                group_centers[group_value] = weighted[ordinal] / counts[ordinal]
+
+        return {
+            'grouped_array': grouped_array,
+            'counts': group_counts,
+            'centers': group_centers,
+        }
+
+    @staticmethod
+    def group_file(input_path: str, output_path: str = None, group_table: dict[int, tuple[int, ...]] = SYNTHSEG_GROUP_TABLE) -> dict:
+        """Group a label NIfTI file, optionally saving the grouped volume next to it."""
+        import nibabel as nib
+
+        base_img = nib.load(input_path)
+        # Native dtype read, no float64 intermediate
+        label_array = np.asanyarray(base_img.dataobj)
+        grouping = LabelGrouping.group_labels(label_array, group_table)
+
+        if output_path is not None:
+            header = base_img.header.copy()
+            header.set_data_dtype(grouping['grouped_array'].dtype)
+            header.set_slope_inter(1, 0)
+            masked_img = nib.Nifti1Image(grouping['grouped_array'], affine=base_img.affine, header=header)
+            nib.save(masked_img, output_path)
+
+        grouping['affine'] = base_img.affine
+        return grouping
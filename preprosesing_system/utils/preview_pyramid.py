@@ -0,0 +1,102 @@
+import numpy as np
+
+# Downsampling factor of every pyramid level, relative to the oriented scan (224³ -> 112³, 56³, 28³)
+PREVIEW_FACTORS = (2, 4, 8)
+PREVIEW_DTYPES = ("uint8", "uint16")
+
+# Thumbnail name -> voxel axis of its mid plane
+PREVIEW_PLANES = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+
+# Percentiles of the first level the 8-bit thumbnails are scaled from
+THUMBNAIL_PERCENTILES = (1, 99)
+
+# Planes of the scan averaged at a time, bounds the float32 temporaries
+SLAB_PLANES = 16
+
+
+class PreviewPyramid:
+    """
+    Builds quantized multi-resolution previews and mid-plane thumbnails of an oriented scan.
+    """
+
+    @staticmethod
+    def _block_mean(array: np.ndarray, factor: int) -> np.ndarray:
+        """Average non-overlapping factor³ blocks of an array whose shape is a multiple of factor."""
+        nx, ny, nz = (x // factor for x in array.shape)
+        blocks = array.reshape(nx, factor, ny, factor, nz, factor)
+        return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+    @staticmethod
+    def quantize(array: np.ndarray, low: float, high: float, dtype: str) -> tuple[np.ndarray, float]:
+        """
+        Maps values in [low, high] onto the full range of an unsigned integer type.
+
+        Returns:
+            tuple[np.ndarray, float]: The quantized array and its scale, value = quantized * scale + low.
+        """
+        max_value = np.iinfo(dtype).max
+        scale = (high - low) / max_value if high > low else 1.0
+        quantized = np.rint((array - low) / scale)
+        return np.clip(quantized, 0, max_value).astype(dtype), float(scale)
+
+    @staticmethod
+    def build(array: np.ndarray, factors: tuple = PREVIEW_FACTORS, dtype: str = "uint8") -> dict:
+        """
+        Builds the preview pyramid and thumbnails in one pass over the scan.
+
+        The scan is read slab by slab: every slab is block-averaged into the finest level and
+        contributes to the value range and the three mid planes. Coarser levels are averaged
+        from the finest one, so the full-resolution scan is only read once. Edges that do not
+        fill a block of the coarsest level are left out.
+
+        Args:
+            array (np.ndarray): The oriented scan (3D).
+            factors (tuple): Downsampling factors, each a multiple of the first.
+            dtype (str): Quantized type of the levels, from PREVIEW_DTYPES.
+
+        Returns:
+            dict: 'levels' (one quantized array per factor), 'scale' and 'offset' (value =
+                level * scale + offset) and 'thumbnails' (plane name -> uint8 image, second
+                in-plane axis pointing up).
+        """
+        if dtype not in PREVIEW_DTYPES:
+            raise Exception(f"Unknown preview type '{dtype}'")
+        if any(x % factors[0] for x in factors):
+            raise Exception(f"Preview factors {factors} must be multiples of {factors[0]}")
+
+        step = max(factors)
+        shape = tuple(x - x % step for x in array.shape[:3])
+        if min(shape) == 0:
+            raise Exception(f"Scan of shape {array.shape} is smaller than the coarsest preview level")
+
+        finest = np.empty(tuple(x // factors[0] for x in shape), dtype=np.float32)
+        planes = {name: np.empty(tuple(x for i, x in enumerate(shape) if i != axis), dtype=np.float32)
+                  for name, axis in PREVIEW_PLANES.items()}
+        middle = [x // 2 for x in shape]
+        low, high = np.inf, -np.inf
+
+        slab_planes = factors[0] * max(1, SLAB_PLANES // factors[0])
+        for start in range(0, shape[0], slab_planes):
+            stop = min(start + slab_planes, shape[0])
+            slab = np.asarray(array[start:stop, :shape[1], :shape[2]], dtype=np.float32)
+            finest[start // factors[0]:stop // factors[0]] = PreviewPyramid._block_mean(slab, factors[0])
+            low, high = min(low, float(slab.min())), max(high, float(slab.max()))
+
+            planes['coronal'][start:stop] = slab[:, middle[1], :]
+            planes['axial'][start:stop] = slab[:, :, middle[2]]
+            if start <= middle[0] < stop:
+                planes['sagittal'][:] = slab[middle[0] - start]
+
+        levels = [finest] + [PreviewPyramid._block_mean(finest, x // factors[0]) for x in factors[1:]]
+        quantized = [PreviewPyramid.quantize(x, low, high, dtype) for x in levels]
+
+        thumbnail_low, thumbnail_high = np.percentile(finest, THUMBNAIL_PERCENTILES)
+        thumbnails = {name: np.flipud(PreviewPyramid.quantize(plane, float(thumbnail_low), float(thumbnail_high), "uint8")[0].T)
+                      for name, plane in planes.items()}
+
+        return {
+            'levels': [x for x, _ in quantized],
+            'scale': quantized[0][1],
+            'offset': low,
+            'thumbnails': thumbnails,
+        }
@@ -1,17 +1,32 @@
+import os
 import json
-import torch
+import threading
+import contextlib
 import numpy as np
-from monai.transforms import ResizeWithPadOrCrop
-from monai.transforms import Rotate
-import nibabel as nib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .label_grouping import SYNTHSEG_GROUP_NAMES
+from .volume_geometry import VolumeGeometry
 
 TARGET_SIZE = (224, 224, 224)
 
+# Padded space the bounding-box crop of the brain is centered in
+CROP_SIZE = (378, 378, 378)
+
+# Rotation sampling grids kept by rotate_batch(cache_grid=True) (about 135 MB each at TARGET_SIZE)
+ROTATION_GRID_CACHE = 2
+
 class PreprocessingBase:
     """
     Base class with utility functions for preprocessing.
     """
 
+    _resize_transforms = {}
+    _rotation_grids = OrderedDict()
+    _transform_lock = threading.Lock()
+    _torch_threads_lock = threading.RLock()
+
     @staticmethod
     def load_json(fname: str):
         """Load JSON file."""
@@ -32,10 +47,7 @@ class PreprocessingBase:
     @staticmethod
     def masked_center(array: np.ndarray, key: int) -> np.ndarray:
         """Find center of mass for a masked region."""
-        indices = np.argwhere(array == key)
-        if indices.size == 0:
-            raise Exception("Values Not Found!")
-        return np.mean(indices, axis=0)
+        return VolumeGeometry.center_of_mass(array, key)
 
     @staticmethod
     def normalise_vector(vector: np.ndarray) -> np.ndarray:
@@ -48,53 +60,329 @@ class PreprocessingBase:
         """Stack vectors into a single array."""
         return np.stack([vk['VECTOR_ALPHA'], vk['VECTOR_BETA'], vk['VECTOR_GAMMA']], axis=0)
 
+    @staticmethod
+    @contextlib.contextmanager
+    def torch_threads(threads: int = None):
+        """
+        Run torch ops with an intra-op thread budget, restoring the previous one afterwards.
+
+        The torch setting is process-wide, so budgeted blocks hold a lock and run one at a time
+        (nested blocks of the same thread are allowed). Calls without a budget do not wait and
+        run with whatever setting is current.
+        """
+        import torch
+
+        if threads is None:
+            yield
+            return
+        with PreprocessingBase._torch_threads_lock:
+            previous = torch.get_num_threads()
+            torch.set_num_threads(max(1, threads))
+            try:
+                yield
+            finally:
+                torch.set_num_threads(previous)
+
+    @staticmethod
+    def resize_transform(output_size=TARGET_SIZE):
+        """Cached ResizeWithPadOrCrop transform of an output size."""
+        from monai.transforms import ResizeWithPadOrCrop
+
+        key = tuple(int(x) for x in output_size)
+        with PreprocessingBase._transform_lock:
+            if key not in PreprocessingBase._resize_transforms:
+                PreprocessingBase._resize_transforms[key] = ResizeWithPadOrCrop(key)
+            return PreprocessingBase._resize_transforms[key]
+
+    @staticmethod
+    def rotation_grid(spatial_shape: tuple, rotation_radians: np.ndarray, cache: bool = False):
+        """
+        Sampling grid of MONAI Rotate (keep_size, align_corners=False) for a volume shape and
+        angle set, in the normalized coordinates of torch grid_sample. With ``cache`` the grid is
+        kept for later calls, up to the last ROTATION_GRID_CACHE grids.
+        """
+        import torch
+        from monai.networks.utils import to_norm_affine
+        from monai.transforms.utils import create_rotate, create_translate
+
+        spatial_shape = tuple(int(x) for x in spatial_shape)
+        key = (spatial_shape, tuple(float(x) for x in np.ravel(rotation_radians)))
+        with PreprocessingBase._transform_lock:
+            grid = PreprocessingBase._rotation_grids.get(key)
+            if grid is not None:
+                PreprocessingBase._rotation_grids.move_to_end(key)
+                return grid
+
+        # Same transform as monai.transforms.spatial.functional.rotate: rotation about the volume center
+        center = (np.array(spatial_shape) - 1) / 2
+        transform = create_translate(3, center.tolist()) @ create_rotate(3, key[1]) @ create_translate(3, (-center).tolist())
+        theta = to_norm_affine(
+            affine=torch.as_tensor(transform, dtype=torch.float32)[None],
+            src_size=spatial_shape, dst_size=spatial_shape, align_corners=False, zero_centered=False
+        )
+        theta[:, :3] = theta[:, [2, 1, 0]]
+        theta[:, :, :3] = theta[:, :, [2, 1, 0]]
+        grid = torch.nn.functional.affine_grid(theta[:, :3], size=[1, 1, *spatial_shape], align_corners=False)
+        if not cache:
+            return grid
+
+        with PreprocessingBase._transform_lock:
+            PreprocessingBase._rotation_grids[key] = grid
+            while len(PreprocessingBase._rotation_grids) > ROTATION_GRID_CACHE:
+                PreprocessingBase._rotation_grids.popitem(last=False)
+        return grid
+
+    @staticmethod
+    def _group_volumes(arrays: list[np.ndarray], *keys) -> dict[tuple, list[int]]:
+        """Indices of the volumes sharing a shape (and the given per-volume keys), in input order."""
+        groups = {}
+        for index, array in enumerate(arrays):
+            groups.setdefault((array.shape,) + tuple(x[index] for x in keys), []).append(index)
+        return groups
+
+    @staticmethod
+    def convert_size_batch(arrays: list[np.ndarray], output_size=TARGET_SIZE, threads: int = None) -> list[np.ndarray]:
+        """
+        Resize a stack of volumes to the target size with one cached ResizeWithPadOrCrop call
+        per shape and dtype, the volumes being its channels.
+
+        Args:
+            arrays (list[np.ndarray]): The volumes (or a 4D stack), e.g. an image and its label map.
+            output_size (tuple): The target size.
+            threads (int): torch intra-op threads of the call (defaults to the current setting).
+
+        Returns:
+            list[np.ndarray]: The resized volumes, in input order and dtypes.
+        """
+        import torch
+
+        arrays = list(arrays)
+        results = [None] * len(arrays)
+        transform = PreprocessingBase.resize_transform(output_size)
+        with PreprocessingBase.torch_threads(threads):
+            for indices in PreprocessingBase._group_volumes(arrays, [x.dtype for x in arrays]).values():
+                output = transform(torch.from_numpy(np.stack([arrays[x] for x in indices]))).numpy()
+                for channel, index in enumerate(indices):
+                    results[index] = output[channel]
+        return results
+
+    @staticmethod
+    def rotate_batch(arrays: list[np.ndarray], rotation_radians: np.ndarray, modes: list[str] = None, threads: int = None,
+                     cache_grid: bool = False) -> list[np.ndarray]:
+        """
+        Rotate a stack of volumes by the same angles, sampling every volume of a shape and
+        interpolation mode in one grid_sample call on one rotation grid.
+
+        Matches rotate_array (MONAI Rotate) volume by volume. Label maps are rotated with
+        ``'nearest'`` and keep their dtype; other volumes are returned as float32.
+
+        Args:
+            arrays (list[np.ndarray]): The volumes (or a 4D stack), e.g. an image and its label map.
+            rotation_radians (np.ndarray): Rotation angles about x, y and z.
+            modes (list[str]): 'bilinear' or 'nearest' per volume (defaults to 'bilinear').
+            threads (int): torch intra-op threads of the call (defaults to the current setting).
+            cache_grid (bool): Keep the rotation grid for later calls with the same shape and angles,
+                otherwise it is freed when the call returns.
+
+        Returns:
+            list[np.ndarray]: The rotated volumes, in input order.
+        """
+        import torch
+
+        arrays = list(arrays)
+        modes = list(modes) if modes is not None else ["bilinear"] * len(arrays)
+        if len(modes) != len(arrays):
+            raise Exception(f"Got {len(modes)} interpolation modes for {len(arrays)} volumes")
+
+        results = [None] * len(arrays)
+        with PreprocessingBase.torch_threads(threads):
+            grids = {}
+            for (shape, mode), indices in PreprocessingBase._group_volumes(arrays, modes).items():
+                if shape not in grids:
+                    grids[shape] = PreprocessingBase.rotation_grid(shape, rotation_radians, cache=cache_grid)
+                grid = grids[shape]
+                stack = torch.from_numpy(np.stack([np.asarray(arrays[x], dtype=np.float32) for x in indices]))
+                output = torch.nn.functional.grid_sample(
+                    stack[None], grid, mode=mode, padding_mode="border", align_corners=False
+                )[0].numpy()
+                for channel, index in enumerate(indices):
+                    results[index] = output[channel] if mode != "nearest" else output[channel].astype(arrays[index].dtype)
+        return results
+
     @staticmethod
     def convert_size(array: np.ndarray, output_size=TARGET_SIZE) -> np.ndarray:
         """Resize array to target size."""
-        array = np.expand_dims(array, axis=0)
-        tensor = torch.from_numpy(array)
-        spatial_resize_function = ResizeWithPadOrCrop(output_size)
-        tensor = spatial_resize_function(tensor)
-        return tensor.squeeze().numpy()
+        return PreprocessingBase.convert_size_batch([array], output_size)[0]
+
+    @staticmethod
+    def pad_or_crop_offset(input_size: tuple, output_size=TARGET_SIZE) -> np.ndarray:
+        """Per-axis voxel offset applied by a symmetric ResizeWithPadOrCrop."""
+        offsets = [
+            (out_dim - in_dim) // 2 if out_dim >= in_dim else out_dim // 2 - in_dim // 2
+            for in_dim, out_dim in zip(input_size, output_size)
+        ]
+        return np.array(offsets, dtype=np.int64)
 
     @staticmethod
     def rotate_array(array: np.ndarray, rotation_radians: np.ndarray) -> np.ndarray:
         """Rotate array by given angles."""
-        array = np.expand_dims(array, axis=0)
-        tensor = torch.from_numpy(array)
-        rotation_function = Rotate(rotation_radians)
-        tensor = rotation_function(tensor)
-        return tensor.squeeze().numpy()
+        return PreprocessingBase.rotate_batch([array], rotation_radians)[0]
+
+    @staticmethod
+    def create_rotation_matrix(rotation_radians: np.ndarray) -> np.ndarray:
+        """Rotation matrix matching MONAI Rotate (intrinsic x, then y, then z)."""
+        cos_x, sin_x = np.cos(rotation_radians[0]), np.sin(rotation_radians[0])
+        cos_y, sin_y = np.cos(rotation_radians[1]), np.sin(rotation_radians[1])
+        cos_z, sin_z = np.cos(rotation_radians[2]), np.sin(rotation_radians[2])
+
+        rotate_x = np.array([[1, 0, 0], [0, cos_x, -sin_x], [0, sin_x, cos_x]])
+        rotate_y = np.array([[cos_y, 0, sin_y], [0, 1, 0], [-sin_y, 0, cos_y]])
+        rotate_z = np.array([[cos_z, -sin_z, 0], [sin_z, cos_z, 0], [0, 0, 1]])
+        return rotate_x @ rotate_y @ rotate_z
+
+    @staticmethod
+    def compose_reorient_transform(input_shape: tuple, center_offset: np.ndarray, rotation_radians: np.ndarray, output_size=TARGET_SIZE) -> np.ndarray:
+        """
+        Compose shift, pad/crop and rotation into one 4x4 output-to-input voxel transform.
+
+        Equivalent to scipy.ndimage.shift by center_offset, convert_size to output_size and
+        rotate_array by rotation_radians about the output center.
+        """
+        rotation = PreprocessingBase.create_rotation_matrix(rotation_radians)
+        output_center = (np.array(output_size, dtype=np.float64) - 1) / 2
+        pad_offset = PreprocessingBase.pad_or_crop_offset(input_shape, output_size)
+
+        transform = np.eye(4)
+        transform[:3, :3] = rotation
+        transform[:3, 3] = output_center - rotation @ output_center - pad_offset - np.asarray(center_offset, dtype=np.float64)
+        return transform
+
+    @staticmethod
+    def reorient_array(array: np.ndarray, center_offset: np.ndarray, rotation_radians: np.ndarray,
+                       output_size=TARGET_SIZE, threads: int = None, output: np.ndarray = None,
+                       padded_size: tuple = None) -> np.ndarray:
+        """
+        Shift, pad/crop and rotate in a single trilinear resampling pass.
+
+        The output grid is split into slabs that are sampled in parallel (scipy releases the
+        GIL while interpolating). Matches the shift/convert_size/rotate_array path to float32
+        precision while the brain lies inside the output window. With ``padded_size`` the array
+        is sampled as if pad_or_crop_into had centered it in a zero volume of that size, without
+        allocating the padded volume. This is not bit-identical to sampling the padded volume:
+        the coordinates are shifted by the padding, which changes their rounding, so values
+        differ at float32 precision (about 1e-5 on 0-255 intensities).
+        """
+        import scipy.ndimage as scimg
+
+        placement = np.zeros(3)
+        if padded_size is not None:
+            offsets = PreprocessingBase.pad_or_crop_offset(array.shape, padded_size)
+            array = array[tuple(slice(max(-o, 0), max(-o, 0) + min(n, s)) for o, n, s in zip(offsets, array.shape, padded_size))]
+            placement = np.maximum(offsets, 0)
+
+        transform = PreprocessingBase.compose_reorient_transform(padded_size or array.shape, center_offset, rotation_radians, output_size)
+        matrix, offset = transform[:3, :3], transform[:3, 3] - placement
+
+        # C order keeps the interpolation reads local (NIfTI volumes are Fortran-ordered views)
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        if output is None:
+            output = np.empty(output_size, dtype=np.float32)
+
+        threads = max(1, min(threads or os.cpu_count() or 1, output_size[0]))
+        bounds = np.linspace(0, output_size[0], threads + 1).astype(int)
+
+        def sample_slab(start: int, stop: int) -> None:
+            scimg.affine_transform(
+                array, matrix,
+                offset=offset + matrix[:, 0] * start,
+                output_shape=(stop - start,) + tuple(output_size[1:]),
+                output=output[start:stop],
+                order=1, mode='grid-constant', cval=0.0, prefilter=False
+            )
+
+        if threads == 1:
+            sample_slab(0, output_size[0])
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(sample_slab, bounds[:-1], bounds[1:]))
+
+        return output
 
     @staticmethod
     def compute_bounding_box(array: np.ndarray) -> dict[str, int]:
-        """Compute bounding box of non-zero region."""
-        arm = np.argwhere(array)
-        start_x, stop_x = np.min(arm[:, 0]), np.max(arm[:, 0])
-        start_y, stop_y = np.min(arm[:, 1]), np.max(arm[:, 1])
-        start_z, stop_z = np.min(arm[:, 2]), np.max(arm[:, 2])
+        """Compute bounding box of non-zero region (stop indices are inclusive)."""
+        return VolumeGeometry.bounding_box(array)
 
-        return {
-            'start_x': int(start_x),
-            'stop_x': int(stop_x),
-            'start_y': int(start_y),
-            'stop_y': int(stop_y),
-            'start_z': int(start_z),
-            'stop_z': int(stop_z)
-        }
+    @staticmethod
+    def convert_bounding_box_2_array(bounds: dict[str, int]) -> np.ndarray:
+        """Convert a bounding box to a (3, 2) array of [start, stop] rows."""
+        return VolumeGeometry.convert_bounding_box_2_array(bounds)
 
     @staticmethod
-    def load_and_crop(file_path: str, bounds: dict[str, int], spatial_size=(378, 378, 378), dtype=np.uint16) -> np.ndarray:
-        """Load and crop image based on bounds."""
-        nib_image: nib.Nifti1Image = nib.load(file_path)
-        nib_array: np.ndarray = nib_image.get_fdata().astype(dtype)
+    def convert_array_2_bounding_box(bbx_array: np.ndarray) -> dict[str, int]:
+        """Convert a (3, 2) array of [start, stop] rows back to a bounding box."""
+        return VolumeGeometry.convert_array_2_bounding_box(bbx_array)
+
+    @staticmethod
+    def pad_or_crop_into(array: np.ndarray, spatial_size=TARGET_SIZE, dtype=None, output: np.ndarray = None) -> np.ndarray:
+        """
+        Place an array centered in a zero-filled volume, as ResizeWithPadOrCrop does.
+
+        The output is filled in place, without a torch/MONAI round trip.
+        """
+        dtype = array.dtype if dtype is None else dtype
+        if output is None:
+            output = np.zeros(spatial_size, dtype=dtype)
+        else:
+            output.fill(0)
+
+        offsets = PreprocessingBase.pad_or_crop_offset(array.shape, spatial_size)
+        source = tuple(slice(max(-o, 0), max(-o, 0) + min(n, s)) for o, n, s in zip(offsets, array.shape, spatial_size))
+        target = tuple(slice(max(o, 0), max(o, 0) + min(n, s)) for o, n, s in zip(offsets, array.shape, spatial_size))
+        output[target] = array[source]
+        return output
+
+    @staticmethod
+    def load_region(file_path: str, bounds: dict[str, int]) -> np.ndarray:
+        """
+        Read the bounding-box region of a NIfTI file.
+
+        Only the region is read from the NIfTI proxy, in the file's native dtype (or float
+        when the header scales the data); for '.nii.gz' files only the gzip members holding
+        the region are decompressed.
+        """
+        from nifti_reader import NiftiReader
 
-        cropped_array = nib_array[
+        nib_image = NiftiReader.load(file_path)
+        return np.asarray(nib_image.dataobj[
             bounds['start_x']:bounds['stop_x'],
             bounds['start_y']:bounds['stop_y'],
             bounds['start_z']:bounds['stop_z']
-        ]
+        ])
+
+    @staticmethod
+    def load_and_crop(file_path: str, bounds: dict[str, int], spatial_size=CROP_SIZE, dtype=np.uint16) -> np.ndarray:
+        """Load and crop image based on bounds, cast straight into the padded output."""
+        return PreprocessingBase.pad_or_crop_into(PreprocessingBase.load_region(file_path, bounds), spatial_size, dtype)
+
+    @staticmethod
+    def compute_center_groups(label_groups: dict, bounds: dict[str, int], spatial_size=CROP_SIZE) -> dict[str, np.ndarray]:
+        """
+        Compute group centers in the cropped and padded space used by load_and_crop.
+
+        The centroids come from the grouping pass, so the label volume is not scanned again.
+        """
+        crop_start = np.array([bounds['start_x'], bounds['start_y'], bounds['start_z']])
+        crop_size = np.array([bounds['stop_x'], bounds['stop_y'], bounds['stop_z']]) - crop_start
+        crop_offset = PreprocessingBase.pad_or_crop_offset(tuple(crop_size), spatial_size)
+        return VolumeGeometry.compute_center_groups(label_groups, bounds, crop_offset, SYNTHSEG_GROUP_NAMES)
 
-        padded_array = PreprocessingBase.convert_size(cropped_array, output_size=spatial_size)
+    @staticmethod
+    def subtract_groups(coordinate_groups: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """Express group centers relative to BRAIN_OFFSET_CENTER."""
+        return VolumeGeometry.subtract_groups(coordinate_groups)
 
-        return padded_array
+    @staticmethod
+    def create_refrence_vectors(coordinate_groups: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """Create the ALPHA, BETA and GAMMA orientation vectors from group centers."""
+        return VolumeGeometry.create_refrence_vectors(coordinate_groups)
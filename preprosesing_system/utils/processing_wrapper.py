@@ -1,195 +1,508 @@
 import os
-import subprocess
-import datetime
+import json
+import time
+import shutil
+import tempfile
 import numpy as np
-import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from loguru import logger
 
-import scipy.ndimage as scimg
-from scipy.spatial.transform import Rotation as R
-from scipy.linalg import orthogonal_procrustes
+from .processing_base import PreprocessingBase, TARGET_SIZE, CROP_SIZE
+from .label_grouping import LabelGrouping, SYNTHSEG_GROUP_TABLE
+from .stage_scheduler import PipelineStage, StageScheduler
+from .stage_cache import StageCache
+from .volume_store import VolumeStore
+from .preview_pyramid import PreviewPyramid, PREVIEW_FACTORS, PREVIEW_PLANES
+from parameters import Becik4UParameters
+from output_writer import OutputWriter
+from telemetry import Telemetry
+from scan_index import ScanIndex
 
-from .processing_base import PreprocessingBase
-from helpers import iBrain2uParamters
+# Stage names in pipeline order, used by --force-from (mirrored in api_system/service/job_manager.py)
+PIPELINE_STAGES = ("skullstrip", "segmentation", "grouping", "orientation", "reorient", "preview")
+
+# Volumes always written to disk, and intermediates only written on request
+PERSISTENT_VOLUMES = ("stripped", "segmented")
+OPTIONAL_INTERMEDIATES = ("mask", "grouped")
+
+# Output types of the reorient-only mode, integer types are rounded and clipped to their range
+REORIENT_DTYPES = ("float32", "float16", "int16", "uint16", "uint8")
+
+# In-memory types of the FreeSurfer outputs: intensities stay float32, labels uint16, masks bool
+VOLUME_DTYPES = {'stripped': np.float32, 'mask': bool, 'segmented': np.uint16}
 
 class PreprocessingWrapper:
-    def __init__(self):
-        """Initialize preprocessing wrapper."""
-        pass
-    
+    def __init__(self, cpu_budget: int = None, write_intermediates: tuple = (), output_writer: OutputWriter = None,
+                 telemetry: Telemetry = None, status_callback=None, preview_dtype: str = None):
+        """
+        Initialize preprocessing wrapper.
+
+        Args:
+            cpu_budget (int): CPUs shared by concurrently running stages (defaults to all CPUs).
+            write_intermediates (tuple): Intermediate volumes from OPTIONAL_INTERMEDIATES to write to disk.
+            output_writer (OutputWriter): Writer for volumes and outputs (defaults to block gzip level 6, npz).
+            telemetry (Telemetry): Recorder of per-stage resource usage (defaults to one without outputs).
+            status_callback (Callable): Receives (current_step, total_steps, message, elapsed) of every
+                status update (defaults to print_status).
+            preview_dtype (str): Quantization of the preview pyramid, 'uint8' or 'uint16' (default: no
+                preview stage).
+        """
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.write_intermediates = tuple(write_intermediates)
+        self.output_writer = output_writer or OutputWriter(threads=self.cpu_budget)
+        self.telemetry = telemetry or Telemetry()
+        self.status_callback = status_callback or self.print_status
+        self.preview_dtype = preview_dtype
+
     @staticmethod
-    def print_status(current_step: int, total_step: int, message: str) -> None:
+    def print_status(current_step: int, total_step: int, message: str, elapsed: float = None) -> None:
         """Print the status of each step in the pipeline."""
         x = {'current_step': current_step, 'total_steps': total_step, 'message': message}
+        if elapsed is not None:
+            x['elapsed_seconds'] = round(elapsed, 3)
         logger.info(f"#**# {x} #**#")
 
-    def preprocessing_pipeline(self, prams: iBrain2uParamters, scan_id: str, refrence_vectors: dict[str, np.ndarray]) -> bool:
-        """Run the preprocessing pipeline."""
-        try:
-            self.print_status(0, 10, "Setup")
-            root_dir = prams.get_root_scan_dir(scan_id)
-            root_dir = os.path.join(root_dir, "data")
-            
-            sampled_image_file  = os.path.join(root_dir, f"{scan_id}_sampled.nii.gz")
-            stripped_image_file = os.path.join(root_dir, f"{scan_id}_synthstrip.nii.gz")
-            brainstrp_mask_file = os.path.join(root_dir, f"{scan_id}_synthstrip_mask.nii.gz")
-            segmented_mask_file = os.path.join(root_dir, f"{scan_id}_synthseg.nii.gz")
-            segmented_grpd_file = os.path.join(root_dir, f"{scan_id}_synthseg_grouped.nii.gz")
-            orientation_file    = os.path.join(root_dir, f"{scan_id}_orientation.npz")
-
-            # Skull stripping process
-            self.print_status(1, 10, "Skull Stripping")
-            self.__image_skullstrip__(sampled_image_file, stripped_image_file, brainstrp_mask_file)
-
-            # Brain segmentation
-            self.print_status(2, 10, "Region Segmentation")
-            self.__image_segmentation_grouping__(sampled_image_file, segmented_mask_file, segmented_grpd_file)
-            
-            self.print_status(3, 10, "Image Loading")
-            # Load mask and crop scan
-            mask_image: nib.Nifti1Image = nib.load(brainstrp_mask_file)
-            mask_array: np.ndarray = mask_image.get_fdata().astype(bool)
-            bounding_box = PreprocessingBase.compute_bounding_box(mask_array)
-
-            # Group image segments and create coordinate groups
-            self.print_status(4, 10, "Computing Bounding Box")
-            grouped_array = PreprocessingBase.load_and_crop(segmented_grpd_file, bounding_box)
-            self.print_status(5, 10, "Creating Group Coordinates")
-            coordiate_groups = PreprocessingBase.compute_center_groups(grouped_array)
-            normalised_coordinate_groups = PreprocessingBase.subtract_groups(coordiate_groups)
-
-            # Compute reference vectors and normalize
-            self.print_status(6, 10, "Computing Brain Orientation Vectors")
-            computed_vectors = PreprocessingBase.create_refrence_vectors(normalised_coordinate_groups)
-            stv_computed = PreprocessingBase.vector_to_stack(computed_vectors)
-            stv_refrence = PreprocessingBase.vector_to_stack(refrence_vectors)
-
-            # Compute rotation matrix and rotation angles
-            self.print_status(7, 10, "Computing Brain Orientation")
-            rotation_matrix, _ = orthogonal_procrustes(stv_refrence, stv_computed)
-            rot_pred: R = R.from_matrix(rotation_matrix)
-            rotation_angle_radians = rot_pred.as_euler("xyz", degrees=False)
-
-            # Center of the brain
-            computed_center = np.round(coordiate_groups["BRAIN_OFFSET_CENTER"])
-
-            # Load the stripped image and compute center offset
-            self.print_status(8, 10, "Loading and Orienting Brain Scan")
-            stripped_array = PreprocessingBase.load_and_crop(stripped_image_file, bounding_box, dtype=np.float32)
-            real_center = np.round(np.array(stripped_array.shape) / 2)
-            center_offset = computed_center - real_center
-
-            # Save orientation data
-            np.savez(
-                orientation_file, 
-                radian_array    = rotation_angle_radians,
-                computed_center = computed_center,
-                bbx_array       = PreprocessingBase.convert_bounding_box_2_array(bounding_box)
-            )
+    @staticmethod
+    def freesurfer_version(freesurfer_root: str, tool: str) -> str:
+        """Identify the installed FreeSurfer tool for cache keys."""
+        stamp_file = os.path.join(freesurfer_root, "build-stamp.txt")
+        if os.path.isfile(stamp_file):
+            with open(stamp_file) as stamp_ref:
+                return stamp_ref.read().strip()
 
-            # Shift image based on computed offset
-            moved_stripped_array = scimg.shift(stripped_array, shift=center_offset, cval=0).astype(np.float32)
+        tool_file = os.path.join(freesurfer_root, "bin", tool)
+        if os.path.isfile(tool_file):
+            tool_stat = os.stat(tool_file)
+            return f"{tool_stat.st_size}-{tool_stat.st_mtime_ns}"
+        return "unknown"
 
-            # Resize image
-            resized_array = PreprocessingBase.convert_size(moved_stripped_array)
+    def build_stages(self, freesurfer_root: str) -> list[PipelineStage]:
+        """Describe the preprocessing pipeline as a DAG of stages."""
+        stages = [
+            PipelineStage(
+                "skullstrip", "Skull Stripping",
+                lambda ctx, cpus: self._stage_skullstrip(freesurfer_root, ctx, cpus),
+                inputs=("sampled",), outputs=("stripped", "mask", "bounding_box"),
+                max_cpus=self.cpu_budget,
+                params={'tool': self.freesurfer_version(freesurfer_root, "mri_synthstrip")},
+                restore=self._restore_skullstrip
+            ),
+            PipelineStage(
+                "segmentation", "Region Segmentation",
+                lambda ctx, cpus: self._stage_segmentation(freesurfer_root, ctx, cpus),
+                inputs=("sampled",), outputs=("segmented",),
+                max_cpus=self.cpu_budget,
+                params={'tool': self.freesurfer_version(freesurfer_root, "mri_synthseg"), 'fast': True}
+            ),
+            PipelineStage(
+                "grouping", "Region Grouping", self._stage_grouping,
+                inputs=("segmented",), outputs=("grouped", "label_groups"),
+                params={'group_table': SYNTHSEG_GROUP_TABLE},
+                restore=self._restore_grouping
+            ),
+            PipelineStage(
+                "orientation", "Computing Brain Orientation", self._stage_orientation,
+                inputs=("label_groups", "bounding_box", "refrence_vectors"),
+                outputs=("orientation", "rotation_angle_radians", "computed_center"),
+                restore=self._restore_orientation
+            ),
+            PipelineStage(
+                "reorient", "Orienting and Writing Brain Scan", self._stage_reorient,
+                inputs=("stripped", "bounding_box", "rotation_angle_radians", "computed_center"),
+                outputs=("palapa_nifti", "palapa_numpy", "rotated_array"),
+                max_cpus=self.cpu_budget,
+                params={'target_size': TARGET_SIZE, 'resampling': 'fused-trilinear'}
+            ),
+        ]
+        if self.preview_dtype is not None:
+            stages.append(PipelineStage(
+                "preview", "Writing Preview Pyramid", self._stage_preview,
+                inputs=("rotated_array",), outputs=("preview_pyramid",) + tuple(f"preview_{x}" for x in PREVIEW_PLANES),
+                params={'factors': PREVIEW_FACTORS, 'dtype': self.preview_dtype}
+            ))
+        return stages
 
-            # Rotate the image
-            rotated_array = PreprocessingBase.rotate_array(resized_array, rotation_angle_radians) 
-            
-            self.print_status(9, 10, "Writing Results")
-            output_file = os.path.join(root_dir, f"{scan_id}_palapa.nii.gz")
-            output_img = nib.Nifti1Image(rotated_array, affine=np.eye(4))
-            nib.save(output_img, output_file)
+    def scan_paths(self, prams: Becik4UParameters, scan_id: str) -> dict[str, str]:
+        """Files of every pipeline artifact of a scan, in its data directory."""
+        root_dir = os.path.join(prams.get_root_scan_dir(scan_id), "data")
+        paths = {
+            "sampled":      os.path.join(root_dir, f"{scan_id}_sampled.nii.gz"),
+            "stripped":     os.path.join(root_dir, f"{scan_id}_synthstrip.nii.gz"),
+            "mask":         os.path.join(root_dir, f"{scan_id}_synthstrip_mask.nii.gz"),
+            "bounding_box": os.path.join(root_dir, f"{scan_id}_synthstrip_bbox.json"),
+            "segmented":    os.path.join(root_dir, f"{scan_id}_synthseg.nii.gz"),
+            "grouped":      os.path.join(root_dir, f"{scan_id}_synthseg_grouped.nii.gz"),
+            "label_groups": os.path.join(root_dir, f"{scan_id}_synthseg_groups.json"),
+            "orientation":  os.path.join(root_dir, f"{scan_id}_orientation.npz"),
+            "palapa_nifti": os.path.join(root_dir, f"{scan_id}_palapa.nii.gz"),
+            "palapa_numpy": self.output_writer.numpy_path(os.path.join(root_dir, f"{scan_id}_palapa")),
+            "preview_pyramid": os.path.join(root_dir, f"{scan_id}_palapa_preview.npz"),
+        }
+        paths.update({f"preview_{x}": os.path.join(root_dir, f"{scan_id}_palapa_preview_{x}.png") for x in PREVIEW_PLANES})
+        return paths
 
-            # Save as compressed numpy array
-            npy_path = os.path.join(root_dir, f"{scan_id}_palapa.npz")
-            np.savez_compressed(npy_path, image_array=rotated_array)
+    def preprocessing_pipeline(self, prams: Becik4UParameters, scan_id: str, refrence_vectors: dict[str, np.ndarray], force_from: str = None) -> bool:
+        """
+        Run the preprocessing pipeline.
 
-            self.print_status(10, 10, "Complete")
+        Stages whose inputs are unchanged since the last run are reused from the scan's
+        manifest; ``force_from`` reruns the named stage and every stage after it. A scan
+        without a manifest first links the outputs of a preprocessed duplicate (see
+        reuse_processed), whose stages are then reused the same way.
+        """
+        try:
+            stages = self.build_stages(prams.freesurfer)
+            self.status_callback(0, len(stages), "Setup")
+            paths = self.scan_paths(prams, scan_id)
+            root_dir = os.path.dirname(paths['sampled'])
+            store = VolumeStore(paths, set(PERSISTENT_VOLUMES) | set(self.write_intermediates), self.output_writer)
+            telemetry = self.telemetry.bind(scan_id=scan_id)
+            context = {'paths': paths, 'refrence_vectors': refrence_vectors, 'store': store, 'telemetry': telemetry}
+
+            stage_cache = None
+            try:
+                manifest_file = os.path.join(root_dir, f"{scan_id}_manifest.json")
+                if not os.path.isfile(manifest_file):
+                    with telemetry.measure("reuse"):
+                        self.reuse_processed(prams, scan_id, paths)
+                stage_cache = StageCache(manifest_file, paths, stages, force_from=force_from, store=store)
+
+                scheduler = StageScheduler(stage_cache.wrap_all(), self.cpu_budget, status_callback=self.status_callback,
+                                           telemetry=telemetry)
+                scheduler.run(context)
+            finally:
+                # Wait for the background writes of persistent volumes
+                with telemetry.measure("flush_writes"):
+                    try:
+                        store.close()
+                    finally:
+                        if stage_cache is not None:
+                            stage_cache.record_written()
+                self.telemetry.write_prometheus()
+
+            self.status_callback(len(stages), len(stages), "Complete")
         except Exception as error_exc:
             logger.error(f"#!!# ERROR REPORT #**# {error_exc}")
             return False
-        
+
         return True
 
-    def __image_skullstrip__(self, input_path: str, output_path: str, output_mask_path: str) -> None:
+    def reuse_processed(self, prams: Becik4UParameters, scan_id: str, paths: dict[str, str]) -> str:
+        """
+        Links the outputs and manifest of a preprocessed scan ingested with the same fingerprint.
+
+        The donor must have been ingested into an identical '_sampled' volume, so the stage
+        keys of the linked manifest match and only stages whose parameters differ are rerun.
+
+        Returns:
+            str: The donor scan ID, or None when there is none.
+        """
+        root_dir = os.path.dirname(paths['sampled'])
+        metadata_file = os.path.join(root_dir, f"{scan_id}_metadata.json")
+        if not os.path.isfile(metadata_file):
+            return None
+        fingerprint = PreprocessingBase.load_json(metadata_file).get('fingerprint')
+        if fingerprint is None:
+            return None
+
+        sampled_digest = None
+        for record in ScanIndex(prams).lookup("nifti", fingerprint, exclude=scan_id):
+            donor_id = record['scan_id']
+            donor_root = os.path.join(prams.get_root_scan_dir(donor_id), "data")
+            donor_sampled = os.path.join(donor_root, f"{donor_id}_sampled.nii.gz")
+            if not os.path.isfile(donor_sampled) or not os.path.isfile(os.path.join(donor_root, f"{donor_id}_manifest.json")):
+                continue
+            if not os.path.samefile(donor_sampled, paths['sampled']):
+                sampled_digest = sampled_digest or StageCache.file_digest(paths['sampled'])
+                if StageCache.file_digest(donor_sampled) != sampled_digest:
+                    continue
+
+            ScanIndex.link_outputs(donor_root, donor_id, root_dir, scan_id,
+                                   exclude=("metadata.json", "sampled.nii.gz", "raw.npz", "raw.npy"))
+            return donor_id
+        return None
+
+    def reorient_scan(self, prams: Becik4UParameters, scan_id: str, target_size: tuple = TARGET_SIZE, dtype: str = "float32",
+                      cpus: int = None) -> dict:
+        """
+        Re-orient a processed scan from its saved orientation, without running FreeSurfer.
+
+        The skull-stripped volume is cropped with the bounding box of '{id}_orientation.npz' and
+        resampled with its rotation and center into a ``target_size`` window. The default size and
+        dtype rewrite the pipeline's palapa outputs (e.g. after an output format change), other
+        settings write '{id}_palapa_{size}_{dtype}' files next to them.
+
+        Returns:
+            dict: 'scan_id', 'shape', 'dtype' and the written 'files'.
+
+        Raises:
+            Exception: If the scan has no saved orientation or skull-stripped volume.
+        """
+        import nibabel as nib
+
+        paths = self.scan_paths(prams, scan_id)
+        for name in ("orientation", "stripped"):
+            if not os.path.isfile(paths[name]):
+                raise Exception(f"Scan '{scan_id}' has no {os.path.basename(paths[name])}, run the pipeline first")
+
+        target_size = tuple(int(x) for x in target_size)
+        telemetry = self.telemetry.bind(scan_id=scan_id)
+        with telemetry.measure("reorient", mode="saved_orientation"):
+            with np.load(paths['orientation']) as orientation_data:
+                rotation_angle_radians = orientation_data['radian_array']
+                computed_center = orientation_data['computed_center']
+                bounding_box = PreprocessingBase.convert_array_2_bounding_box(orientation_data['bbx_array'])
+
+            # Same crop and centering as the pipeline's reorient stage, only the window size differs
+            stripped_array = PreprocessingBase.load_region(paths['stripped'], bounding_box)
+            center_offset = computed_center - np.round(np.array(CROP_SIZE) / 2)
+            rotated_array = PreprocessingBase.reorient_array(
+                stripped_array, center_offset, rotation_angle_radians, output_size=target_size,
+                threads=cpus or self.cpu_budget, padded_size=CROP_SIZE)
+            del stripped_array
+            output_array = self.cast_output(rotated_array, dtype)
+
+            if target_size == TARGET_SIZE and dtype == "float32":
+                nifti_path, numpy_path = paths['palapa_nifti'], paths['palapa_numpy']
+            else:
+                stem = os.path.join(os.path.dirname(paths['palapa_nifti']), f"{scan_id}_palapa_{'x'.join(map(str, target_size))}_{dtype}")
+                nifti_path, numpy_path = f"{stem}.nii.gz", self.output_writer.numpy_path(stem)
+
+            self.output_writer.write_outputs(
+                nifti_outputs=[(nib.Nifti1Image(output_array, affine=np.eye(4)), nifti_path)],
+                numpy_outputs=[(output_array, numpy_path)]
+            )
+
+        return {
+            'scan_id': scan_id,
+            'shape': list(output_array.shape),
+            'dtype': str(output_array.dtype),
+            'files': [os.path.basename(nifti_path), os.path.basename(numpy_path)],
+        }
+
+    def reorient_batch(self, prams: Becik4UParameters, scan_ids: list[str], target_size: tuple = TARGET_SIZE,
+                       dtype: str = "float32", workers: int = None) -> dict:
+        """
+        Re-orient many scans concurrently with reorient_scan.
+
+        Scans run on threads that share the CPU budget: the resampling and the zlib work release
+        the GIL, and no worker has to import torch/MONAI.
+
+        Returns:
+            dict: Per-scan results and aggregate counts.
+        """
+        workers = max(1, min(workers or self.cpu_budget, len(scan_ids)))
+        scan_cpus = max(1, self.cpu_budget // workers)
+
+        def run_scan(scan_id: str) -> dict:
+            start_time = time.perf_counter()
+            try:
+                result = self.reorient_scan(prams, scan_id, target_size, dtype, scan_cpus)
+                result['success'] = True
+            except Exception as error_exc:
+                logger.error(f"#!!# ERROR REPORT {scan_id} #**# {error_exc}")
+                result = {'scan_id': scan_id, 'success': False, 'error': str(error_exc)}
+            result['seconds'] = round(time.perf_counter() - start_time, 3)
+            return result
+
+        start_time = time.perf_counter()
+        results = []
+        self.status_callback(0, len(scan_ids), "Re-orienting from saved orientations")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_scan, scan_id) for scan_id in scan_ids]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                state = "Done" if result['success'] else "Failed"
+                self.status_callback(len(results), len(scan_ids), f"{result['scan_id']} {state}", result['seconds'])
+        self.telemetry.write_prometheus()
+
+        succeeded = sum(1 for x in results if x['success'])
+        return {
+            'scans': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'workers': workers,
+            'seconds': round(time.perf_counter() - start_time, 3),
+            'results': results,
+        }
+
+    @staticmethod
+    def cast_output(array: np.ndarray, dtype: str) -> np.ndarray:
+        """Cast a float32 output to dtype, rounding and clipping (in place) for integer types."""
+        dtype = np.dtype(dtype)
+        if dtype.kind == 'f':
+            return array.astype(dtype, copy=False)
+        limits = np.iinfo(dtype)
+        np.rint(array, out=array)
+        np.clip(array, limits.min, limits.max, out=array)
+        return array.astype(dtype)
+
+    def _stage_skullstrip(self, freesurfer_root: str, context: dict, cpus: int) -> dict:
+        """Skull strip into scratch files, keep the volumes in the store and compute the bounding box."""
+        paths, store = context['paths'], context['store']
+        scratch_dir = tempfile.mkdtemp(prefix=".scratch-", dir=os.path.dirname(paths['stripped']))
+        try:
+            # Uncompressed scratch output avoids a gzip encode/decode round trip
+            stripped_file = os.path.join(scratch_dir, "synthstrip.nii")
+            mask_file = os.path.join(scratch_dir, "synthstrip_mask.nii")
+            self.__image_skullstrip__(freesurfer_root, paths['sampled'], stripped_file, mask_file, cpus, context['telemetry'])
+            store.load_file("stripped", stripped_file, VOLUME_DTYPES['stripped'])
+            mask_array, _ = store.load_file("mask", mask_file, VOLUME_DTYPES['mask'])
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+        bounding_box = PreprocessingBase.compute_bounding_box(mask_array)
+        with open(paths['bounding_box'], "w") as jsn_ref:
+            json.dump(bounding_box, jsn_ref, indent=2)
+
+        store.release("mask")
+        return {'bounding_box': bounding_box}
+
+    def _restore_skullstrip(self, context: dict) -> dict:
+        """Reload the bounding box of a cached skull stripping stage."""
+        return {'bounding_box': PreprocessingBase.load_json(context['paths']['bounding_box'])}
+
+    def _stage_segmentation(self, freesurfer_root: str, context: dict, cpus: int) -> None:
+        """Segment into a scratch file and keep the label volume in the store."""
+        paths, store = context['paths'], context['store']
+        scratch_dir = tempfile.mkdtemp(prefix=".scratch-", dir=os.path.dirname(paths['segmented']))
+        try:
+            segmented_file = os.path.join(scratch_dir, "synthseg.nii")
+            self.__image_segmentation__(freesurfer_root, paths['sampled'], segmented_file, cpus, context['telemetry'])
+            store.load_file("segmented", segmented_file, VOLUME_DTYPES['segmented'])
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def _stage_grouping(self, context: dict, cpus: int) -> dict:
+        """Group the SynthSeg labels, keeping counts and centroids for later stages."""
+        paths, store = context['paths'], context['store']
+        label_array, affine = store.get("segmented")
+        label_groups = LabelGrouping.group_labels(label_array, SYNTHSEG_GROUP_TABLE)
+        store.put("grouped", label_groups.pop('grouped_array'), affine)
+        store.release("segmented")
+        store.release("grouped")
+
+        # Keep the counts and centroids so cached runs can skip the grouping pass
+        with open(paths['label_groups'], "w") as jsn_ref:
+            json.dump({
+                'counts': {str(k): v for k, v in label_groups['counts'].items()},
+                'centers': {str(k): v.tolist() for k, v in label_groups['centers'].items()},
+            }, jsn_ref, indent=2)
+
+        return {'label_groups': label_groups}
+
+    def _restore_grouping(self, context: dict) -> dict:
+        """Reload the group counts and centroids of a cached grouping stage."""
+        saved_groups = PreprocessingBase.load_json(context['paths']['label_groups'])
+        return {'label_groups': {
+            'counts': {int(k): v for k, v in saved_groups['counts'].items()},
+            'centers': {int(k): np.array(v) for k, v in saved_groups['centers'].items()},
+        }}
+
+    def _stage_orientation(self, context: dict, cpus: int) -> dict:
+        """Compute the brain orientation from the group centroids."""
+        from scipy.spatial.transform import Rotation as R
+        from scipy.linalg import orthogonal_procrustes
+
+        bounding_box = context['bounding_box']
+
+        # Create coordinate groups from the centroids of the grouping pass
+        coordiate_groups = PreprocessingBase.compute_center_groups(context['label_groups'], bounding_box)
+        normalised_coordinate_groups = PreprocessingBase.subtract_groups(coordiate_groups)
+
+        # Compute reference vectors and normalize
+        computed_vectors = PreprocessingBase.create_refrence_vectors(normalised_coordinate_groups)
+        stv_computed = PreprocessingBase.vector_to_stack(computed_vectors)
+        stv_refrence = PreprocessingBase.vector_to_stack(context['refrence_vectors'])
+
+        # Compute rotation matrix and rotation angles
+        rotation_matrix, _ = orthogonal_procrustes(stv_refrence, stv_computed)
+        rot_pred: R = R.from_matrix(rotation_matrix)
+        rotation_angle_radians = rot_pred.as_euler("xyz", degrees=False)
+
+        # Center of the brain
+        computed_center = np.round(coordiate_groups["BRAIN_OFFSET_CENTER"])
+
+        # Save orientation data
+        np.savez(
+            context['paths']['orientation'],
+            radian_array    = rotation_angle_radians,
+            computed_center = computed_center,
+            bbx_array       = PreprocessingBase.convert_bounding_box_2_array(bounding_box)
+        )
+
+        return {'rotation_angle_radians': rotation_angle_radians, 'computed_center': computed_center}
+
+    def _restore_orientation(self, context: dict) -> dict:
+        """Reload the orientation of a cached orientation stage."""
+        with np.load(context['paths']['orientation']) as orientation_data:
+            return {
+                'rotation_angle_radians': orientation_data['radian_array'],
+                'computed_center': orientation_data['computed_center'],
+            }
+
+    def _stage_reorient(self, context: dict, cpus: int) -> dict:
+        """Load the stripped image, move it to the brain center, resize, rotate and write it."""
+        store = context['store']
+        stripped_array = store.region("stripped", context['bounding_box'], dtype=np.float32)
+        store.release("stripped")
+        real_center = np.round(np.array(CROP_SIZE) / 2)
+        center_offset = context['computed_center'] - real_center
+
+        # Pad, shift, resize and rotate in one resampling pass, the padded crop is never allocated
+        rotated_array = PreprocessingBase.reorient_array(
+            stripped_array, center_offset, context['rotation_angle_radians'], threads=cpus, padded_size=CROP_SIZE)
+
+        # Encode both outputs concurrently
+        import nibabel as nib
+        output_img = nib.Nifti1Image(rotated_array, affine=np.eye(4))
+        self.output_writer.write_outputs(
+            nifti_outputs=[(output_img, context['paths']['palapa_nifti'])],
+            numpy_outputs=[(rotated_array, context['paths']['palapa_numpy'])]
+        )
+
+        return {'rotated_array': rotated_array}
+
+    def _stage_preview(self, context: dict, cpus: int) -> None:
+        """Write the quantized preview pyramid and the mid-plane thumbnails of the oriented scan."""
+        paths = context['paths']
+        rotated_array = context.get('rotated_array')
+        if rotated_array is None:
+            # A cached reorient stage restores nothing, the oriented scan is only reloaded when a stage reads it
+            rotated_array = OutputWriter.load_numpy(paths['palapa_numpy'])
+        preview = PreviewPyramid.build(rotated_array, PREVIEW_FACTORS, self.preview_dtype)
+
+        arrays = {'factors': np.array(PREVIEW_FACTORS), 'scale': np.float64(preview['scale']), 'offset': np.float64(preview['offset'])}
+        arrays.update({f"level_{i}": level for i, level in enumerate(preview['levels'])})
+        self.output_writer.write_arrays(arrays, paths['preview_pyramid'])
+        for name, image in preview['thumbnails'].items():
+            self.output_writer.write_png(image, paths[f"preview_{name}"])
+
+    def __image_skullstrip__(self, freesurfer_root: str, input_path: str, output_path: str, output_mask_path: str, cpus: int = 1,
+                             telemetry: Telemetry = None) -> None:
         """Perform skull stripping."""
-        global gbl_freesurfer_root, gbl_freesurfer_cpus
-        logger.info("### FREESURFER - SYNTHSTRIP - START ###")   
-        start_time = datetime.datetime.now()
-
-        subprocess.run([
-            os.path.join(gbl_freesurfer_root, "bin", "mri_synthstrip"),
-            "-i", input_path, 
-            "-o", output_path, 
-            "-m", output_mask_path], 
-            check=True
+        logger.info("### FREESURFER - SYNTHSTRIP - START ###")
+        record = (telemetry or self.telemetry).run_subprocess([
+            os.path.join(freesurfer_root, "bin", "mri_synthstrip"),
+            "-i", input_path,
+            "-o", output_path,
+            "-m", output_mask_path,
+            "-t", str(cpus)],
+            "mri_synthstrip"
         )
-        stop_time = datetime.datetime.now()
-        exec_time = stop_time - start_time
-        logger.info(f"### STOP : {exec_time.total_seconds()} seconds ###")
+        logger.info(f"### STOP : {record['wall_seconds']} seconds ###")
 
-    def __image_segmentation_grouping__(self, input_path: str, output_path: str, grouped_path: str) -> None:
-        """Segment image into brain sections and group."""
-        global gbl_freesurfer_root, gbl_freesurfer_cpus
+    def __image_segmentation__(self, freesurfer_root: str, input_path: str, output_path: str, cpus: int = 1,
+                               telemetry: Telemetry = None) -> None:
+        """Segment image into brain sections."""
         logger.info("### FREESURFER - SYTHSEG - START ###")
-        start_time = datetime.datetime.now()
-        
-        subprocess.run([
-            os.path.join(gbl_freesurfer_root, "bin", "mri_synthseg"),
-            "--i", input_path, 
+        record = (telemetry or self.telemetry).run_subprocess([
+            os.path.join(freesurfer_root, "bin", "mri_synthseg"),
+            "--i", input_path,
             "--o", output_path,
             "--fast", "--cpu",
-            "--threads", gbl_freesurfer_cpus], 
-            check=True
+            "--threads", str(cpus)],
+            "mri_synthseg"
         )
-
-        self.__image_grouping__(output_path, grouped_path)
-        
-        stop_time = datetime.datetime.now()
-        exec_time = stop_time - start_time
-        logger.info(f"### STOP : {exec_time.total_seconds()} seconds ###")    
-
-    def __image_grouping__(self, input_path: str, output_image_path: str) -> None:
-        """Group image segments into a mask."""
-        # Internal logic for binary mask creation
-        def create_binary_mask(array: np.ndarray, masked_values: list[int]) -> np.ndarray:
-            binary_array = np.zeros_like(array, dtype=bool)
-            for numerical_value in masked_values:
-                binary_array[array == numerical_value] = True
-            return binary_array
-
-        def compute_binary_center(array: np.ndarray) -> np.ndarray:
-            """Compute center of mass for a binary mask."""
-            indices = np.nonzero(array)
-            return np.mean(indices, axis=1)
-
-        def compute_masked_values(source_array: np.ndarray, masked_values: list[int], replacement_value: int = 1) -> tuple:
-            """Compute masked values for the image."""
-            masked_binary = create_binary_mask(source_array, masked_values)
-            center_of_mass = compute_binary_center(masked_binary)
-            output_array = np.uint16(masked_binary)
-            output_array *= replacement_value
-            return (output_array, masked_binary, center_of_mass)
-
-        # Process the segmentation grouping logic
-        base_img = nib.load(input_path)
-        array = base_img.get_fdata()
-
-        a_lcer, _, _ = compute_masked_values(array, [2, 3], 100)
-        a_lcor, _, _ = compute_masked_values(array, [7, 8], 200)
-        a_rcer, _, _ = compute_masked_values(array, [41, 42], 300)
-        a_rcor, _, _ = compute_masked_values(array, [46, 47], 400)
-        a_stem, _, _ = compute_masked_values(array, [16], 500)
-
-        # Create the mask array 
-        mask_array = np.zeros_like(array, dtype=np.uint16)
-        mask_array += a_lcer
-        mask_array += a_lcor
-        mask_array += a_rcer
-        mask_array += a_rcor
-        mask_array += a_stem
-
-        # Save the final mask
-        masked_img = nib.Nifti1Image(mask_array, affine=base_img.affine, header=base_img.header)
-        nib.save(masked_img, output_image_path)
+        logger.info(f"### STOP : {record['wall_seconds']} seconds ###")
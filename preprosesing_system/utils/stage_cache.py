@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+import datetime
+import threading
+import numpy as np
+from loguru import logger
+
+from .stage_scheduler import PipelineStage
+from .volume_store import VolumeStore
+
+MANIFEST_VERSION = 1
+
+
+class StageCache:
+    """
+    Content-addressed cache of pipeline stages, backed by a per-scan JSON manifest.
+
+    Every stage gets a key hashed from its name, parameters and input digests. File inputs
+    produced by an earlier stage use the digest recorded for that output, external file
+    inputs are hashed from disk and in-memory inputs are hashed from their value. A stage
+    is skipped when its key matches the manifest and its recorded outputs are still present.
+    Volumes held by the VolumeStore are recorded by content digest, so intermediates that
+    are never written still chain the keys of later stages. A volume its stage already
+    released is not hashed; later stages chain on the producing stage's key instead.
+    Persistent volumes are written in the background, their file size is recorded by
+    record_written once the writes are flushed, and until then the stage is not reused.
+    """
+
+    def __init__(self, manifest_path: str, paths: dict[str, str], stages: list[PipelineStage], force_from: str = None,
+                 store: VolumeStore = None):
+        self.manifest_path = manifest_path
+        self.paths = paths
+        self.store = store
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.manifest = self._load_manifest()
+        self.signatures = {}
+
+        self.producers = {artifact: stage.name for stage in stages for artifact in stage.outputs}
+        self.forced = set()
+        if force_from is not None:
+            names = [stage.name for stage in stages]
+            if force_from not in names:
+                raise Exception(f"Unknown pipeline stage '{force_from}'")
+            self.forced = set(names[names.index(force_from):])
+            for name in self.forced:
+                self.manifest['stages'].pop(name, None)
+            self._save_manifest()
+
+    def _load_manifest(self) -> dict:
+        """Load the manifest, starting fresh if it is missing or from another version."""
+        try:
+            with open(self.manifest_path) as jsn_ref:
+                manifest = json.load(jsn_ref)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {'version': MANIFEST_VERSION, 'stages': {}}
+
+    def _save_manifest(self) -> None:
+        """Atomically write the manifest."""
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as jsn_ref:
+            json.dump(self.manifest, jsn_ref, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    @staticmethod
+    def file_digest(file_path: str, chunk_size: int = 1 << 20) -> str:
+        """Hash a file's content."""
+        digest = hashlib.blake2b(digest_size=20)
+        with open(file_path, "rb") as file_ref:
+            for chunk in iter(lambda: file_ref.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def value_digest(value) -> str:
+        """Hash an in-memory parameter or artifact value."""
+        def encode(x):
+            if isinstance(x, np.ndarray):
+                return {'dtype': str(x.dtype), 'shape': list(x.shape), 'data': x.tolist()}
+            if isinstance(x, (np.integer, np.floating)):
+                return x.item()
+            if isinstance(x, (tuple, set)):
+                return list(x)
+            raise TypeError(f"Cannot hash value of type {type(x).__name__}")
+
+        payload = json.dumps(value, sort_keys=True, default=encode)
+        return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+    def _input_signature(self, artifact: str, context: dict) -> str:
+        """Signature of one stage input."""
+        if artifact in self.signatures:
+            return self.signatures[artifact]
+
+        if artifact in self.producers:
+            entry = self.manifest['stages'].get(self.producers[artifact], {})
+            signature = entry.get('outputs', {}).get(artifact, {}).get('digest') or entry.get('key', "")
+        elif artifact in self.paths:
+            signature = self.file_digest(self.paths[artifact])
+        else:
+            signature = self.value_digest(context.get(artifact))
+
+        with self.lock:
+            self.signatures[artifact] = signature
+        return signature
+
+    def stage_key(self, stage: PipelineStage, context: dict) -> str:
+        """Hash a stage's name, parameters and inputs."""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(stage.name.encode())
+        digest.update(self.value_digest(stage.params).encode())
+        for artifact in stage.inputs:
+            digest.update(artifact.encode())
+            digest.update(self._input_signature(artifact, context).encode())
+        return digest.hexdigest()
+
+    def _outputs_present(self, entry: dict) -> bool:
+        """Check that every recorded output file still exists with its recorded size."""
+        for artifact, output in entry.get('outputs', {}).items():
+            if not output.get('persistent', True):
+                continue
+            file_path = self.paths.get(artifact)
+            if file_path is None or not os.path.isfile(file_path):
+                return False
+            if output.get('size') is None or os.path.getsize(file_path) != output['size']:
+                return False
+        return True
+
+    def record_written(self) -> None:
+        """
+        Record the size and file digest of the persistent volumes written in the background.
+
+        Called after the VolumeStore is flushed. Outputs whose write did not complete keep no
+        size, so their stage is rerun instead of reusing a missing or stale file.
+        """
+        if self.store is None:
+            return
+        with self.lock:
+            for entry in self.manifest['stages'].values():
+                for artifact, output in entry.get('outputs', {}).items():
+                    if not output.get('persistent') or output.get('size') is not None or not self.store.was_written(artifact):
+                        continue
+                    file_path = self.paths[artifact]
+                    output['size'] = os.path.getsize(file_path)
+                    output['file_digest'] = self.file_digest(file_path)
+            self._save_manifest()
+
+    def wrap(self, stage: PipelineStage) -> PipelineStage:
+        """Return a copy of the stage that consults the cache before running."""
+        def cached_function(context: dict, cpus: int):
+            key = self.stage_key(stage, context)
+            entry = self.manifest['stages'].get(stage.name)
+
+            if (stage.cacheable and stage.name not in self.forced and entry is not None
+                    and entry.get('key') == key and self._outputs_present(entry)):
+                logger.info(f"### STAGE {stage.name} - CACHED ###")
+                return stage.restore(context) if stage.restore is not None else None
+
+            result = stage.function(context, cpus)
+
+            outputs = {}
+            for artifact in stage.outputs:
+                file_path = self.paths.get(artifact)
+                if self.store is not None and self.store.tracks(artifact):
+                    # Persistent volumes may still be in the background writer, see record_written
+                    outputs[artifact] = {
+                        'path': os.path.basename(file_path),
+                        'digest': self.store.digest(artifact),
+                        'persistent': self.store.is_persistent(artifact),
+                    }
+                elif file_path is not None and os.path.isfile(file_path):
+                    outputs[artifact] = {
+                        'path': os.path.basename(file_path),
+                        'size': os.path.getsize(file_path),
+                        'digest': self.file_digest(file_path),
+                    }
+
+            with self.lock:
+                self.manifest['stages'][stage.name] = {
+                    'key': key,
+                    'outputs': outputs,
+                    'completed': datetime.datetime.now().isoformat(timespec='seconds'),
+                }
+                self._save_manifest()
+            return result
+
+        return PipelineStage(
+            stage.name, stage.description, cached_function,
+            inputs=stage.inputs, outputs=stage.outputs,
+            min_cpus=stage.min_cpus, max_cpus=stage.max_cpus,
+            params=stage.params, restore=stage.restore, cacheable=stage.cacheable
+        )
+
+    def wrap_all(self) -> list[PipelineStage]:
+        """Wrap every stage of the pipeline."""
+        return [self.wrap(stage) for stage in self.stages]
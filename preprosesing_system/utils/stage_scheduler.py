@@ -0,0 +1,161 @@
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Optional
+
+from loguru import logger
+
+from telemetry import Telemetry
+
+
+class PipelineStage:
+    """
+    A single pipeline stage with declared input and output artifacts.
+
+    The stage function is called as ``function(context, cpus)`` and returns a dict of the
+    in-memory artifacts it produced (or None when it only writes files). ``params`` holds
+    the settings that change the stage result, and ``restore(context)`` rebuilds the
+    in-memory artifacts from the stage's files when a cached run is reused.
+    """
+
+    def __init__(self, name: str, description: str, function: Callable[[dict, int], Optional[dict]],
+                 inputs: tuple = (), outputs: tuple = (), min_cpus: int = 1, max_cpus: int = 1,
+                 params: dict = None, restore: Callable[[dict], Optional[dict]] = None, cacheable: bool = True):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.min_cpus = min_cpus
+        self.max_cpus = max(max_cpus, min_cpus)
+        self.params = params or {}
+        self.restore = restore
+        self.cacheable = cacheable
+
+
+class StageScheduler:
+    """
+    Runs a DAG of pipeline stages, starting independent stages in parallel.
+
+    Dependencies are derived from the declared artifacts: a stage depends on every stage
+    producing one of its inputs. Running stages share a fixed CPU budget; each stage gets
+    at least ``min_cpus`` and at most ``max_cpus`` of the CPUs free when it starts.
+    With a Telemetry recorder, every stage run is emitted as a 'stage' event.
+    """
+
+    def __init__(self, stages: list[PipelineStage], cpu_budget: int,
+                 status_callback: Callable[[int, int, str, Optional[float]], None] = None,
+                 telemetry: Telemetry = None):
+        self.stages = stages
+        self.cpu_budget = max(1, int(cpu_budget))
+        self.status_callback = status_callback
+        self.telemetry = telemetry
+        self.dependencies = self._resolve_dependencies()
+
+    def _resolve_dependencies(self) -> dict[str, set[str]]:
+        """Map each stage to the stages producing its inputs."""
+        producers = {}
+        for stage in self.stages:
+            for artifact in stage.outputs:
+                if artifact in producers:
+                    raise Exception(f"Artifact '{artifact}' produced by '{producers[artifact]}' and '{stage.name}'")
+                producers[artifact] = stage.name
+
+        dependencies = {
+            stage.name: {producers[x] for x in stage.inputs if x in producers}
+            for stage in self.stages
+        }
+
+        # Reject cycles early rather than deadlocking at run time
+        resolved = set()
+        while len(resolved) < len(dependencies):
+            ready = {name for name, deps in dependencies.items() if name not in resolved and deps <= resolved}
+            if not ready:
+                raise Exception("Pipeline stages contain a dependency cycle")
+            resolved |= ready
+
+        return dependencies
+
+    def _report(self, current_step: int, message: str, elapsed: float = None) -> None:
+        if self.status_callback is not None:
+            self.status_callback(current_step, len(self.stages), message, elapsed)
+
+    def _execute(self, stage: PipelineStage, context: dict, cpus: int) -> tuple[Optional[dict], float]:
+        measure = self.telemetry.measure(stage.name, cpus=cpus) if self.telemetry is not None else contextlib.nullcontext()
+        start_time = time.perf_counter()
+        with measure:
+            result = stage.function(context, cpus)
+        return result, time.perf_counter() - start_time
+
+    def run(self, context: dict) -> dict:
+        """
+        Run every stage once its inputs are available.
+
+        Args:
+            context (dict): Initial artifacts; updated in place with the stage results.
+
+        Returns:
+            dict: The context with all produced artifacts.
+        """
+        pending = list(self.stages)
+        completed = set()
+        running = {}
+        timings = {}
+        free_cpus = self.cpu_budget
+        context_lock = threading.Lock()
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=len(self.stages) or 1) as executor:
+            while pending or running:
+                ready = [s for s in pending if self.dependencies[s.name] <= completed] if failure is None else []
+
+                # Admit ready stages in declaration order while their minimum fits the budget
+                admitted = []
+                reserved = 0
+                for stage in ready:
+                    min_cpus = min(stage.min_cpus, self.cpu_budget)
+                    if reserved + min_cpus > free_cpus:
+                        break
+                    admitted.append(stage)
+                    reserved += min_cpus
+
+                # Share the free CPUs between the admitted stages
+                share = free_cpus // len(admitted) if admitted else 0
+                spare = free_cpus - share * len(admitted) if admitted else 0
+                for stage in admitted:
+                    cpus = min(stage.max_cpus, max(min(stage.min_cpus, self.cpu_budget), share + spare))
+                    spare = 0
+                    free_cpus -= cpus
+                    pending.remove(stage)
+                    self._report(len(completed), stage.description)
+                    logger.info(f"### STAGE {stage.name} - START ({cpus} cpus) ###")
+                    running[executor.submit(self._execute, stage, context, cpus)] = (stage, cpus)
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, cpus = running.pop(future)
+                    free_cpus += cpus
+                    try:
+                        result, elapsed = future.result()
+                    except Exception as error_exc:
+                        logger.error(f"### STAGE {stage.name} - FAILED : {error_exc} ###")
+                        failure = failure or error_exc
+                        continue
+
+                    with context_lock:
+                        if result:
+                            context.update(result)
+                    completed.add(stage.name)
+                    timings[stage.name] = elapsed
+                    logger.info(f"### STAGE {stage.name} - STOP : {elapsed:.3f} seconds ###")
+                    self._report(len(completed), f"{stage.description} Done", elapsed)
+
+        if failure is not None:
+            raise failure
+
+        context['stage_timings'] = timings
+        return context
@@ -0,0 +1,222 @@
+import numpy as np
+
+# Voxels streamed per block for the projection and moment kernels
+SLAB_VOXELS = 1 << 22
+
+# Group centers used for the orientation vectors
+ORIENTATION_GROUPS = ("LEFT_CEREBRUM", "LEFT_CEREBELLUM", "RIGHT_CEREBRUM", "RIGHT_CEREBELLUM", "BRAIN_STEM")
+
+
+class AxisHistograms:
+    """
+    Per-axis label histograms of a volume, accumulated one slice at a time.
+
+    For every label ordinal the three marginal histograms give the voxel count and the
+    coordinate sums, so counts and centroids of all labels come out of a single pass
+    without materializing voxel coordinates.
+    """
+
+    def __init__(self, shape: tuple, n_ordinals: int):
+        size_a, size_b, size_c = shape
+        self.n_ordinals = n_ordinals
+        self.hist_a = np.zeros((size_a, n_ordinals), dtype=np.int64)
+        self.hist_b = np.zeros((size_b, n_ordinals), dtype=np.int64)
+        self.hist_c = np.zeros((size_c, n_ordinals), dtype=np.int64)
+        self.b_offsets = (np.arange(size_b, dtype=np.intp) * n_ordinals)[:, None]
+        self.c_offsets = (np.arange(size_c, dtype=np.intp) * n_ordinals)[None, :]
+
+    def add_slice(self, index: int, ordinals: np.ndarray) -> None:
+        """Add slice ``index`` of the first axis, given as an intp array of label ordinals."""
+        size_b, size_c = len(self.hist_b), len(self.hist_c)
+        self.hist_a[index] = np.bincount(ordinals.ravel(), minlength=self.n_ordinals)
+        self.hist_b += np.bincount((ordinals + self.b_offsets).ravel(), minlength=size_b * self.n_ordinals).reshape(size_b, self.n_ordinals)
+        self.hist_c += np.bincount((ordinals + self.c_offsets).ravel(), minlength=size_c * self.n_ordinals).reshape(size_c, self.n_ordinals)
+
+    def moments(self, reverse_axes: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Voxel counts and coordinate sums of every ordinal.
+
+        Args:
+            reverse_axes (bool): The slices were taken from a transposed (Fortran ordered) view.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: counts (n_ordinals,) and coordinate sums (n_ordinals, 3).
+        """
+        axis_hists = [self.hist_a, self.hist_b, self.hist_c]
+        if reverse_axes:
+            axis_hists.reverse()
+        counts = self.hist_a.sum(axis=0)
+        sums = np.stack([np.arange(hist.shape[0], dtype=np.float64) @ hist for hist in axis_hists], axis=1)
+        return counts, sums
+
+
+class VolumeGeometry:
+    """
+    Geometry kernels on label volumes and masks.
+
+    Bounding boxes come from per-axis ``any`` projections and centroids from per-axis
+    weighted sums, streamed along the slowest axis so that no N x 3 coordinate array is
+    ever built.
+    """
+
+    @staticmethod
+    def slowest_axis_view(array: np.ndarray) -> tuple[np.ndarray, bool]:
+        """View whose first axis is the slowest-varying one (NIfTI arrays are Fortran ordered)."""
+        fortran_order = np.isfortran(array)
+        return (array.T if fortran_order else array), fortran_order
+
+    @staticmethod
+    def _slabs(size_a: int, plane_voxels: int):
+        """Yield (start, stop) slabs of about SLAB_VOXELS voxels along the first axis."""
+        step = max(1, SLAB_VOXELS // max(plane_voxels, 1))
+        for start in range(0, size_a, step):
+            yield start, min(start + step, size_a)
+
+    @staticmethod
+    def bounding_box(array: np.ndarray) -> dict[str, int]:
+        """
+        Bounding box of the non-zero region from per-axis projections.
+
+        Args:
+            array (np.ndarray): 3D mask or volume.
+
+        Returns:
+            dict[str, int]: First and last non-zero index per axis, in compute_bounding_box's format.
+        """
+        view, fortran_order = VolumeGeometry.slowest_axis_view(array)
+        profile_a = np.zeros(view.shape[0], dtype=bool)
+        plane = np.zeros(view.shape[1:], dtype=bool)
+
+        for start, stop in VolumeGeometry._slabs(view.shape[0], plane.size):
+            slab = view[start:stop] != 0
+            profile_a[start:stop] = slab.any(axis=(1, 2))
+            plane |= slab.any(axis=0)
+
+        profiles = [profile_a, plane.any(axis=1), plane.any(axis=0)]
+        if fortran_order:
+            profiles.reverse()
+        if not profile_a.any():
+            raise Exception("Values Not Found!")
+
+        bounds = {}
+        for name, profile in zip(("x", "y", "z"), profiles):
+            indices = np.flatnonzero(profile)
+            bounds[f'start_{name}'] = int(indices[0])
+            bounds[f'stop_{name}'] = int(indices[-1])
+        return bounds
+
+    @staticmethod
+    def center_of_mass(array: np.ndarray, key=None) -> np.ndarray:
+        """
+        Centroid of the voxels equal to ``key`` (or of all non-zero voxels) from per-axis sums.
+
+        Args:
+            array (np.ndarray): 3D label volume or mask.
+            key: Label value to locate, None for every non-zero voxel.
+
+        Returns:
+            np.ndarray: The centroid in voxel coordinates.
+        """
+        view, fortran_order = VolumeGeometry.slowest_axis_view(array)
+        profile_a = np.zeros(view.shape[0], dtype=np.int64)
+        plane = np.zeros(view.shape[1:], dtype=np.int64)
+
+        for start, stop in VolumeGeometry._slabs(view.shape[0], plane.size):
+            slab = view[start:stop] != 0 if key is None else view[start:stop] == key
+            profile_a[start:stop] = slab.sum(axis=(1, 2))
+            plane += slab.sum(axis=0)
+
+        count = profile_a.sum()
+        if count == 0:
+            raise Exception("Values Not Found!")
+
+        profiles = [profile_a, plane.sum(axis=1), plane.sum(axis=0)]
+        if fortran_order:
+            profiles.reverse()
+        return np.array([np.arange(len(p), dtype=np.float64) @ p for p in profiles]) / count
+
+    @staticmethod
+    def compute_center_groups(label_groups: dict, bounds: dict[str, int], crop_offset: np.ndarray,
+                              group_names: dict[int, str]) -> dict[str, np.ndarray]:
+        """
+        Map group centroids of the full volume into the cropped and padded space.
+
+        Args:
+            label_groups (dict): 'counts' and 'centers' per group value, from the grouping pass.
+            bounds (dict[str, int]): Bounding box the volume is cropped to.
+            crop_offset (np.ndarray): Offset of the cropped region inside the padded volume.
+            group_names (dict[int, str]): Name of every group value.
+
+        Returns:
+            dict[str, np.ndarray]: Center per group name, plus the count-weighted BRAIN_OFFSET_CENTER.
+        """
+        crop_start = np.array([bounds['start_x'], bounds['start_y'], bounds['start_z']])
+        shift = crop_offset - crop_start
+
+        center_groups = {}
+        total_weight = 0
+        weighted_sum = np.zeros(3, dtype=np.float64)
+        for group_value, center in label_groups['centers'].items():
+            center_groups[group_names.get(group_value, str(group_value))] = center + shift
+            total_weight += label_groups['counts'][group_value]
+            weighted_sum += center * label_groups['counts'][group_value]
+
+        if total_weight == 0:
+            raise Exception("Values Not Found!")
+
+        center_groups["BRAIN_OFFSET_CENTER"] = weighted_sum / total_weight + shift
+        return center_groups
+
+    @staticmethod
+    def subtract_groups(coordinate_groups: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """Express every group center relative to BRAIN_OFFSET_CENTER."""
+        brain_center = coordinate_groups["BRAIN_OFFSET_CENTER"]
+        return {
+            name: center - brain_center
+            for name, center in coordinate_groups.items()
+            if name != "BRAIN_OFFSET_CENTER"
+        }
+
+    @staticmethod
+    def create_refrence_vectors(coordinate_groups: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """
+        Build the three orientation vectors of a brain from its group centers.
+
+        ALPHA points from the left to the right hemisphere, BETA from the cerebellum to the
+        cerebrum and GAMMA from the brain stem to the cerebrum; each is unit length.
+        """
+        missing = [x for x in ORIENTATION_GROUPS if x not in coordinate_groups]
+        if missing:
+            raise Exception(f"Groups not found: {', '.join(missing)}")
+
+        def mean(*names: str) -> np.ndarray:
+            return np.mean([coordinate_groups[x] for x in names], axis=0)
+
+        def normalise(vector: np.ndarray) -> np.ndarray:
+            norm = np.linalg.norm(vector)
+            return vector if norm == 0 else vector / norm
+
+        cerebrum = mean("LEFT_CEREBRUM", "RIGHT_CEREBRUM")
+        return {
+            "VECTOR_ALPHA": normalise(mean("RIGHT_CEREBRUM", "RIGHT_CEREBELLUM") - mean("LEFT_CEREBRUM", "LEFT_CEREBELLUM")),
+            "VECTOR_BETA": normalise(cerebrum - mean("LEFT_CEREBELLUM", "RIGHT_CEREBELLUM")),
+            "VECTOR_GAMMA": normalise(cerebrum - coordinate_groups["BRAIN_STEM"]),
+        }
+
+    @staticmethod
+    def convert_bounding_box_2_array(bounds: dict[str, int]) -> np.ndarray:
+        """Bounding box as a (3, 2) array of [start, stop] rows for x, y and z."""
+        return np.array([
+            [bounds['start_x'], bounds['stop_x']],
+            [bounds['start_y'], bounds['stop_y']],
+            [bounds['start_z'], bounds['stop_z']],
+        ], dtype=np.int64)
+
+    @staticmethod
+    def convert_array_2_bounding_box(bbx_array: np.ndarray) -> dict[str, int]:
+        """Bounding box dict from a (3, 2) array of [start, stop] rows, the inverse of convert_bounding_box_2_array."""
+        return {
+            f"{edge}_{axis}": int(bbx_array[row][column])
+            for row, axis in enumerate("xyz")
+            for column, edge in enumerate(("start", "stop"))
+        }
@@ -0,0 +1,211 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from .processing_base import PreprocessingBase, CROP_SIZE
+from output_writer import OutputWriter
+from nifti_reader import NiftiReader
+
+if TYPE_CHECKING:
+    import nibabel as nib
+
+# Planes (along the last, slowest file axis) read at a time when a volume is cast on load
+LOAD_SLAB_PLANES = 16
+
+
+class VolumeStore:
+    """
+    Per-run store of volumes shared between pipeline stages.
+
+    Arrays and affines produced by one stage stay in memory for later stages instead of
+    being gzip-written and read back. Volumes marked persistent are written to their path
+    by a background thread through the OutputWriter (atomically renamed into place); everything
+    else is only kept in memory.
+    """
+
+    def __init__(self, paths: dict[str, str], persistent: set[str], writer: OutputWriter = None, writer_threads: int = 2):
+        self.paths = paths
+        self.writer = writer or OutputWriter()
+        self.persistent = set(persistent)
+        self.volumes = {}
+        self.digests = {}
+        self.released = set()
+        self.written = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=writer_threads)
+
+    def is_persistent(self, name: str) -> bool:
+        """Whether the volume is written to disk."""
+        return name in self.persistent
+
+    def put(self, name: str, array: np.ndarray, affine: np.ndarray, header: "nib.Nifti1Header" = None) -> None:
+        """Keep a volume in memory and schedule its write if it is persistent."""
+        with self.lock:
+            self.volumes[name] = (array, affine, header)
+            self.digests.pop(name, None)
+            self.released.discard(name)
+            self.written.discard(name)
+
+        if self.is_persistent(name):
+            future = self.executor.submit(self._write, name, array, affine, header)
+            with self.lock:
+                self.pending[name] = future
+
+    def _write(self, name: str, array: np.ndarray, affine: np.ndarray, header: "nib.Nifti1Header") -> None:
+        """Write a volume atomically through the output writer."""
+        import nibabel as nib
+
+        # NIfTI has no boolean type, masks are written as uint8 without a copy
+        if array.dtype == bool:
+            array = array.view(np.uint8)
+        if header is not None:
+            header = header.copy()
+            header.set_data_dtype(array.dtype)
+        self.writer.write_nifti(nib.Nifti1Image(array, affine=affine, header=header), self.paths[name])
+        with self.lock:
+            self.written.add(name)
+
+    def load_file(self, name: str, file_path: str, dtype=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Read a volume written by an external tool into the store.
+
+        With ``dtype`` the file is read slab by slab into one array of that type, so a label or
+        mask volume written as int32/float never exists at its file size in memory. Integer
+        casts are checked against the range of the target type.
+        """
+        import nibabel as nib
+
+        nib_image: nib.Nifti1Image = nib.load(file_path, mmap=False)
+        if dtype is None or nib_image.get_data_dtype() == dtype:
+            array = np.asanyarray(nib_image.dataobj)
+        else:
+            array = self._read_as(nib_image.dataobj, np.dtype(dtype), name)
+        self.put(name, array, nib_image.affine, nib_image.header)
+        return array, nib_image.affine
+
+    @staticmethod
+    def _read_as(proxy, dtype: np.dtype, name: str) -> np.ndarray:
+        """Read a NIfTI array proxy into a Fortran-ordered array of dtype, LOAD_SLAB_PLANES at a time."""
+        array = np.empty(proxy.shape, dtype=dtype, order='F')
+        limits = np.iinfo(dtype) if dtype.kind in "ui" else None
+        for start in range(0, proxy.shape[-1], LOAD_SLAB_PLANES):
+            slab = np.asarray(proxy[..., start:start + LOAD_SLAB_PLANES])
+            if limits is not None and slab.size and (slab.min() < limits.min or slab.max() > limits.max):
+                raise Exception(f"Volume '{name}' has values outside the range of {dtype}")
+            array[..., start:start + LOAD_SLAB_PLANES] = slab
+        return array
+
+    def get(self, name: str) -> tuple[np.ndarray, np.ndarray]:
+        """Return (array, affine), reading the persisted file when it is not in memory."""
+        with self.lock:
+            if name in self.volumes:
+                array, affine, _ = self.volumes[name]
+                return array, affine
+
+        file_path = self.paths[name]
+        if not os.path.isfile(file_path):
+            raise Exception(f"Volume '{name}' is neither in memory nor written to {file_path}")
+
+        nib_image = NiftiReader.load(file_path, self.writer.threads)
+        array = np.asanyarray(nib_image.dataobj)
+        with self.lock:
+            self.volumes[name] = (array, nib_image.affine, nib_image.header)
+        return array, nib_image.affine
+
+    def region(self, name: str, bounds: dict[str, int], dtype=None) -> np.ndarray:
+        """
+        Bounding-box region of a volume: a view when it is in memory, otherwise only the
+        region is read from its file. Cast to ``dtype`` only when the type differs.
+        """
+        with self.lock:
+            in_memory = name in self.volumes
+        if in_memory:
+            array, _ = self.get(name)
+            cropped_array = array[
+                bounds['start_x']:bounds['stop_x'],
+                bounds['start_y']:bounds['stop_y'],
+                bounds['start_z']:bounds['stop_z']
+            ]
+        else:
+            cropped_array = PreprocessingBase.load_region(self.paths[name], bounds)
+        return cropped_array if dtype is None else cropped_array.astype(dtype, copy=False)
+
+    def crop(self, name: str, bounds: dict[str, int], spatial_size=CROP_SIZE, dtype=np.uint16) -> np.ndarray:
+        """Crop and pad a volume like PreprocessingBase.load_and_crop, from memory when possible."""
+        return PreprocessingBase.pad_or_crop_into(self.region(name, bounds), spatial_size, dtype)
+
+    def digest(self, name: str) -> str:
+        """
+        Content hash of a volume (data and affine), independent of compression.
+
+        A volume released before its digest was asked for has none (None); the stage cache
+        then chains later keys on the key of the stage that produced it.
+        """
+        with self.lock:
+            if name in self.digests:
+                return self.digests[name]
+            if name not in self.volumes and name in self.released:
+                return None
+
+        array, affine = self.get(name)
+        fortran_order = array.flags.f_contiguous and not array.flags.c_contiguous
+        data = array.T if fortran_order else np.ascontiguousarray(array)
+
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{array.dtype.str}{array.shape}{'F' if fortran_order else 'C'}".encode())
+        digest.update(data.data)
+        digest.update(np.ascontiguousarray(affine, dtype=np.float64).data)
+
+        with self.lock:
+            self.digests[name] = digest.hexdigest()
+        return self.digests[name]
+
+    def contains(self, name: str) -> bool:
+        """Whether the volume is held in memory."""
+        with self.lock:
+            return name in self.volumes
+
+    def was_written(self, name: str) -> bool:
+        """Whether the background write of the volume put in this run completed."""
+        with self.lock:
+            return name in self.written
+
+    def tracks(self, name: str) -> bool:
+        """Whether the volume was put in the store during this run (even if since released)."""
+        with self.lock:
+            return name in self.volumes or name in self.released
+
+    def release(self, name: str) -> None:
+        """Drop a volume from memory, keeping its digest if one was computed; a pending write keeps its own reference."""
+        with self.lock:
+            if self.volumes.pop(name, None) is not None:
+                self.released.add(name)
+
+    def flush(self) -> None:
+        """Wait for all background writes, raising the first error."""
+        with self.lock:
+            pending = list(self.pending.items())
+            self.pending = {}
+
+        failure = None
+        for name, future in pending:
+            try:
+                future.result()
+            except Exception as error_exc:
+                logger.error(f"### WRITE {name} - FAILED : {error_exc} ###")
+                failure = failure or error_exc
+
+        if failure is not None:
+            raise failure
+
+    def close(self) -> None:
+        """Flush pending writes and stop the writer threads."""
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)